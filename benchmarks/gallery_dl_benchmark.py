@@ -0,0 +1,93 @@
+"""
+Per download overhead of gallery-dl: a new job and configuration per call
+(how download_pic_from_url worked before) against one long lived GalleryDownloader.
+Pictures come from a local keep-alive HTTP server, so the network costs next to nothing.
+gallery-dl's sleep between downloads is turned off for both.
+python -m benchmarks.gallery_dl_benchmark [--amount=200]
+"""
+import functools
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import fire
+from gallery_dl.job import config
+from PIL import Image
+
+from src.gallery_dl_helper import (
+    GalleryDownloader,
+    PathRecordingJob,
+    configure_gallery_dl,
+)
+
+
+class CountingHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        CountingHandler.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(folder: str) -> http.server.ThreadingHTTPServer:
+    handler = functools.partial(CountingHandler, directory=folder)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def download_with_new_job(url: str, folder: str) -> list:
+    configure_gallery_dl(folder)
+    config.set((), "sleep", 0)
+    job = PathRecordingJob(url)
+    job.run()
+    return job.written_paths
+
+
+def measure(name: str, download, amount: int, served: str, folder: str) -> None:
+    # a server per measurement, so no connection is carried over from the previous one
+    server = start_server(served)
+    # the local url isn't a direct i.redd.it link, so it goes through gallery-dl
+    url = f"http://127.0.0.1:{server.server_port}/noise.png"
+    CountingHandler.connections = 0
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(amount):
+        for path in download(url, folder):
+            path.unlink()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    server.shutdown()
+
+    print(
+        f"{name:<20} {wall / amount * 1000:6.2f}ms wall {cpu / amount * 1000:6.2f}ms cpu "
+        f"per download, {CountingHandler.connections} connections"
+    )
+
+
+def main(amount: int = 200):
+    served = tempfile.mkdtemp()
+    folder = tempfile.mkdtemp()
+    Image.frombytes("RGB", (200, 200), os.urandom(200 * 200 * 3)).save(
+        os.path.join(served, "noise.png")
+    )
+
+    try:
+        measure("new job per call", download_with_new_job, amount, served, folder)
+
+        downloader = GalleryDownloader(folder)
+        config.set((), "sleep", 0)
+        measure("GalleryDownloader", downloader.download, amount, served, folder)
+    finally:
+        shutil.rmtree(served)
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,58 @@
+"""
+Compare the batch phash of src/img_helper.py with one imagehash.phash call per picture.
+python -m benchmarks.phash_benchmark [--amount=500] [--size=1200]
+"""
+import time
+
+import fire
+import imagehash
+import numpy as np
+from PIL import Image
+
+from src.img_helper import phash_batch, phash_thumbnail, phash_thumbnails
+
+
+def make_images(amount: int, size: int) -> list:
+    rng = np.random.default_rng(0)
+    return [
+        Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+        for _ in range(amount)
+    ]
+
+
+def timed(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(amount: int = 500, size: int = 1200, repeat: int = 3):
+    images = make_images(amount, size)
+    thumbnails = np.stack([phash_thumbnail(image) for image in images])
+
+    expected = [str(imagehash.phash(image)) for image in images]
+    assert phash_batch(images) == expected, "batch phash differs from imagehash"
+
+    per_image = timed(lambda: [str(imagehash.phash(im)) for im in images], repeat)
+    batch = timed(lambda: phash_batch(images), repeat)
+    per_thumbnail = timed(
+        lambda: [str(imagehash.phash(Image.fromarray(t))) for t in thumbnails], repeat
+    )
+    batch_thumbnails = timed(lambda: phash_thumbnails(thumbnails), repeat)
+
+    print(f"{amount} pictures {size}x{size}, best of {repeat}")
+    print(f"imagehash.phash per picture:   {per_image:.3f}s")
+    print(f"phash_batch:                   {batch:.3f}s ({per_image / batch:.2f}x)")
+    print("without resizing (32x32 thumbnails only):")
+    print(f"imagehash.phash per thumbnail: {per_thumbnail:.3f}s")
+    print(
+        f"phash_thumbnails:              {batch_thumbnails:.3f}s "
+        f"({per_thumbnail / batch_thumbnails:.2f}x)"
+    )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
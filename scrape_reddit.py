@@ -3,31 +3,78 @@ Use praw/psaw api to scrape reddit, store the data in the db,
 and delete the pictures to save space.
 Fire module is used to turn this into a cli.
 """
-import glob
+import asyncio
+import functools
+import io
+import multiprocessing
 import os
-import signal
+import shutil
+import threading
 import time
 import warnings
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
 from enum import Enum
+from itertools import islice
 from pathlib import Path
-from typing import Any, List, Optional, Tuple
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import fire
-import imagehash
 import praw
 import psycopg2
-import psycopg2.errors as psql_err
+import psycopg2.extras
+import psycopg2.pool
 from dotenv import find_dotenv, load_dotenv
 from PIL import Image, ImageFile
 from psaw import PushshiftAPI
 
-from src.gallery_dl_helper import download_pic_from_url
+from src.blob_cache import BlobCache
+from src.gallery_dl_helper import (
+    download_pic_from_url,
+    download_pic_to_buffer,
+    get_downloader,
+    is_direct_image_url,
+    rename_downloaded_file,
+)
+from src.gallery_dl_pool import DownloadTimeout, GalleryDLPool
+from src.host_policy import HostUnavailable
+from src.image_features import (
+    ImageFeatures,
+    compute_features,
+    get_file_size,
+    save_features,
+)
+from src.img_helper import PHASH_MODES, hamming_distance
+from src.phash_index import PhashIndex
+from src.poll_schedule import (
+    PollPolicy,
+    get_due_subreddits,
+    get_post_rates,
+    plan_poll,
+    save_poll_plan,
+)
+from src.preflight import MAX_DIMENSIONS_SUM, MIN_DIMENSIONS_SUM, preflight_check
+from src.scrape_pipeline import Pipeline
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True  # else OsError
 
 load_dotenv(find_dotenv(raise_error_if_not_found=True))
 
+MEGABYTE = 1000000
+
 
 class PostSearchType(Enum):
     NEW = 1
@@ -35,19 +82,88 @@ class PostSearchType(Enum):
     TOP = 3
 
 
-def connect_to_postgres():
-    connection = psycopg2.connect(
+def parse_post_search_type(value) -> PostSearchType:
+    """Fire passes --PRAW_MODE=PostSearchType.NEW as a plain string,
+    accept that, "new"/"hot"/"top" or the enum itself
+    """
+    if isinstance(value, PostSearchType):
+        return value
+    return PostSearchType[str(value).split(".")[-1].upper()]
+
+
+def get_postgres_params() -> dict:
+    return dict(
         user=os.environ.get("DB_USER_NAME"),
         password=os.environ.get("DB_USER_PASSWORD"),
         host="localhost",
         port=int(os.environ.get("DB_PORT")),
         database=os.environ.get("DB_NAME"),
     )
+
+
+def connect_to_postgres():
+    connection = psycopg2.connect(**get_postgres_params())
     connection.autocommit = True
     cursor = connection.cursor()
     return connection, cursor
 
 
+def create_postgres_pool(maxconn: int) -> psycopg2.pool.ThreadedConnectionPool:
+    """Connection pool shared by threads that scrape different subreddits"""
+    return psycopg2.pool.ThreadedConnectionPool(1, maxconn, **get_postgres_params())
+
+
+def get_reddit_client() -> praw.Reddit:
+    return praw.Reddit(
+        client_id=os.environ.get("REDDIT_CLIENT_ID"),
+        client_secret=os.environ.get("REDDIT_CLIENT_SECRET"),
+        user_agent=os.environ.get("REDDIT_USER_AGENT"),
+        username=os.environ.get("REDDIT_USERNAME"),
+        password=os.environ.get("REDDIT_PASSWORD"),
+    )
+
+
+def get_listing(
+    reddit: praw.Reddit,
+    subreddit_name: str,
+    mode,
+    amount: int,
+    watermark: Optional[int] = None,
+    watermark_run: int = 25,
+):
+    """Subreddit listing, in NEW mode it stops early once
+    {watermark_run} posts in a row are not newer than {watermark} (see stop_at_watermark)
+    """
+    subreddit = reddit.subreddit(subreddit_name)
+    mode = parse_post_search_type(mode)
+    if mode == PostSearchType.HOT:
+        return subreddit.hot(limit=amount)
+    elif mode == PostSearchType.TOP:
+        return subreddit.top(limit=amount)
+
+    listing = subreddit.new(limit=amount)
+    if watermark is None or watermark_run <= 0:
+        return listing
+    return stop_at_watermark(listing, watermark, watermark_run)
+
+
+def stop_at_watermark(submissions: Iterable, watermark: int, run: int) -> Iterator:
+    """Yield submissions until {run} consecutive ones are not newer than {watermark}.
+    New listings are sorted by date, but not strictly (removed/approved posts etc),
+    so a single old post doesn't stop the iteration. Praw fetches listings lazily,
+    so the pages after the stop are never requested.
+    """
+    old_in_a_row = 0
+    for subm in submissions:
+        yield subm
+        if int(subm.created_utc) <= watermark:
+            old_in_a_row += 1
+            if old_in_a_row >= run:
+                return
+        else:
+            old_in_a_row = 0
+
+
 def postgres_access(func):
     def wrapper(*args, **kwargs):
         conn, cur = connect_to_postgres()
@@ -64,87 +180,343 @@ def close_postgres_connection(connection, cursor):
     connection.close()
 
 
-def timeout_handler(num, stack):
-    print("Received SIGALARM")
-    raise Exception("DownloadIsTooLong")
+def get_filename_from_subm(subm):
+    return str(int(subm.created_utc)) + "_" + str(subm.id)
+
+
+@dataclass
+class DownloadOptions:
+    """How pictures of new submissions are downloaded and checked.
+
+    Args:
+        folder (str): temporary download folder
+        workers (int): amount of download processes
+        timeout (int): seconds to wait for a single download
+        in_memory (bool): keep downloaded pictures in memory instead of writing them to {folder}
+        max_memory (int): in_memory size limit per picture in bytes, bigger ones spill to {folder}
+        preflight (bool): check content type, size and dimensions of direct picture urls
+            before downloading
+        phash_mode (str): "exact", "draft" or "verify", see src/img_helper.py
+        blob_cache (Optional[BlobCache]): keep optimized jpegs of valid pictures for the downloader
+    """
+
+    folder: str
+    workers: int = 1
+    timeout: int = 60
+    in_memory: bool = False
+    max_memory: int = 32 * MEGABYTE
+    preflight: bool = True
+    phash_mode: str = "exact"
+    blob_cache: Optional[BlobCache] = field(default_factory=BlobCache.from_env)
+
+    def __post_init__(self):
+        if self.phash_mode not in PHASH_MODES:
+            raise ValueError(f"phash_mode must be one of {PHASH_MODES}")
+
+
+def make_download_options(
+    folder: str,
+    workers: int,
+    download_timeout: int = 60,
+    in_memory: bool = False,
+    max_memory_mb: int = 32,
+    preflight: bool = True,
+    phash_mode: str = "exact",
+) -> DownloadOptions:
+    """DownloadOptions from the download flags that all Scraper commands take.
+
+    Args:
+        workers (int): Parallel downloads, each command has its own default.
+        download_timeout (int, optional): Seconds before a download is killed. Defaults to 60.
+        in_memory (bool, optional): Check pictures without writing them to disk. Defaults to False.
+        max_memory_mb (int, optional): Pictures above this size are written to disk anyway. Defaults to 32.
+        preflight (bool, optional): Check content type, size and dimensions
+            of direct picture urls (i.redd.it, i.imgur.com) before downloading them.
+            Defaults to True.
+        phash_mode (str, optional): "exact" decodes pictures fully, "draft" decodes jpegs
+            at reduced resolution (faster, phash may differ in a couple of bits),
+            "verify" computes both and reports differences. Defaults to "exact".
+    """
+    return DownloadOptions(
+        folder=folder,
+        workers=workers,
+        timeout=download_timeout,
+        in_memory=in_memory,
+        max_memory=max_memory_mb * MEGABYTE,
+        preflight=preflight,
+        phash_mode=phash_mode,
+    )
+
+
+def passes_preflight(url: str, options: DownloadOptions) -> bool:
+    """False if the picture would be rejected after the download anyway.
+    Only direct picture urls are checked, for gallery pages it would be a wasted request.
+    The check goes through the session of the download that follows, so it reuses the connection.
+    """
+    if not options.preflight or not is_direct_image_url(url):
+        return True
+
+    session = get_downloader(options.folder).direct_session
+    result = preflight_check(url, session=session)
+    if not result.ok:
+        print(f"Skipping {url}: {result.reason}")
+    return result.ok
+
+
+# (submission, is_wrong_format, phash, features)
+CheckedSubmission = Tuple[Any, bool, Optional[str], Optional[ImageFeatures]]
+
+
+def split_features(
+    checked_submissions: Iterable[CheckedSubmission],
+) -> Tuple[List[Tuple[Any, bool, Optional[str]]], Dict[str, ImageFeatures]]:
+    """(submission, is_wrong_format, phash) tuples for the db and features by post id"""
+    filtered_submissions = []
+    features_by_post = {}
+    for subm, is_wrong_format, phash, features in checked_submissions:
+        filtered_submissions.append((subm, is_wrong_format, phash))
+        if features is not None:
+            features_by_post[subm.id] = features
+    return filtered_submissions, features_by_post
+
+
+def download_and_check(
+    url: str, new_name: str, options: DownloadOptions
+) -> Tuple[bool, Optional[str], Optional[ImageFeatures]]:
+    """Download a picture, rename it to {new_name} and check it with PIL.
+
+    Returns:
+        [type]: is_wrong_format, phash, features
+    """
+    if not passes_preflight(url, options):
+        return True, None, None
+
+    if options.in_memory:
+        buffers = download_pic_to_buffer(
+            url, max_memory=options.max_memory, spill_folder=options.folder
+        )
+        if not buffers:
+            return True, None, None
 
+        try:
+            return check_validity_and_features(
+                buffers[0], options.phash_mode, options.blob_cache, url
+            )
+        finally:
+            for buffer in buffers:
+                buffer.close()
+
+    downloaded_paths = download_pic_from_url(url=url, folder=options.folder)
+    if not downloaded_paths:
+        return True, None, None
+
+    new_path = rename_downloaded_file(downloaded_paths[0], new_name)
+    return check_validity_and_features(
+        new_path, options.phash_mode, options.blob_cache, url
+    )
 
-def rename_latest_file_in_folder(folder: str, new_filename: str):
-    """Gallery-dl loads images with random names, rename the latest downloaded one
-    to {new_filename} + {.ext}
+
+@dataclass
+class UrlChecks:
+    """url -> running or finished check of one run, shared by the subreddits it scrapes,
+    the thread counterpart of AsyncScrapeContext.url_checks.
+    Crossposts wait for the first check of their url instead of downloading it again.
+    """
+
+    checks: Dict[str, Future] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def submit(self, url: str, start: Callable[[], Future]) -> Future:
+        """Check of {url}, started with start() if it is the first one"""
+        with self._lock:
+            if url not in self.checks:
+                self.checks[url] = start()
+            return self.checks[url]
+
+    def claim(self, url: str) -> Tuple[Future, bool]:
+        """Check of {url} and whether it is the first one, whose result the caller sets"""
+        with self._lock:
+            if url in self.checks:
+                return self.checks[url], False
+            check = self.checks[url] = Future()
+            return check, True
+
+
+def download_submissions(
+    submissions: list,
+    options: DownloadOptions,
+    pool: Optional[GalleryDLPool] = None,
+    url_checks: Optional[UrlChecks] = None,
+) -> List[CheckedSubmission]:
+    """Download and check pictures of submissions in {options.workers} worker processes,
+    a download that takes longer than {options.timeout} seconds gets its worker killed.
+    Results are returned in the same order as the submissions.
 
     Args:
-        new_filename (str): {created_utc} + '_' + {post.id}
+        submissions (list): reddit submission objects
+        pool (Optional[GalleryDLPool], optional): pool shared with other scrapes,
+            it is left running for the caller to close.
+        url_checks (Optional[UrlChecks], optional): checks shared with other scrapes
+            of the pool, urls they already download are not downloaded again.
 
     Returns:
-        [type]: new path to renamed file
+        List[CheckedSubmission]: (submission, is_wrong_format, phash, features)
     """
-    file_path = get_latest_filename_in_folder(folder)
-    if not file_path:
-        print("No file path found")
-        return
-    old_ext = file_path.suffix
-    old_path = Path(file_path).resolve().parent
-    new_path = Path(old_path, new_filename + old_ext)
-    file_path.rename(new_path)
-    return new_path
+    if pool is not None:
+        return _download_submissions_in_pool(submissions, options, pool, url_checks)
+
+    if not submissions:
+        return []
+
+    with GalleryDLPool(options.workers, options.timeout, options.folder) as pool:
+        return _download_submissions_in_pool(submissions, options, pool, url_checks)
+
+
+def _download_submissions_in_pool(
+    submissions: list,
+    options: DownloadOptions,
+    pool: GalleryDLPool,
+    url_checks: Optional[UrlChecks] = None,
+) -> List[CheckedSubmission]:
+    url_checks = UrlChecks() if url_checks is None else url_checks
+    pending = []
+    for subm in submissions:
+        url = str(subm.url)
+        future = url_checks.submit(
+            url,
+            lambda: pool.submit(
+                download_and_check, url, get_filename_from_subm(subm), options, url=url
+            ),
+        )
+        pending.append((subm, future))
 
+    filtered_submissions: List[CheckedSubmission] = []
+    for subm, future in pending:
+        try:
+            is_wrong_format, phash, features = future.result()
+        except (DownloadTimeout, HostUnavailable) as ex:
+            print(f"Aborting download of {subm.url}: {ex}")
+            filtered_submissions.append((subm, True, None, None))
+            continue
+        except Exception:
+            filtered_submissions.append((subm, True, None, None))
+            continue
 
-def get_latest_filename_in_folder(folder: str) -> Optional[Path]:
-    download_folder = str(Path(f"./{folder}/*").absolute())
-    try:
-        last_file = max(glob.glob(download_folder), key=os.path.getctime)
-    except ValueError:
-        print("Couldnt find a file")
-        return None
+        filtered_submissions.append((subm, is_wrong_format, phash, features))
 
-    return Path(last_file)
+    return filtered_submissions
 
 
-def get_filename_from_subm(subm):
-    return str(int(subm.created_utc)) + "_" + str(subm.id)
+REDDIT_POST_COLUMNS = (
+    "sub_name",
+    "post_id",
+    "author",
+    "title",
+    "url",
+    "created_utc",
+    "phash",
+    "wrong_format",
+)
 
 
-def insert_pic_record(
-    cursor,
-    sub_name: str,
-    post_id: str,
-    author: str,
-    title: str,
-    url: str,
-    created_utc: str,
-    phash: str,
-    wrong_format: bool,
-):
+def insert_pic_records(cursor, rows: List[tuple], page_size: int = 1000) -> List[str]:
+    """Insert many records with a few multi-row statements.
+    Rows that conflict with existing ones are skipped.
+
+    Args:
+        rows (List[tuple]): values in REDDIT_POST_COLUMNS order
+
+    Returns:
+        List[str]: post ids of actually inserted rows
+    """
     query = """INSERT INTO my_app_redditpost (sub_name, post_id, author, title, url, created_utc, phash, wrong_format)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"""
-    cursor.execute(
-        query,
-        (
-            sub_name,
-            post_id,
-            author,
-            title,
-            url,
-            created_utc,
-            phash,
-            wrong_format,
-        ),
+            VALUES %s ON CONFLICT DO NOTHING RETURNING post_id"""
+    inserted = psycopg2.extras.execute_values(
+        cursor, query, rows, page_size=page_size, fetch=True
     )
+    return [row[0] for row in inserted]
 
 
-def does_post_id_exist(cursor, table_name: str, post_id: str) -> bool:
+def get_column_max_lengths(
+    cursor, table_name: str = "my_app_redditpost"
+) -> Dict[str, int]:
     """
-    Returns True if post_id exists in database
+    Returns {column_name: max length} for the varchar columns of a table
     """
-    query = """SELECT post_id FROM my_app_redditpost WHERE post_id=%s AND sub_name=%s"""
+    query = """SELECT column_name, character_maximum_length FROM information_schema.columns
+            WHERE table_name=%s AND character_maximum_length IS NOT NULL"""
 
-    cursor.execute(query, (post_id, table_name))
-    data = cursor.fetchall()
-    if data:
-        return True
-    else:
-        return False
+    cursor.execute(query, (table_name,))
+    return {name: length for name, length in cursor.fetchall()}
+
+
+def get_existing_post_ids(cursor, table_name: str, post_ids: List[str]) -> Set[str]:
+    """
+    Returns the subset of post_ids that already exist in database
+    """
+    query = """SELECT post_id FROM my_app_redditpost WHERE sub_name=%s AND post_id = ANY(%s)"""
+
+    cursor.execute(query, (table_name, post_ids))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def filter_new_submissions(
+    cursor, table_name: str, submissions: Iterable, page_size: int = 100
+) -> Iterator:
+    """Buffer submissions into pages (reddit listings return 100 items per request)
+    and drop the ones already in database with a single query per page.
+    """
+    submissions = iter(submissions)
+    while True:
+        page = list(islice(submissions, page_size))
+        if not page:
+            return
+
+        existing_ids = get_existing_post_ids(
+            cursor, table_name, [str(subm.id) for subm in page]
+        )
+        for subm in page:
+            if str(subm.id) not in existing_ids:
+                yield subm
+
+
+def get_known_url_results(
+    cursor, urls: List[str]
+) -> Dict[str, Tuple[bool, Optional[str]]]:
+    """Look up pictures that were already downloaded and checked for another post
+    (crossposts etc), uses the index from sql_commands/redditpost_url_index.sql
+
+    Returns:
+        Dict[str, Tuple[bool, Optional[str]]]: url -> (is_wrong_format, phash)
+    """
+    if not urls:
+        return {}
+
+    # failed downloads are retried, they might have been temporary
+    query = """SELECT DISTINCT ON (url) url, wrong_format, phash FROM my_app_redditpost
+            WHERE url = ANY(%s) AND phash IS NOT NULL"""
+
+    cursor.execute(query, (urls,))
+    return {
+        url: (wrong_format, phash) for url, wrong_format, phash in cursor.fetchall()
+    }
+
+
+def attach_known_url_results(
+    cursor, submissions: Iterable, page_size: int = 100
+) -> Iterator[Tuple[Any, Optional[Tuple[bool, Optional[str]]]]]:
+    """Pair submissions with the known (is_wrong_format, phash) of their url,
+    looked up one page at a time. None means the url has to be downloaded.
+    """
+    submissions = iter(submissions)
+    while True:
+        page = list(islice(submissions, page_size))
+        if not page:
+            return
+
+        known = get_known_url_results(cursor, list({str(subm.url) for subm in page}))
+        for subm in page:
+            yield subm, known.get(str(subm.url))
 
 
 def get_last_post_time(cursor, table_name):
@@ -156,151 +528,921 @@ def get_last_post_time(cursor, table_name):
     return data
 
 
+def load_phash_index(cursor, radius: int) -> Optional[PhashIndex]:
+    """Phashes of all valid pictures for near duplicate checks, None if radius is 0"""
+    if radius <= 0:
+        return None
+
+    started = time.monotonic()
+    phash_index = PhashIndex.from_db(cursor, radius=radius)
+    print(f"Loaded {len(phash_index)} phashes in {time.monotonic() - started:.1f}s")
+    return phash_index
+
+
+def flag_near_duplicates(
+    filtered_submissions: list, phash_index: PhashIndex
+) -> List[tuple]:
+    """Find new pictures that are almost identical to a known one.
+    They keep their own phash, the match is only recorded in near_duplicate,
+    so a false positive never merges two pictures. Pictures that aren't duplicates
+    are added to the index.
+
+    Returns:
+        List[tuple]: (submission, own phash, known phash, distance) of the near duplicates
+    """
+    near_duplicates = []
+    for subm, is_wrong_format, phash in filtered_submissions:
+        if phash is None or is_wrong_format:
+            continue
+
+        match = phash_index.find(phash)
+        if match is None:
+            phash_index.add(phash)
+        elif match[0] != phash:
+            known_phash, distance = match
+            print(f"Near duplicate {subm.id}: {distance} bits from {known_phash}")
+            near_duplicates.append((subm, phash, known_phash, distance))
+
+    return near_duplicates
+
+
+def insert_near_duplicates(
+    cursor, subreddit_name: str, near_duplicates: List[tuple]
+) -> None:
+    """Record near duplicates, the downloader skips them, see sql_commands/near_duplicate.sql"""
+    if not near_duplicates:
+        return
+
+    psycopg2.extras.execute_values(
+        cursor,
+        """INSERT INTO near_duplicate (sub_name, post_id, phash, duplicate_of, distance)
+        VALUES %s ON CONFLICT DO NOTHING""",
+        [
+            (subreddit_name, subm.id, phash, known_phash, distance)
+            for subm, phash, known_phash, distance in near_duplicates
+        ],
+    )
+
+
+# tables of optional features, looked up once per process
+_existing_tables: Dict[str, bool] = {}
+
+
+def has_table(cursor, table_name: str) -> bool:
+    """False if sql_commands/{table_name}.sql wasn't run yet, which is reported once,
+    the scrape then goes on without the feature
+    """
+    if table_name not in _existing_tables:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (table_name,))
+        _existing_tables[table_name] = cursor.fetchone()[0]
+        if not _existing_tables[table_name]:
+            print(f"Table {table_name} is missing, run sql_commands/{table_name}.sql")
+    return _existing_tables[table_name]
+
+
+def get_watermark(cursor, table_name) -> Optional[int]:
+    """created_utc of the newest known post, None if there are no posts yet"""
+    data = get_last_post_time(cursor, table_name)
+    if not data:
+        return None
+    return int(data[0][0])
+
+
+@dataclass
+class SubredditSpec:
+    """One entry of scrape_all's subreddit list, written as name[:mode[:amount]]"""
+
+    name: str
+    mode: PostSearchType = PostSearchType.NEW
+    amount: int = 1000
+
+    @classmethod
+    def from_str(cls, value: str):
+        name, *rest = str(value).strip().split(":")
+        spec = cls(name=name)
+        if rest and rest[0]:
+            spec.mode = parse_post_search_type(rest[0])
+        if len(rest) > 1 and rest[1]:
+            spec.amount = int(rest[1])
+        return spec
+
+
+def parse_subreddit_specs(subreddits) -> List[SubredditSpec]:
+    """Fire gives either a string "a:new:1000,b" or a list/tuple of such entries"""
+    if isinstance(subreddits, str):
+        subreddits = subreddits.split(",")
+    return [SubredditSpec.from_str(value) for value in subreddits if str(value).strip()]
+
+
+@dataclass
+class ScrapeSummary:
+    sub_name: str
+    start_time: str = field(
+        default_factory=lambda: datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    )
+    end_time: str = ""
+    new: int = 0
+    reused: int = 0
+    failed: int = 0
+    inserted: int = 0
+
+    def finish(self):
+        self.end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return self
+
+    def __str__(self):
+        return (
+            f"[{self.start_time}] {self.sub_name}: inserted {self.inserted} posts "
+            f"({self.new} new, {self.reused} reused by url, {self.failed} failed downloads) "
+            f"[{self.end_time}]"
+        )
+
+
+def scrape_submissions(
+    connection,
+    subreddit_name: str,
+    submissions: Iterable,
+    options: DownloadOptions,
+    pool: Optional[GalleryDLPool] = None,
+    phash_index: Optional[PhashIndex] = None,
+    url_checks: Optional[UrlChecks] = None,
+) -> ScrapeSummary:
+    """Drop known submissions, download and check the new ones and insert them into db.
+    Scrapes that run at once share {pool} and {url_checks}, so a url is downloaded once.
+    """
+    summary = ScrapeSummary(sub_name=subreddit_name)
+
+    with connection.cursor() as cur:
+        # check if post id is already in database
+        new_submissions = list(filter_new_submissions(cur, subreddit_name, submissions))
+        # crossposts of already checked pictures don't need another download
+        url_results = get_known_url_results(
+            cur, list({str(subm.url) for subm in new_submissions})
+        )
+    summary.reused = sum(1 for subm in new_submissions if str(subm.url) in url_results)
+
+    # download every unknown url only once, even if it was posted several times
+    to_download = {}
+    for subm in new_submissions:
+        if str(subm.url) not in url_results:
+            to_download.setdefault(str(subm.url), subm)
+
+    url_features = {}
+    for subm, is_wrong_format, phash, features in download_submissions(
+        list(to_download.values()), options, pool, url_checks
+    ):
+        url_results[str(subm.url)] = (is_wrong_format, phash)
+        url_features[str(subm.url)] = features
+
+    filtered_submissions, features_by_post = split_features(
+        (subm, *url_results[str(subm.url)], url_features.get(str(subm.url)))
+        for subm in new_submissions
+    )
+
+    # add them to database
+    summary.new = len(filtered_submissions)
+    summary.failed = sum(1 for _, _, phash in filtered_submissions if phash is None)
+    summary.inserted = add_filtered_submissions_to_db(
+        connection,
+        filtered_submissions,
+        subreddit_name,
+        phash_index=phash_index,
+        features=features_by_post,
+    )
+    return summary.finish()
+
+
+def buffer_to_payload(
+    buffer: BinaryIO, new_name: str, options: DownloadOptions
+) -> Union[Path, bytes]:
+    """Bytes of a downloaded picture up to {options.max_memory},
+    bigger ones are written to {options.folder} as {new_name}, so they are
+    not read into memory and pickled on their way to the hash process.
+    """
+    size = buffer.seek(0, io.SEEK_END)
+    buffer.seek(0)
+    if size <= options.max_memory:
+        return buffer.read()
+
+    path = Path(options.folder, new_name)
+    with open(path, "wb") as file:
+        shutil.copyfileobj(buffer, file)
+    return path
+
+
+def fetch_payload(
+    url: str, new_name: str, options: DownloadOptions
+) -> Union[Path, bytes, None]:
+    """Download a picture as a path or bytes, None if it couldn't be downloaded.
+    In memory pictures come back as bytes, unless they were spilled to disk.
+    """
+    if not passes_preflight(url, options):
+        return None
+
+    if options.in_memory:
+        buffers = download_pic_to_buffer(
+            url, max_memory=options.max_memory, spill_folder=options.folder
+        )
+        try:
+            return buffer_to_payload(buffers[0], new_name, options) if buffers else None
+        finally:
+            for buffer in buffers:
+                buffer.close()
+
+    downloaded_paths = download_pic_from_url(url=url, folder=options.folder)
+    if not downloaded_paths:
+        return None
+    return rename_downloaded_file(downloaded_paths[0], new_name)
+
+
+def download_payload(
+    subm, options: DownloadOptions, pool: Optional[GalleryDLPool] = None
+) -> Tuple[Any, Union[Path, bytes, None]]:
+    """Download stage of the scrape pipeline, returns the picture as a path or bytes,
+    None if it couldn't be downloaded. With a pool the download runs in one of its workers,
+    within the limits of the url's host.
+    """
+    args = (str(subm.url), get_filename_from_subm(subm), options)
+    try:
+        if pool is None:
+            return subm, fetch_payload(*args)
+        return subm, pool.run(fetch_payload, *args, url=str(subm.url))
+    except Exception as ex:
+        print(f"Aborting download of {subm.url}: {ex!r}")
+        return subm, None
+
+
+def check_payload(
+    payload: Union[Path, bytes, None],
+    phash_mode: str = "exact",
+    blob_cache: Optional[BlobCache] = None,
+    url: Optional[str] = None,
+) -> Tuple[bool, Optional[str], Optional[ImageFeatures]]:
+    """Hash stage of the scrape pipeline, downloaded files are deleted once they are checked"""
+    if payload is None:
+        return True, None, None
+
+    if isinstance(payload, bytes):
+        return check_validity_and_features(
+            io.BytesIO(payload), phash_mode, blob_cache, url
+        )
+
+    try:
+        return check_validity_and_features(payload, phash_mode, blob_cache, url)
+    finally:
+        payload.unlink(missing_ok=True)
+
+
+def scrape_submissions_pipeline(
+    connection,
+    subreddit_name: str,
+    submissions: Iterable,
+    options: DownloadOptions,
+    hash_workers: int = 2,
+    batch_size: int = 50,
+    phash_index: Optional[PhashIndex] = None,
+) -> ScrapeSummary:
+    """Same as scrape_submissions, but as a streaming pipeline:
+    listing -> download threads -> hash processes -> batched db writer.
+    Rows are written while the listing is still being downloaded,
+    so a crash only loses the posts that are still in flight.
+    Crossposts in the stream wait for the first check of their url.
+    """
+    summary = ScrapeSummary(sub_name=subreddit_name)
+    summary_lock = threading.Lock()
+    url_checks = UrlChecks()
+
+    def write(batch: List[CheckedSubmission]) -> None:
+        filtered_submissions, features_by_post = split_features(batch)
+        inserted = add_filtered_submissions_to_db(
+            connection,
+            filtered_submissions,
+            subreddit_name,
+            phash_index=phash_index,
+            features=features_by_post,
+        )
+        with summary_lock:
+            summary.new += len(batch)
+            summary.failed += sum(
+                1 for _, _, phash in filtered_submissions if phash is None
+            )
+            summary.inserted += inserted
+
+    with GalleryDLPool(
+        options.workers, options.timeout, options.folder
+    ) as download_pool, multiprocessing.Pool(
+        processes=max(hash_workers, 1)
+    ) as hash_pool:
+
+        def download(item) -> Tuple[Any, Any, Optional[Future]]:
+            subm, known_result = item
+            if known_result is None:
+                check, is_first = url_checks.claim(str(subm.url))
+                if is_first:
+                    try:
+                        return (*download_payload(subm, options, download_pool), check)
+                    except BaseException as ex:
+                        check.set_exception(ex)
+                        raise
+                # crosspost, the first one already left this stage so waiting can't block it
+                is_wrong_format, phash, _ = check.result()
+                known_result = (is_wrong_format, phash)
+
+            with summary_lock:
+                summary.reused += 1
+            return subm, known_result, None
+
+        def hash_payload(item) -> CheckedSubmission:
+            subm, payload, check = item
+            if check is None:  # known (is_wrong_format, phash) of the url
+                return (subm, *payload, None)
+            try:
+                result = hash_pool.apply(
+                    check_payload,
+                    (payload, options.phash_mode, options.blob_cache, str(subm.url)),
+                )
+            except BaseException as ex:
+                check.set_exception(ex)
+                raise
+            check.set_result(result)
+            return (subm, *result)
+
+        pipeline = (
+            Pipeline(queue_size=max(options.workers, hash_workers) * 2)
+            .add_stage("download", download, workers=options.workers)
+            .add_stage("hash", hash_payload, workers=hash_workers)
+            .add_batch_stage("db", write, batch_size=batch_size)
+        )
+
+        with connection.cursor() as cur:
+            counters = pipeline.run(
+                attach_known_url_results(
+                    cur, filter_new_submissions(cur, subreddit_name, submissions)
+                )
+            )
+
+    for counter in counters:
+        print(f"  {subreddit_name} {counter}")
+    return summary.finish()
+
+
+@dataclass
+class AsyncScrapeContext:
+    """Clients and executors shared by the subreddits of async_scrape.
+    praw and the psycopg2 connection are not thread safe, so they get one thread each.
+    """
+
+    reddit: praw.Reddit
+    connection: Any
+    options: DownloadOptions
+    download_pool: GalleryDLPool
+    download_executor: ThreadPoolExecutor
+    hash_executor: ProcessPoolExecutor
+    reddit_executor: ThreadPoolExecutor
+    db_executor: ThreadPoolExecutor
+    download_slots: asyncio.Semaphore
+    batch_size: int = 50
+    phash_index: Optional[PhashIndex] = None
+    # url -> running or finished check, shared by all subreddits
+    url_checks: Dict[str, asyncio.Future] = field(default_factory=dict)
+
+
+def lookup_page(
+    connection, subreddit_name: str, page: list
+) -> Tuple[list, Dict[str, Tuple[bool, Optional[str]]]]:
+    """New submissions of a listing page and the known results of their urls"""
+    with connection.cursor() as cur:
+        new_submissions = list(filter_new_submissions(cur, subreddit_name, page))
+        known = get_known_url_results(
+            cur, list({str(subm.url) for subm in new_submissions})
+        )
+    return new_submissions, known
+
+
+def read_watermark(connection, subreddit_name: str) -> Optional[int]:
+    with connection.cursor() as cur:
+        return get_watermark(cur, subreddit_name)
+
+
+async def download_and_hash_async(
+    ctx: AsyncScrapeContext, subm
+) -> Tuple[bool, Optional[str], Optional[ImageFeatures]]:
+    """Download in a worker process, hash in another process. Hashing happens while
+    the download slot is still held, so at most {workers} pictures are in memory at once.
+    """
+    loop = asyncio.get_running_loop()
+    async with ctx.download_slots:
+        # the thread waits on the pool, which kills downloads that run past the timeout
+        _, payload = await loop.run_in_executor(
+            ctx.download_executor,
+            download_payload,
+            subm,
+            ctx.options,
+            ctx.download_pool,
+        )
+
+        return await loop.run_in_executor(
+            ctx.hash_executor,
+            check_payload,
+            payload,
+            ctx.options.phash_mode,
+            ctx.options.blob_cache,
+            str(subm.url),
+        )
+
+
+def check_url_async(ctx: AsyncScrapeContext, subm) -> asyncio.Future:
+    """Every url is downloaded once per run, crossposts wait for the first download"""
+    url = str(subm.url)
+    if url not in ctx.url_checks:
+        ctx.url_checks[url] = asyncio.ensure_future(download_and_hash_async(ctx, subm))
+    return ctx.url_checks[url]
+
+
+async def scrape_subreddit_async(
+    ctx: AsyncScrapeContext, spec: SubredditSpec, watermark_run: int = 25
+) -> ScrapeSummary:
+    """Listing pages, downloads and db writes of one subreddit overlap:
+    the next page is fetched while the current one downloads,
+    and full batches are written while the rest is still downloading.
+    """
+    loop = asyncio.get_running_loop()
+    summary = ScrapeSummary(sub_name=spec.name)
+
+    def in_reddit_thread(func, *args):
+        return loop.run_in_executor(ctx.reddit_executor, func, *args)
+
+    def in_db_thread(func, *args, **kwargs):
+        return loop.run_in_executor(
+            ctx.db_executor, functools.partial(func, *args, **kwargs)
+        )
+
+    watermark = await in_db_thread(read_watermark, ctx.connection, spec.name)
+    listing = await in_reddit_thread(
+        lambda: iter(
+            get_listing(
+                ctx.reddit,
+                spec.name,
+                spec.mode,
+                spec.amount,
+                watermark=watermark,
+                watermark_run=watermark_run,
+            )
+        )
+    )
+
+    def next_page() -> list:
+        # praw fetches 100 posts per request
+        return list(islice(listing, 100))
+
+    batch: List[CheckedSubmission] = []
+
+    async def flush() -> None:
+        nonlocal batch
+        rows, batch = batch, []
+        if rows:
+            filtered_submissions, features_by_post = split_features(rows)
+            # flushes overlap, so don't read summary.inserted before the await
+            inserted = await in_db_thread(
+                add_filtered_submissions_to_db,
+                ctx.connection,
+                filtered_submissions,
+                spec.name,
+                truncate_titles=True,
+                phash_index=ctx.phash_index,
+                features=features_by_post,
+            )
+            summary.inserted += inserted
+
+    async def add(row: CheckedSubmission) -> None:
+        batch.append(row)
+        if len(batch) >= ctx.batch_size:
+            await flush()
+
+    async def check(subm) -> None:
+        is_wrong_format, phash, features = await check_url_async(ctx, subm)
+        if phash is None:
+            summary.failed += 1
+        await add((subm, is_wrong_format, phash, features))
+
+    tasks = []
+    page_request = in_reddit_thread(next_page)
+    while True:
+        page = await page_request
+        if not page:
+            break
+        page_request = in_reddit_thread(next_page)
+
+        new_submissions, known = await in_db_thread(
+            lookup_page, ctx.connection, spec.name, page
+        )
+        summary.new += len(new_submissions)
+        for subm in new_submissions:
+            if str(subm.url) in known:
+                summary.reused += 1
+                await add((subm, *known[str(subm.url)], None))
+            else:
+                tasks.append(asyncio.ensure_future(check(subm)))
+
+    await asyncio.gather(*tasks)
+    await flush()
+    return summary.finish()
+
+
+async def scrape_subreddits_async(
+    specs: List[SubredditSpec],
+    options: DownloadOptions,
+    hash_workers: int = 2,
+    watermark_run: int = 25,
+    batch_size: int = 50,
+    near_duplicate_radius: int = 0,
+) -> List[Union[ScrapeSummary, BaseException]]:
+    """Scrape all subreddits, returns a summary or the exception for every spec"""
+    connection, cursor = connect_to_postgres()
+    phash_index = load_phash_index(cursor, near_duplicate_radius)
+
+    with GalleryDLPool(
+        options.workers, options.timeout, options.folder
+    ) as download_pool, ThreadPoolExecutor(
+        max_workers=max(options.workers, 1)
+    ) as download_executor, ProcessPoolExecutor(
+        max_workers=max(hash_workers, 1)
+    ) as hash_executor, ThreadPoolExecutor(
+        max_workers=1
+    ) as reddit_executor, ThreadPoolExecutor(
+        max_workers=1
+    ) as db_executor:
+        ctx = AsyncScrapeContext(
+            reddit=get_reddit_client(),
+            connection=connection,
+            options=options,
+            download_pool=download_pool,
+            download_executor=download_executor,
+            hash_executor=hash_executor,
+            reddit_executor=reddit_executor,
+            db_executor=db_executor,
+            download_slots=asyncio.Semaphore(max(options.workers, 1)),
+            batch_size=batch_size,
+            phash_index=phash_index,
+        )
+        results = await asyncio.gather(
+            *(scrape_subreddit_async(ctx, spec, watermark_run) for spec in specs),
+            return_exceptions=True,
+        )
+
+    for spec, result in zip(specs, results):
+        if isinstance(result, Exception):
+            print(f"{spec.name}: scrape failed: {result!r}")
+        else:
+            print(result)
+
+    close_postgres_connection(connection, cursor)
+    return results
+
+
 class Scraper:
     download_folder = "scrape_download"
     if not os.path.exists(download_folder):
         os.makedirs(download_folder)
 
     def praw_scrape(
-        self, subreddit_name: str, PRAW_MODE=PostSearchType.NEW, amount: int = 100
+        self,
+        subreddit_name: str,
+        PRAW_MODE=PostSearchType.NEW,
+        amount: int = 100,
+        workers: int = 1,
+        pipeline: bool = False,
+        hash_workers: int = 2,
+        watermark_run: int = 25,
+        near_duplicate_radius: int = 0,
+        **download_flags,
     ):
-        start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        """
+        Args:
+            workers (int, optional): Parallel download processes. Defaults to 1.
+            pipeline (bool, optional): Stream posts through download/hash/db stages,
+                inserting them while the listing is still processed. Defaults to False.
+            hash_workers (int, optional): Hashing processes of the pipeline. Defaults to 2.
+            watermark_run (int, optional): In NEW mode stop after this many posts in a row
+                are older than the newest post in db, 0 walks the whole listing. Defaults to 25.
+            near_duplicate_radius (int, optional): New pictures whose phash differs from a known one
+                in at most this many bits are flagged in near_duplicate and not downloaded,
+                4 works well, 0 turns it off. Defaults to 0.
+            download_flags: --download_timeout, --in_memory, --max_memory_mb, --preflight
+                and --phash_mode, see make_download_options
+        """
         conn, cur = connect_to_postgres()
-        r = praw.Reddit(
-            client_id=os.environ.get("REDDIT_CLIENT_ID"),
-            client_secret=os.environ.get("REDDIT_CLIENT_SECRET"),
-            user_agent=os.environ.get("REDDIT_USER_AGENT"),
-            username=os.environ.get("REDDIT_USERNAME"),
-            password=os.environ.get("REDDIT_PASSWORD"),
-        )
+        r = get_reddit_client()
+        phash_index = load_phash_index(cur, near_duplicate_radius)
 
         # delete files in downloads folder
         clear_folder(self.download_folder)
 
-        iter = r.subreddit(subreddit_name).new(limit=amount)
+        iter = get_listing(
+            r,
+            subreddit_name,
+            PRAW_MODE,
+            amount,
+            watermark=get_watermark(cur, subreddit_name),
+            watermark_run=watermark_run,
+        )
+        options = make_download_options(self.download_folder, workers, **download_flags)
+
+        if pipeline:
+            summary = scrape_submissions_pipeline(
+                conn,
+                subreddit_name,
+                iter,
+                options,
+                hash_workers=hash_workers,
+                phash_index=phash_index,
+            )
+        else:
+            summary = scrape_submissions(
+                conn, subreddit_name, iter, options, phash_index=phash_index
+            )
 
-        if PRAW_MODE == PostSearchType.HOT:
-            iter = r.subreddit(subreddit_name).hot(limit=amount)
-        elif PRAW_MODE == PostSearchType.TOP:
-            iter = r.subreddit(subreddit_name).top(limit=amount)
+        clear_folder(self.download_folder)
 
-        filtered_submissions: List[Tuple[Any, bool, Optional[str]]] = []
+        print(summary)
+        close_postgres_connection(conn, cur)
 
-        with cur:
-            for subm in iter:
-                # check if post id is already in database
-                if does_post_id_exist(cur, subreddit_name, subm.id):
-                    # print(f"Subm id already exists: {subm.id}")
-                    continue
+    def scrape_all(
+        self,
+        subreddits,
+        workers: int = 8,
+        watermark_run: int = 25,
+        near_duplicate_radius: int = 0,
+        **download_flags,
+    ):
+        """Scrape several subreddits at once in a single process.
+        They share one reddit client, one db connection pool and one download pool,
+        so {workers} is the download budget for all of them together.
 
-                if "minus.com" in subm.url:
-                    filtered_submissions.append((subm, True, None))
-                    continue
+        Args:
+            subreddits: "patchuu:new:1000,awwnime:hot:100" or a list of such entries,
+                mode defaults to new and amount to 1000.
+            workers (int, optional): Parallel download processes. Defaults to 8.
+            watermark_run (int, optional): see praw_scrape. Defaults to 25.
+            near_duplicate_radius (int, optional): see praw_scrape. Defaults to 0.
+            download_flags: see make_download_options
+        """
+        specs = parse_subreddit_specs(subreddits)
+        if not specs:
+            print("No subreddits to scrape")
+            return
 
-                signal.signal(signal.SIGALRM, timeout_handler)
-                signal.alarm(60)
-                try:
-                    did_load = download_pic_from_url(
-                        url=subm.url, folder=self.download_folder
-                    )
-                except Exception as ex:
-                    did_load = False
-                    print(f"Aborting download of {subm.url}")
-                finally:
-                    signal.alarm(0)  # Disable the alarm
-
-                if did_load:
-                    new_name = get_filename_from_subm(subm)
-                    new_path = rename_latest_file_in_folder(
-                        self.download_folder, new_name
+        options = make_download_options(self.download_folder, workers, **download_flags)
+        reddit = get_reddit_client()
+        # praw is not thread safe, listings are fetched one at a time
+        reddit_lock = threading.Lock()
+        db_pool = create_postgres_pool(maxconn=len(specs))
+
+        conn = db_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                phash_index = load_phash_index(cur, near_duplicate_radius)
+        finally:
+            db_pool.putconn(conn)
+
+        # crossposts in several of the subreddits are downloaded once
+        url_checks = UrlChecks()
+
+        def scrape_one(spec: SubredditSpec) -> ScrapeSummary:
+            conn = db_pool.getconn()
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    watermark = get_watermark(cur, spec.name)
+                with reddit_lock:
+                    listing = list(
+                        get_listing(
+                            reddit,
+                            spec.name,
+                            spec.mode,
+                            spec.amount,
+                            watermark=watermark,
+                            watermark_run=watermark_run,
+                        )
                     )
-                    is_wrong_format, phash = check_validity_and_phash(new_path)
-                    filtered_submissions.append((subm, is_wrong_format, phash))
-                else:
-                    filtered_submissions.append((subm, True, None))
 
+                return scrape_submissions(
+                    conn, spec.name, listing, options, pool, phash_index, url_checks
+                )
+            finally:
+                db_pool.putconn(conn)
+
+        # delete files in downloads folder
         clear_folder(self.download_folder)
 
-        # add them to database
-        inserted = add_filtered_submissions_to_db(
-            conn, filtered_submissions, subreddit_name
-        )
+        try:
+            with GalleryDLPool(workers, options.timeout, self.download_folder) as pool:
+                with ThreadPoolExecutor(max_workers=len(specs)) as executor:
+                    futures = [executor.submit(scrape_one, spec) for spec in specs]
+                    for spec, future in zip(specs, futures):
+                        try:
+                            print(future.result())
+                        except Exception as ex:
+                            print(f"{spec.name}: scrape failed: {ex!r}")
+        finally:
+            db_pool.closeall()
+            clear_folder(self.download_folder)
+
+    def async_scrape(
+        self,
+        subreddits,
+        workers: int = 16,
+        hash_workers: int = 2,
+        watermark_run: int = 25,
+        near_duplicate_radius: int = 0,
+        batch_size: int = 50,
+        **download_flags,
+    ):
+        """Scrape several subreddits on one event loop. Listing pages, downloads,
+        hashing and db writes of all subreddits overlap, so the run is limited by
+        bandwidth and reddit's rate limit instead of waiting on each step in turn.
 
-        end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        Args:
+            subreddits: same as scrape_all
+            workers (int, optional): Parallel downloads for all subreddits. Defaults to 16.
+            hash_workers (int, optional): Hashing processes. Defaults to 2.
+            batch_size (int, optional): Rows per db write. Defaults to 50.
+            other args: see praw_scrape
+        """
+        specs = parse_subreddit_specs(subreddits)
+        if not specs:
+            print("No subreddits to scrape")
+            return
 
-        print(
-            f"[{start_time}] {subreddit_name}: inserted {inserted} posts [{end_time}]"
-        )
-        close_postgres_connection(conn, cur)
+        options = make_download_options(self.download_folder, workers, **download_flags)
 
-    def psaw_scrape(self, subreddit_name: str, amount: int = 100):
-        """
-        0) Get latest created_utc from db or use the one provided by const
-        1) Download pics
-        2) Check if they can be opened with PIL and have sane dimensions etc
-        3) Add them to database
-        4) If inserted amount is 0 - exit, otherwise re:start.
+        # delete files in downloads folder
+        clear_folder(self.download_folder)
+        try:
+            asyncio.run(
+                scrape_subreddits_async(
+                    specs,
+                    options,
+                    hash_workers=hash_workers,
+                    watermark_run=watermark_run,
+                    batch_size=batch_size,
+                    near_duplicate_radius=near_duplicate_radius,
+                )
+            )
+        finally:
+            clear_folder(self.download_folder)
+
+    def scrape_due(
+        self,
+        subreddits,
+        workers: int = 16,
+        hash_workers: int = 2,
+        watermark_run: int = 25,
+        near_duplicate_radius: int = 0,
+        posts_per_poll: int = 100,
+        dry_run: bool = False,
+        **download_flags,
+    ):
+        """Scrape only the subreddits whose next poll time has come, meant to run every hour.
+        After a scrape the post rate of the subreddit is measured from db, and the next
+        poll time and fetch size are saved in subreddit_schedule:
+        busy subreddits are polled often with small fetches, quiet ones rarely.
 
         Args:
-            amount (int, optional): Pushshift query amount. Defaults to 100.
+            subreddits: same as scrape_all, amount is the fetch size of the first poll
+            posts_per_poll (int, optional): Aim for this many new posts per poll. Defaults to 100.
+            dry_run (bool, optional): Only print the due subreddits. Defaults to False.
+            other args: see async_scrape
         """
-        start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        specs = parse_subreddit_specs(subreddits)
+        policy = PollPolicy(posts_per_poll=posts_per_poll)
 
         conn, cur = connect_to_postgres()
+        due = get_due_subreddits(cur, [spec.name for spec in specs])
+        due_specs = [
+            SubredditSpec(spec.name, spec.mode, due[spec.name] or spec.amount)
+            for spec in specs
+            if spec.name in due
+        ]
+        for spec in due_specs:
+            print(f"{spec.name} is due, fetching {spec.amount} posts")
+        if not due_specs or dry_run:
+            close_postgres_connection(conn, cur)
+            return
 
-        # delete files in downloads folder
-        clear_folder(self.download_folder)
+        options = make_download_options(self.download_folder, workers, **download_flags)
 
-        # get latest date from db and start downloading after it
-        since_date = get_latest_created_utc_time_from_db(subreddit_name)
-        # print(f"Starting download from: {since_date}")
+        clear_folder(self.download_folder)
+        try:
+            results = asyncio.run(
+                scrape_subreddits_async(
+                    due_specs,
+                    options,
+                    hash_workers=hash_workers,
+                    watermark_run=watermark_run,
+                    near_duplicate_radius=near_duplicate_radius,
+                )
+            )
+        finally:
+            clear_folder(self.download_folder)
+
+        # failed subreddits stay due and are retried on the next run
+        scraped = [
+            spec.name
+            for spec, result in zip(due_specs, results)
+            if not isinstance(result, BaseException)
+        ]
+        if scraped:
+            rates = get_post_rates(cur, scraped, policy.history_days)
+            for sub_name in scraped:
+                plan = plan_poll(sub_name, rates[sub_name], policy)
+                save_poll_plan(cur, plan)
+                print(
+                    f"{sub_name}: {plan.posts_per_hour:.1f} posts/hour, next poll in "
+                    f"{plan.interval / 3600:.1f} hours for {plan.amount} posts"
+                )
 
-        submissions = get_submissions(subreddit_name, since_date, amount)
+        close_postgres_connection(conn, cur)
 
-        # try to download pics
-        filtered_submissions: List[Tuple[Any, bool, Optional[str]]] = []
-        with cur:
-            for subm in submissions:
-                if does_post_id_exist(cur, subreddit_name, subm.id):
-                    continue
-                if "minus.com" in subm.url:
-                    filtered_submissions.append((subm, True, None))
-                    continue
+    def psaw_scrape(
+        self,
+        subreddit_name: str,
+        amount: int = 100,
+        workers: int = 1,
+        max_seconds: Optional[int] = None,
+        max_rows: Optional[int] = None,
+        near_duplicate_radius: int = 0,
+        **download_flags,
+    ):
+        """Backfill subreddit history from pushshift, oldest posts first.
+        0) Start from the saved scrape cursor, or latest created_utc from db
+        1) Stream submissions and take them {amount} at a time
+        2) Download pics, check if they can be opened with PIL and have sane dimensions etc
+        3) Add them to database and save the cursor, so a crash resumes from the last batch
+        4) Stop when pushshift runs out of posts or a budget is used up.
 
-                did_load = download_pic_from_url(
-                    url=subm.url, folder=self.download_folder
-                )
-                if did_load:
-                    new_name = get_filename_from_subm(subm)
-                    new_path = rename_latest_file_in_folder(
-                        self.download_folder, new_name
-                    )
-                    is_wrong_format, phash = check_validity_and_phash(new_path)
-                    filtered_submissions.append((subm, is_wrong_format, phash))
-                else:
-                    filtered_submissions.append((subm, True, None))
+        Args:
+            amount (int, optional): Submissions per batch/checkpoint. Defaults to 100.
+            workers (int, optional): Parallel download processes. Defaults to 1.
+            max_seconds (Optional[int], optional): Stop after this many seconds. Defaults to None.
+            max_rows (Optional[int], optional): Stop after this many submissions. Defaults to None.
+            near_duplicate_radius (int, optional): see praw_scrape. Defaults to 0.
+            download_flags: see make_download_options
+        """
+        started = time.monotonic()
+        conn, cur = connect_to_postgres()
+        options = make_download_options(self.download_folder, workers, **download_flags)
 
+        # delete files in downloads folder
         clear_folder(self.download_folder)
 
-        # add them to database
-        inserted = add_filtered_submissions_to_db(
-            conn, filtered_submissions, subreddit_name
-        )
+        phash_index = load_phash_index(cur, near_duplicate_radius)
 
-        close_postgres_connection(conn, cur)
+        since_date = get_scrape_cursor(cur, subreddit_name)
+        if since_date is None:
+            # get latest date from db and start downloading after it
+            since_date = int(get_latest_created_utc_time_from_db(subreddit_name))
+        else:
+            # posts with the same created_utc as the checkpoint may be split between batches,
+            # the ones that were already inserted are dropped by post id
+            since_date -= 1
+        # print(f"Starting download from: {since_date}")
 
-        end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(
-            f"[{start_time}] {subreddit_name}: inserted {inserted} posts [{end_time}]"
-        )
+        submissions = get_submissions(subreddit_name, since_date)
 
-        if inserted == 0:
-            return
-        else:
-            self.psaw_scrape(subreddit_name)
+        processed = 0
+        with GalleryDLPool(workers, options.timeout, self.download_folder) as pool:
+            while True:
+                batch = list(islice(submissions, amount))
+                if not batch:
+                    break
 
+                # try to download pics and add them to database
+                summary = scrape_submissions(
+                    conn, subreddit_name, batch, options, pool, phash_index
+                )
+                save_scrape_cursor(
+                    cur, subreddit_name, max(int(subm.created_utc) for subm in batch)
+                )
+                clear_folder(self.download_folder)
+                print(summary)
+
+                processed += len(batch)
+                if max_rows is not None and processed >= max_rows:
+                    print(f"{subreddit_name}: row budget of {max_rows} used up")
+                    break
+                if (
+                    max_seconds is not None
+                    and time.monotonic() - started >= max_seconds
+                ):
+                    print(f"{subreddit_name}: time budget of {max_seconds}s used up")
+                    break
 
-def get_submissions(sub, sdate, amount):
+        close_postgres_connection(conn, cur)
+
+
+def get_submissions(sub, sdate, amount=None) -> Iterator:
+    """Lazily stream submissions, pushshift is queried page by page while iterating"""
     api = PushshiftAPI()
     gen = api.search_submissions(
         sort="asc",
@@ -310,7 +1452,26 @@ def get_submissions(sub, sdate, amount):
         filter=["title", "url", "author", "id", "created_utc"],
         limit=amount,
     )
-    return list(gen)
+    return gen
+
+
+def get_scrape_cursor(cursor, sub_name: str) -> Optional[int]:
+    """created_utc of the newest post a backfill of {sub_name} got to"""
+    query = """SELECT created_utc FROM scrape_cursor WHERE sub_name=%s"""
+
+    cursor.execute(query, (sub_name,))
+    data = cursor.fetchone()
+    if data:
+        return int(data[0])
+    return None
+
+
+def save_scrape_cursor(cursor, sub_name: str, created_utc: int) -> None:
+    query = """INSERT INTO scrape_cursor (sub_name, created_utc, updated_at) VALUES (%s, %s, now())
+            ON CONFLICT (sub_name) DO UPDATE
+            SET created_utc = GREATEST(scrape_cursor.created_utc, EXCLUDED.created_utc), updated_at = now()"""
+
+    cursor.execute(query, (sub_name, created_utc))
 
 
 @postgres_access
@@ -328,35 +1489,100 @@ def get_latest_created_utc_time_from_db(_, cursor, subreddit_name):
     return since_date
 
 
-def add_filtered_submissions_to_db(
-    connection, filtered_submissions: list, subreddit_name: str
-):
-    inserted = 0
+def prepare_pic_records(
+    filtered_submissions: list,
+    subreddit_name: str,
+    max_lengths: Dict[str, int],
+    truncate_titles: bool = True,
+) -> Tuple[List[tuple], List[Tuple[Any, str]]]:
+    """Turn (subm, wrong_format, phash) tuples into db rows.
+    Values that don't fit into their varchar column would fail the whole statement,
+    so too long titles get truncated and other too long rows are rejected.
+
+    Returns:
+        Tuple[List[tuple], List[Tuple[Any, str]]]: rows, (submission, reason) of rejected rows
+    """
+    rows = []
+    rejected = []
     for subm, wrong_format, img_hash in filtered_submissions:
-        with connection:
-            with connection.cursor() as cur:
-                try:
-                    insert_pic_record(
-                        cursor=cur,
-                        sub_name=subreddit_name,
-                        post_id=str(subm.id),
-                        author=str(subm.author),
-                        title=str(subm.title),
-                        url=str(subm.url),
-                        created_utc=str(int(subm.created_utc)),
-                        phash=img_hash,
-                        wrong_format=wrong_format,
-                    )
+        record = {
+            "sub_name": subreddit_name,
+            "post_id": str(subm.id),
+            "author": str(subm.author),
+            "title": str(subm.title),
+            "url": str(subm.url),
+            "created_utc": str(int(subm.created_utc)),
+            "phash": img_hash,
+            "wrong_format": wrong_format,
+        }
+
+        if truncate_titles and "title" in max_lengths:
+            record["title"] = record["title"][: max_lengths["title"]]
+
+        too_long = [
+            column
+            for column, max_length in max_lengths.items()
+            if isinstance(record.get(column), str) and len(record[column]) > max_length
+        ]
+        if too_long:
+            rejected.append((subm, f"too long: {', '.join(too_long)}"))
+            continue
+
+        rows.append(tuple(record[column] for column in REDDIT_POST_COLUMNS))
+
+    return rows, rejected
 
-                    inserted += 1
-                except psql_err.UniqueViolation:
-                    connection.rollback()
-                    continue
-                except psql_err.StringDataRightTruncation:
-                    connection.rollback()
-                    continue
 
-    return inserted
+def add_filtered_submissions_to_db(
+    connection,
+    filtered_submissions: list,
+    subreddit_name: str,
+    truncate_titles: bool = True,
+    phash_index: Optional[PhashIndex] = None,
+    features: Optional[Dict[str, ImageFeatures]] = None,
+) -> int:
+    """Write the whole filtered batch with a few multi-row statements.
+    With a phash_index near duplicates of known pictures are flagged.
+    Picture features (by post id) of the inserted posts are saved too.
+
+    Returns:
+        int: amount of inserted rows
+    """
+    near_duplicates: List[tuple] = []
+    if phash_index is not None:
+        near_duplicates = flag_near_duplicates(filtered_submissions, phash_index)
+
+    with connection:
+        with connection.cursor() as cur:
+            max_lengths = get_column_max_lengths(cur)
+            rows, rejected = prepare_pic_records(
+                filtered_submissions, subreddit_name, max_lengths, truncate_titles
+            )
+            for subm, reason in rejected:
+                print(f"Rejected {subm.id}: {reason}")
+
+            if not rows:
+                return 0
+
+            inserted_ids = insert_pic_records(cur, rows)
+            inserted = set(inserted_ids)
+            if near_duplicates and has_table(cur, "near_duplicate"):
+                insert_near_duplicates(
+                    cur,
+                    subreddit_name,
+                    [dup for dup in near_duplicates if dup[0].id in inserted],
+                )
+            if features and has_table(cur, "image_features"):
+                save_features(
+                    cur,
+                    [
+                        (subreddit_name, post_id, post_features)
+                        for post_id, post_features in features.items()
+                        if post_id in inserted
+                    ],
+                )
+
+    return len(inserted_ids)
 
 
 def clear_folder(folder_path):
@@ -375,28 +1601,62 @@ def clear_folder(folder_path):
             print("Failed to delete %s. Reason: %s" % (file_path, e))
 
 
-def check_validity_and_phash(file_path: Path) -> Tuple[bool, Optional[str]]:
+def check_validity_and_features(
+    file_path: Union[Path, BinaryIO],
+    phash_mode: str = "exact",
+    blob_cache: Optional[BlobCache] = None,
+    url: Optional[str] = None,
+) -> Tuple[bool, Optional[str], Optional[ImageFeatures]]:
     """Go through reddit submission objects and check if the image is actually loaded.
     Then check if it open with PIL.Image() and has correct dimensions etc
-    If everything is ok, return is_wrong_format=False and phash value of image.
+    If everything is ok, return is_wrong_format=False, phash value and features of image.
+    Accepts a path or an already downloaded file object.
+    Dimensions are read from the header, pictures that are too big are not decoded at all,
+    the others are decoded once for all features.
+
+    Args:
+        phash_mode (str): "exact", "draft" or "verify", see src/img_helper.py
+        blob_cache (Optional[BlobCache]): valid pictures are stored there under {url},
+            from the same decode. Not in draft mode, the decode is reduced then.
 
     Returns:
-        [type]: is_wrong_format, phash
+        [type]: is_wrong_format, phash, features
     """
     warnings.simplefilter("error", Image.DecompressionBombWarning)
 
     try:  # if it DID load the picture, try to open it with PIL
+        file_size = get_file_size(file_path)
         with Image.open(file_path) as im:
             width, height = im.size
-            img_phash = str(imagehash.phash(im))
+            if width + height >= MAX_DIMENSIONS_SUM:
+                return True, None, None
+            features = compute_features(im, file_size, draft=phash_mode == "draft")
+            is_valid = MIN_DIMENSIONS_SUM < width + height
+            if blob_cache is not None and url and is_valid and phash_mode != "draft":
+                try:
+                    blob_cache.put_image(url, im)
+                except OSError as ex:  # the cache is optional, the check still counts
+                    print(f"Couldnt cache {url}: {ex}")
+
+        if phash_mode == "verify":
+            if hasattr(file_path, "seek"):
+                file_path.seek(0)
+            with Image.open(file_path) as im:
+                draft_phash = compute_features(im, file_size, draft=True).phash
+            distance = hamming_distance(features.phash, draft_phash)
+            if distance:
+                print(
+                    f"Draft phash {draft_phash} is {distance} bits from {features.phash}"
+                )
+
         # check image dimensions
-        if not 500 < width + height < 14000:
-            return True, img_phash
+        if not is_valid:
+            return True, features.phash, None
 
     except Exception:
-        return True, None
+        return True, None, None
 
-    return False, img_phash
+    return False, features.phash, features
 
 
 if __name__ == "__main__":
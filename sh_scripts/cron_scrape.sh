@@ -7,11 +7,7 @@
 
 source /home/ubuntu/kotanima_project/kotanima_content/.venv/bin/activate
 cd /home/ubuntu/kotanima_project/kotanima_content
-python scrape_reddit.py praw_scrape --subreddit_name="patchuu" --amount=1000 --PRAW_MODE=PostSearchType.NEW
-python scrape_reddit.py praw_scrape --subreddit_name="awenime" --amount=1000 --PRAW_MODE=PostSearchType.NEW
-python scrape_reddit.py praw_scrape --subreddit_name="moescape" --amount=1000 --PRAW_MODE=PostSearchType.NEW
-python scrape_reddit.py praw_scrape --subreddit_name="fantasymoe" --amount=1000 --PRAW_MODE=PostSearchType.NEW
-python scrape_reddit.py praw_scrape --subreddit_name="awwnime" --amount=1000 --PRAW_MODE=PostSearchType.NEW
-python scrape_reddit.py praw_scrape --subreddit_name="artistic_ecchi" --amount=1000 --PRAW_MODE=PostSearchType.NEW
-#python scrape_reddit.py praw_scrape --subreddit_name="ecchi" --amount=1000 --PRAW_MODE=PostSearchType.NEW
+# subreddits are scraped by cron_scrape_due.sh, this scrapes all of them at once
+#python scrape_reddit.py async_scrape --subreddits="patchuu:new:1000,awenime:new:1000,moescape:new:1000,fantasymoe:new:1000,awwnime:new:1000,artistic_ecchi:new:1000" --workers=16
+#python scrape_reddit.py praw_scrape --subreddit_name="ecchi" --amount=1000 --PRAW_MODE=PostSearchType.NEW --workers=8
 python yandex_backup.py
@@ -0,0 +1,10 @@
+#!/bin/bash
+
+# setup for cron job, every hour:
+# crontab -e
+# 30 * * * * bash /home/kotanima_project/kotanima_content/cron_scrape_due.sh >> /home/ubuntu/kotanima_scraper/scrape_log.txt 2>&1
+
+
+source /home/ubuntu/kotanima_project/kotanima_content/.venv/bin/activate
+cd /home/ubuntu/kotanima_project/kotanima_content
+python scrape_reddit.py scrape_due --subreddits="patchuu:new:1000,awenime:new:1000,moescape:new:1000,fantasymoe:new:1000,awwnime:new:1000,artistic_ecchi:new:1000" --workers=16
@@ -0,0 +1,17 @@
+-- features the scraper computes from its single decode of a picture, see src/image_features.py
+-- rows with an older version than FEATURES_VERSION are ignored
+CREATE TABLE IF NOT EXISTS image_features (
+    sub_name TEXT NOT NULL,
+    post_id TEXT NOT NULL,
+    version SMALLINT NOT NULL,
+    phash TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    file_size INTEGER NOT NULL,
+    -- RGB
+    avg_color SMALLINT[] NOT NULL,
+    -- 8x8x8 BGR color histogram, 512 little endian float32, like image_similarity.py
+    color_hist BYTEA NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    PRIMARY KEY (sub_name, post_id)
+);
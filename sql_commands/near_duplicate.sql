@@ -0,0 +1,13 @@
+-- posts whose picture is almost identical to an older one, the downloader skips them
+CREATE TABLE IF NOT EXISTS near_duplicate (
+    sub_name TEXT NOT NULL,
+    post_id TEXT NOT NULL,
+    -- phash of the post's own picture
+    phash TEXT NOT NULL,
+    -- phash of the older picture
+    duplicate_of TEXT NOT NULL,
+    -- amount of differing bits
+    distance SMALLINT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    PRIMARY KEY (sub_name, post_id)
+);
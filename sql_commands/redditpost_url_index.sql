@@ -0,0 +1,2 @@
+-- the scraper looks up already checked pictures by url (crossposts)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS my_app_redditpost_url_idx ON my_app_redditpost (url);
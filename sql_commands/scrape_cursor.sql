@@ -0,0 +1,6 @@
+-- resumable position of psaw_scrape backfills, one row per subreddit
+CREATE TABLE IF NOT EXISTS scrape_cursor (
+    sub_name TEXT PRIMARY KEY,
+    created_utc BIGINT NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
@@ -0,0 +1,35 @@
+-- size of every file in STATIC_FOLDER_PATH, see src/static_ledger.py
+-- the downloader, vk_scheduler and verify_file_integrity keep it up to date
+CREATE TABLE IF NOT EXISTS static_file (
+    -- relative to STATIC_FOLDER_PATH
+    file_name TEXT PRIMARY KEY,
+    size BIGINT NOT NULL
+);
+
+-- single row with the sum of static_file.size, so the folder size is read without a scan
+CREATE TABLE IF NOT EXISTS static_folder (
+    id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+    total_size BIGINT NOT NULL DEFAULT 0,
+    -- last full scan of the folder, NULL until the first one
+    reconciled_at TIMESTAMP WITH TIME ZONE
+);
+INSERT INTO static_folder (id) VALUES (true) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION static_folder_total() RETURNS trigger
+  LANGUAGE plpgsql AS
+$function$
+BEGIN
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    UPDATE static_folder SET total_size = total_size + NEW.size;
+  END IF;
+  IF TG_OP IN ('DELETE', 'UPDATE') THEN
+    UPDATE static_folder SET total_size = total_size - OLD.size;
+  END IF;
+  RETURN NULL;
+END;
+$function$;
+
+DROP TRIGGER IF EXISTS static_folder_total ON static_file;
+CREATE TRIGGER static_folder_total
+AFTER INSERT OR UPDATE OF size OR DELETE ON static_file
+FOR EACH ROW EXECUTE PROCEDURE static_folder_total();
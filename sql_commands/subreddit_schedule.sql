@@ -0,0 +1,9 @@
+-- adaptive polling of subreddits, see src/poll_schedule.py and scrape_reddit.py scrape_due
+CREATE TABLE IF NOT EXISTS subreddit_schedule (
+    sub_name TEXT PRIMARY KEY,
+    -- measured from created_utc of the posts in my_app_redditpost
+    posts_per_hour DOUBLE PRECISION NOT NULL,
+    fetch_amount INTEGER NOT NULL,
+    last_poll TIMESTAMP WITH TIME ZONE NOT NULL,
+    next_poll TIMESTAMP WITH TIME ZONE NOT NULL
+);
@@ -0,0 +1,121 @@
+"""
+Size bounded cache of optimized JPEG renditions of scraped pictures, keyed by url.
+The scraper fills it with the picture it already decoded for the phash,
+the downloader moves pictures from it to the static folder instead of downloading them again.
+The least recently used files are deleted once the cache grows over its size limit.
+The size is estimated from the own puts, the folder is only scanned when the estimate
+crosses the limit and every RESCAN_EVERY puts, to notice the puts of other processes.
+Safe to share between processes: files are written to a temporary name and renamed.
+"""
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image
+
+MEGABYTE = 1000000
+
+# eviction goes a bit below the limit, so it doesn't run again on the next put
+EVICT_TO = 0.9
+
+RESCAN_EVERY = 500
+
+
+def optimized_jpeg(image: Image.Image) -> bytes:
+    """Same rendition as downloader.optimize_image"""
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", optimize=True)
+    return buffer.getvalue()
+
+
+@dataclass
+class BlobCache:
+    folder: str
+    max_bytes: int = 2000 * MEGABYTE
+
+    def __post_init__(self):
+        # estimated size of the folder, None until the first put scans it.
+        # Not locked (the cache is pickled into worker processes), a wrong estimate
+        # only moves the next scan.
+        self._size: Optional[int] = None
+        self._puts = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["BlobCache"]:
+        """Cache configured by BLOB_CACHE_PATH and BLOB_CACHE_MAX_MB, None if it is not set"""
+        folder = os.getenv("BLOB_CACHE_PATH")
+        if not folder:
+            return None
+        return cls(folder, int(os.getenv("BLOB_CACHE_MAX_MB", "2000")) * MEGABYTE)
+
+    def path_for(self, url: str) -> Path:
+        return Path(self.folder, hashlib.sha1(url.encode()).hexdigest() + ".jpg")
+
+    def put(self, url: str, data: bytes) -> Path:
+        path = self.path_for(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, suffix=".tmp", delete=False
+        ) as temp_file:
+            temp_file.write(data)
+        os.replace(temp_file.name, path)
+
+        self._puts += 1
+        if self._size is None or self._puts % RESCAN_EVERY == 0:
+            self.evict()
+        else:
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self.evict()
+        return path
+
+    def put_image(self, url: str, image: Image.Image) -> Path:
+        return self.put(url, optimized_jpeg(image))
+
+    def get(self, url: str) -> Optional[Path]:
+        """Path of the cached picture, which now counts as recently used"""
+        path = self.path_for(url)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def take(self, url: str, destination: Path) -> bool:
+        """Move the cached picture to {destination}, False if it isn't cached"""
+        path = self.get(url)
+        if path is None:
+            return False
+        try:
+            shutil.move(str(path), str(destination))
+        except FileNotFoundError:  # evicted by another process in the meantime
+            return False
+        return True
+
+    def size(self) -> int:
+        return sum(path.stat().st_size for path in Path(self.folder).glob("*.jpg"))
+
+    def evict(self) -> None:
+        """Scan the folder and delete the least recently used files until the cache fits its limit"""
+        entries = []
+        for path in Path(self.folder).glob("*.jpg"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+                path.unlink(missing_ok=True)
+                total -= size
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+
+        self._size = total
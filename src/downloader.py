@@ -2,17 +2,21 @@
 Delete disliked images to free up space and
 Download and optimize new images 
 """
-import glob
 import os
 import pathlib
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
 
+import fire
 import psycopg2
 from dotenv import find_dotenv, load_dotenv
 from PIL import Image, ImageFile
 
-from gallery_dl_helper import download_pic_from_url
+from blob_cache import BlobCache
+from gallery_dl_helper import download_pic_from_url, rename_downloaded_file
+from gallery_dl_pool import GalleryDLPool
+from host_policy import HostUnavailable
 from models import RedditPost
 from postgres import (
     connect_to_db,
@@ -20,6 +24,7 @@ from postgres import (
     set_downloaded_status_by_phash,
     set_wrong_format_status_by_phash,
 )
+from static_ledger import forget_files, get_folder_size, record_file
 from verify_file_integrity import verify_downloaded_files
 
 # load configuration
@@ -38,6 +43,9 @@ STATIC_FOLDER_PATH = os.getenv("STATIC_FOLDER_PATH")
 # stop downloading files when it gets to the size limit
 FOLDER_SIZE_LIMIT = 5 * GIGABYTE
 
+# seconds before a download is killed
+DOWNLOAD_TIMEOUT = 60
+
 
 def get_reddit_post_data(cursor, limit: int):
     query = """select mar.post_id, mar.author, mar.created_utc, mar.title, mar.url, mar.phash, mar.sub_name from my_app_redditpost mar 
@@ -47,6 +55,8 @@ def get_reddit_post_data(cursor, limit: int):
             AND mar.is_downloaded=false
             AND mar.is_checked=false
             AND mar.wrong_format=false
+            AND NOT EXISTS (SELECT 1 FROM near_duplicate nd
+                            WHERE nd.sub_name=mar.sub_name AND nd.post_id=mar.post_id)
             ORDER BY created_utc DESC
             LIMIT (%s)
             """
@@ -83,49 +93,56 @@ def optimize_image(file_path: str) -> None:
             pass
 
 
-def rename_latest_file_in_folder(folder: str, new_filename: str) -> Optional[Path]:
-    """Gallery-dl loads images with random names, rename the latest downloaded one
-    to {new_filename} + {.ext}
+def get_static_folder_size(connection) -> int:
+    # read from the static_file ledger, the folder is only walked to reconcile it
+    assert isinstance(STATIC_FOLDER_PATH, str)
+    return get_folder_size(connection, STATIC_FOLDER_PATH)
 
-    Args:
-        new_filename (str): {created_utc} + '_' + {post.id}
 
-    Returns:
-        [type]: new path to renamed file
-    """
-    file_path = get_latest_filename_in_folder(folder)
-    if not file_path:
-        print("No file path found")
-        return None
-    old_ext = file_path.suffix
-    old_path = Path(file_path).resolve().parent
-    new_path = Path(old_path, new_filename + old_ext)
+def mark_downloaded(connection, reddit_post: RedditPost) -> None:
+    """Add the post's file to the static folder ledger and mark the post in db"""
     try:
-        file_path.rename(new_path)
-    except FileExistsError:
-        print("File already exists")
-    return new_path
-
-
-def get_latest_filename_in_folder(folder: str) -> Optional[Path]:
-    download_folder = str(Path(folder + "/*").absolute())
+        record_file(
+            connection,
+            STATIC_FOLDER_PATH,
+            Path(STATIC_FOLDER_PATH, reddit_post.get_image_name()),
+        )
+    except FileNotFoundError:  # reconciliation finds it if it shows up after all
+        print(f"No file for {reddit_post.url}")
+    set_downloaded_status_by_phash(connection, status=True, phash=reddit_post.phash)
+
+
+def finish_download(
+    connection, reddit_post: RedditPost, future: Future
+) -> Optional[Path]:
+    """Path of the downloaded and renamed file, None if the download failed"""
     try:
-        last_file = max(glob.glob(download_folder), key=os.path.getctime)
-    except ValueError:
-        print("Couldnt find a file")
+        downloaded_paths = future.result()
+    except HostUnavailable as ex:
+        # the post stays as it is and is tried again on the next run
+        print(f"Skipping {reddit_post.url}: {ex}")
+        return None
+    except Exception as ex:  # killed after the timeout, or crashed
+        print(f"Aborting download of {reddit_post.url}: {ex!r}")
+        downloaded_paths = []
+
+    if not downloaded_paths:
+        print("Couldnt download file, with ", f"{reddit_post.url=}")
+        set_wrong_format_status_by_phash(
+            connection, status=True, phash=reddit_post.phash
+        )
         return None
 
-    return Path(last_file)
-
-
-def get_static_folder_size() -> int:
-    # this is non recursive
-    assert isinstance(STATIC_FOLDER_PATH, str)
-    root_directory = Path(STATIC_FOLDER_PATH)
-    return sum(f.stat().st_size for f in root_directory.glob("**/*") if f.is_file())
+    return rename_downloaded_file(
+        downloaded_paths[0], f"{reddit_post.sub_name}_{reddit_post.post_id}"
+    )
 
 
-def download_images(amount: int) -> None:
+def download_images(amount: int, workers: int = 1, optimize_workers: int = 1) -> None:
+    """Download {amount} posts, rename and optimize them.
+    Downloads run in {workers} processes and optimization in {optimize_workers} others,
+    every post is marked in db as soon as its file is ready.
+    """
     # get N random entries from db
     # download them, rename, optimize size
     connection = connect_to_db()
@@ -143,30 +160,65 @@ def download_images(amount: int) -> None:
                 print("DB Connection error")
                 return
 
+    # pictures the scraper kept, already optimized
+    blob_cache = BlobCache.from_env()
+    pool = GalleryDLPool(
+        workers=workers, timeout=DOWNLOAD_TIMEOUT, folder=STATIC_FOLDER_PATH
+    )
+    optimizer = ProcessPoolExecutor(max_workers=max(optimize_workers, 1))
+    downloads: Dict[Future, RedditPost] = {}
+    optimizations: Dict[Future, RedditPost] = {}
+    # crossposts share the url and phash, the db update marks them all
+    seen = set()
+
     try:
         for post in posts:
             reddit_post = RedditPost.from_downloader_db(post)
-            print(f"Downloading: {post.url}")
-            did_load = download_pic_from_url(reddit_post.url)
-            if not did_load:
-                print("Couldnt download file, with ", f"{reddit_post.url=}")
-                set_wrong_format_status_by_phash(
-                    connection, status=True, phash=reddit_post.phash
-                )
+            if reddit_post.phash in seen or reddit_post.url in seen:
+                continue
+            seen.update((reddit_post.phash, reddit_post.url))
+
+            cached_path = Path(STATIC_FOLDER_PATH, reddit_post.get_image_name())
+            if blob_cache is not None and blob_cache.take(reddit_post.url, cached_path):
+                print(f"Taken from cache: {post.url}")
+                mark_downloaded(connection, reddit_post)
                 continue
-            else:
-                assert isinstance(STATIC_FOLDER_PATH, str)
-                file_path = rename_latest_file_in_folder(
-                    STATIC_FOLDER_PATH, f"{reddit_post.sub_name}_{reddit_post.post_id}"
-                )
-
-            optimize_image(file_path=str(file_path))
-            # mark as selected in db
-            set_downloaded_status_by_phash(
-                connection, status=True, phash=reddit_post.phash
+
+            print(f"Downloading: {post.url}")
+            future = pool.submit(
+                download_pic_from_url,
+                reddit_post.url,
+                STATIC_FOLDER_PATH,
+                url=reddit_post.url,
             )
+            downloads[future] = reddit_post
+
+        while downloads or optimizations:
+            done, _ = wait([*downloads, *optimizations], return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in downloads:
+                    reddit_post = downloads.pop(future)
+                    file_path = finish_download(connection, reddit_post, future)
+                    if file_path is not None:
+                        optimization = optimizer.submit(optimize_image, str(file_path))
+                        optimizations[optimization] = reddit_post
+                    continue
+
+                reddit_post = optimizations.pop(future)
+                try:
+                    future.result()
+                except Exception as ex:  # PIL couldn't open it after all
+                    print(f"Couldnt optimize {reddit_post.url}: {ex!r}")
+                    set_wrong_format_status_by_phash(
+                        connection, status=True, phash=reddit_post.phash
+                    )
+                    continue
+                # mark as selected in db
+                mark_downloaded(connection, reddit_post)
 
     finally:
+        pool.close()
+        optimizer.shutdown()
         if connection:
             connection.close()
 
@@ -174,6 +226,7 @@ def download_images(amount: int) -> None:
 def delete_disliked_posts():
     conn = connect_to_db()
     disliked_posts = get_disliked_posts(conn)
+    deleted_files = []
 
     for post in disliked_posts:
         (sub_name, post_id, phash) = post
@@ -183,13 +236,20 @@ def delete_disliked_posts():
         # delete file
         filename = pathlib.Path(STATIC_FOLDER_PATH, f"{sub_name}_{post_id}.jpg")
         filename.unlink(missing_ok=True)
+        deleted_files.append(filename)
 
+    forget_files(conn, STATIC_FOLDER_PATH, deleted_files)
     if conn:
         conn.close()
 
 
-def main():
-    folder_size = get_static_folder_size()
+def main(amount: int = 5, workers: int = 1, optimize_workers: int = 1):
+    """Runs every minute from cron with the defaults. To fill the folder quickly:
+    python src/downloader.py --amount=500 --workers=8 --optimize_workers=4
+    """
+    conn = connect_to_db()
+    folder_size = get_static_folder_size(conn)
+    conn.close()
     print(folder_size / MEGABYTE)
 
     delete_disliked_posts()
@@ -198,9 +258,9 @@ def main():
         print("Enough files")
     else:
         print("Downloading more")
-        download_images(5)
+        download_images(amount, workers=workers, optimize_workers=optimize_workers)
         verify_downloaded_files()
 
 
 if __name__ == "__main__":
-    main()
+    fire.Fire(main)
@@ -2,25 +2,252 @@
 This is used to download images from various website. Which turned out to be a much harder task than it seems.
 """
 import gallery_dl
+from gallery_dl import extractor, text
+from gallery_dl.extractor.common import Extractor
 from gallery_dl.job import DownloadJob, config
 from dotenv import load_dotenv, find_dotenv
 import os
+import shutil
+import tempfile
+import threading
+import urllib.parse
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import requests
+import requests.adapters
 
 # load configuration
 load_dotenv(find_dotenv(raise_error_if_not_found=True))
 
+FILESIZE_MIN = "20k"
 
-def download_pic_from_url(url: str, folder=os.getenv("STATIC_FOLDER_PATH")) -> bool:
+# buffered files bigger than this are spilled to disk
+DEFAULT_MAX_MEMORY = 32 * 1000000
 
-    """Download image file
+# gallery-dl keeps oauth access tokens (pixiv, deviantart) in this sqlite file until they
+# expire. All scraper and downloader processes share it, so a token is refreshed once
+# per lifetime instead of once per process.
+TOKEN_CACHE_PATH = os.getenv("GALLERY_DL_CACHE_PATH") or str(
+    Path(__file__).resolve().parent.parent / ".gallery_dl_cache.sqlite3"
+)
+# set on import, gallery-dl before 1.26 opens its cache with the first extractor module,
+# newer versions with the first login
+config.set(("cache",), "file", TOKEN_CACHE_PATH)
+
+# these hosts serve the picture itself, their urls don't need a gallery-dl extractor
+DIRECT_HOSTS = ("i.redd.it", "i.imgur.com")
+DIRECT_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+DIRECT_TIMEOUT = 7
+DIRECT_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:115.0) Gecko/20100101 Firefox/115.0"
+)
+CHUNK_SIZE = 64 * 1024
+# downloads get a unique name with this prefix, the url's name is shared by crossposts
+JOB_PREFIX = "download-"
+
+# the host couldn't be reached, as opposed to a missing or broken picture
+NETWORK_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+_direct_sessions = threading.local()
+_downloaders = threading.local()
+
+
+class PathRecordingJob(DownloadJob):
+    """DownloadJob that remembers where it wrote files,
+    so callers don't have to search the download folder for them.
+    Child jobs (pixiv, deviantart galleries etc) report into their parent's list.
+    """
+
+    def __init__(self, url, parent=None, *args, **kwargs):
+        DownloadJob.__init__(self, url, parent, *args, **kwargs)
+        if isinstance(parent, PathRecordingJob):
+            self.written_paths = parent.written_paths
+        else:
+            self.written_paths: List[Path] = []
+
+    def handle_url(self, url, kwdict, *args, **kwargs):
+        DownloadJob.handle_url(self, url, kwdict, *args, **kwargs)
+        pathfmt = self.pathfmt
+        if not pathfmt or not pathfmt.realpath:
+            return
+
+        path = Path(pathfmt.realpath)
+        if path not in self.written_paths and path.is_file():
+            self.written_paths.append(path)
+
+
+class BufferJob(DownloadJob):
+    """DownloadJob that keeps downloaded files in memory instead of writing them to a folder.
+    Files bigger than max_memory bytes are spilled to a temporary file in spill_folder.
+    Extractor filters (image-range, image-filter) still apply, the files are fetched
+    with the extractor's own session, so site specific headers and auth are kept.
+    """
+
+    def __init__(
+        self,
+        url,
+        parent=None,
+        *args,
+        max_memory: int = DEFAULT_MAX_MEMORY,
+        spill_folder: Optional[str] = None,
+        **kwargs,
+    ):
+        DownloadJob.__init__(self, url, parent, *args, **kwargs)
+        if isinstance(parent, BufferJob):
+            self.buffers = parent.buffers
+            self.max_memory = parent.max_memory
+            self.spill_folder = parent.spill_folder
+        else:
+            self.buffers: List[tempfile.SpooledTemporaryFile] = []
+            self.max_memory = max_memory
+            self.spill_folder = spill_folder
+
+    def handle_url(self, url, kwdict, *args, **kwargs):
+        buffer = tempfile.SpooledTemporaryFile(
+            max_size=self.max_memory, dir=self.spill_folder
+        )
+        try:
+            response = self.extractor.request(url, stream=True)
+            for chunk in response.iter_content(CHUNK_SIZE):
+                buffer.write(chunk)
+        except (
+            gallery_dl.exception.GalleryDLException,
+            requests.exceptions.RequestException,
+        ):
+            self.log.error("Failed to download %s", url)
+            buffer.close()
+            return
+
+        if buffer.tell() < text.parse_bytes(FILESIZE_MIN):
+            buffer.close()
+            return
+
+        buffer.seek(0)
+        self.buffers.append(buffer)
+
+
+def host_failure(url: str, ex: Exception) -> OSError:
+    """Builtin TimeoutError or ConnectionError for a network error of {url},
+    the circuit breaker of src/host_policy.py counts these against the host.
+    """
+    error = (
+        TimeoutError if isinstance(ex, requests.exceptions.Timeout) else ConnectionError
+    )
+    return error(f"{urllib.parse.urlsplit(url).hostname}: {ex!r}")
+
+
+def make_direct_session() -> requests.Session:
+    session = requests.Session()
+    session.headers["User-Agent"] = DIRECT_USER_AGENT
+    adapter = requests.adapters.HTTPAdapter(pool_connections=len(DIRECT_HOSTS))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    Args:
-        url (str): url to image file
+
+def get_direct_session() -> requests.Session:
+    """Session of the current thread, it keeps connections to the image hosts open"""
+    session = getattr(_direct_sessions, "session", None)
+    if session is None:
+        session = make_direct_session()
+        _direct_sessions.session = session
+    return session
+
+
+def is_direct_image_url(url: str) -> bool:
+    """i.redd.it/abc.jpg yes, imgur.com/a/abc or pixiv.net/... no"""
+    parsed = urllib.parse.urlsplit(url)
+    return parsed.hostname in DIRECT_HOSTS and parsed.path.lower().endswith(
+        DIRECT_EXTENSIONS
+    )
+
+
+def stream_direct(url: str, file, session: Optional[requests.Session] = None) -> bool:
+    """Write the picture at a direct url to an open binary file, chunk by chunk.
 
     Returns:
-        bool: True if no errors
+        bool: False if it is missing, not a picture or smaller than FILESIZE_MIN
+
+    Raises:
+        ConnectionError, TimeoutError: the host couldn't be reached
+    """
+    session = session or get_direct_session()
+    try:
+        with session.get(url, stream=True, timeout=DIRECT_TIMEOUT) as response:
+            response.raise_for_status()
+            content_type = response.headers.get("Content-Type", "")
+            # imgur redirects deleted pictures to a placeholder
+            if not content_type.startswith("image/") or response.url.endswith(
+                "/removed.png"
+            ):
+                return False
+            for chunk in response.iter_content(CHUNK_SIZE):
+                file.write(chunk)
+    except NETWORK_ERRORS as ex:
+        raise host_failure(url, ex) from ex
+    except requests.exceptions.RequestException:
+        return False
+
+    return file.tell() >= text.parse_bytes(FILESIZE_MIN)
+
+
+def fetch_direct(
+    url: str, folder: str, session: Optional[requests.Session] = None
+) -> List[Path]:
+    """download_pic_from_url for direct urls, without gallery-dl.
+    The file is named after the url with a unique prefix and only appears once it is complete.
     """
+    temp_file = tempfile.NamedTemporaryFile(
+        dir=folder, prefix=JOB_PREFIX, suffix=".part", delete=False
+    )
+    name = Path(urllib.parse.urlsplit(url).path).name
+    path = Path(folder, f"{Path(temp_file.name).stem}_{name}")
+    try:
+        with temp_file:
+            is_complete = stream_direct(url, temp_file, session)
+    except BaseException:
+        os.unlink(temp_file.name)
+        raise
+
+    if not is_complete:
+        os.unlink(temp_file.name)
+        return []
+
+    os.replace(temp_file.name, path)
+    return [path]
+
+
+def fetch_direct_to_buffer(
+    url: str,
+    max_memory: int,
+    spill_folder: Optional[str],
+    session: Optional[requests.Session] = None,
+) -> List[tempfile.SpooledTemporaryFile]:
+    """download_pic_to_buffer for direct urls, without gallery-dl"""
+    buffer = tempfile.SpooledTemporaryFile(max_size=max_memory, dir=spill_folder)
+    try:
+        is_complete = stream_direct(url, buffer, session)
+    except BaseException:
+        buffer.close()
+        raise
+    if not is_complete:
+        buffer.close()
+        return []
+
+    buffer.seek(0)
+    return [buffer]
+
+
+def load_extractors() -> None:
+    """gallery-dl imports its extractor modules lazily on the first url lookup,
+    which breaks when several threads do that at once. Import them all upfront.
+    """
+    extractor.extractors()
+
 
+def configure_gallery_dl(folder: Optional[str]) -> None:
+    """Set gallery-dl options, downloaded files end up in {folder}"""
     config.set(("extractor", "imgur"), "filename", "{id}.{extension}")
     config.set((), "timeout", 7)
     config.set((), "sleep", 1)
@@ -33,28 +260,232 @@ def download_pic_from_url(url: str, folder=os.getenv("STATIC_FOLDER_PATH")) -> b
     config.set((), "parent-directory", True)
     config.set(("extractor", "imgur"), "mp4", False)
     config.set(("extractor", "imgur"), "gif", False)
-    config.set(("downloader",), "filesize-min", "20k")
+    config.set(("downloader",), "filesize-min", FILESIZE_MIN)
     config.set(
         ("extractor", "pixiv"),
         "refresh-token",
         os.getenv("GALLERY_DL_REFRESH_TOKEN"),
     )
     config.set(
-        ("extractor", "devianart"),
+        ("extractor", "deviantart"),
         "client-id",
         os.getenv("DA_CLIENT_ID"),
     )
     config.set(
-        ("extractor", "devianart"),
+        ("extractor", "deviantart"),
         "client-secret",
         os.getenv("DA_CLIENT_SECRET"),
     )
     config.set(("extractor", "pixiv"), "avatar", False)
     config.set(("extractor", "pixiv"), "ugoira", False)
 
+
+def rename_downloaded_file(file_path: Path, new_filename: str) -> Path:
+    """Gallery-dl loads images with random names, rename the file
+    to {new_filename} + {.ext}
+
+    Args:
+        new_filename (str): {created_utc} + '_' + {post.id}
+
+    Returns:
+        Path: new path to renamed file
+    """
+    new_path = file_path.with_name(new_filename + file_path.suffix)
     try:
-        DownloadJob(url).run()
-    except gallery_dl.exception.GalleryDLException:
-        return False
+        file_path.rename(new_path)
+    except FileExistsError:
+        print("File already exists")
+    return new_path
+
+
+def move_out_of_job_folder(file_path: Path) -> Path:
+    """Move a file of a job folder next to it, the folder's unique name becomes its prefix"""
+    job_folder = file_path.parent
+    new_path = job_folder.with_name(f"{job_folder.name}_{file_path.name}")
+    os.replace(file_path, new_path)
+    return new_path
+
+
+class GalleryDownloader:
+    """gallery-dl configured once, for thousands of downloads.
+    Extractors of the same category (imgur, pixiv, deviantart...) share one HTTP session,
+    so connections stay open and logins carry over from one download to the next.
+    gallery-dl only logs network errors, the sessions remember them, so a download
+    that failed because the host couldn't be reached raises instead of returning nothing.
+    Not thread safe, use one per thread (see get_downloader).
+
+    Example:
+        downloader = GalleryDownloader("scrape_download")
+        paths = downloader.download("https://imgur.com/a/abc", "scrape_download")
+    """
+
+    def __init__(self, folder: Optional[str] = None):
+        configure_gallery_dl(folder)
+        load_extractors()
+        self.folder = folder
+        self.direct_session = make_direct_session()
+        self.sessions: Dict[str, requests.Session] = {}
+        self.network_error: Optional[Exception] = None
+
+    def _find_extractor(self, url: str) -> Optional[Extractor]:
+        extr = extractor.find(url)
+        if extr is None:
+            return None
+        kept = self.sessions.get(extr.category)
+        initialize = getattr(extr, "initialize", None)
+        if initialize is None:
+            # gallery-dl before 1.26 sets up the session with its cookies in the constructor,
+            # only the connections are shared, the way it does for child jobs
+            if kept is not None:
+                extr.session.adapters = kept.adapters
+        else:
+            if kept is not None:
+                extr.session = kept
+            # the job would do it first thing as well, here it creates the session to watch
+            initialize()
+        self._watch_session(extr.session)
+        return extr
+
+    def _watch_session(self, session: requests.Session) -> None:
+        """Remember the last network error of the session's requests,
+        gallery-dl's downloaders and extractors all go through session.request
+        """
+        if getattr(session, "is_watched", False):
+            return
+        request = session.request
+
+        def watched_request(*args, **kwargs):
+            try:
+                return request(*args, **kwargs)
+            except NETWORK_ERRORS as ex:
+                self.network_error = ex
+                raise
+
+        session.request = watched_request
+        session.is_watched = True
+
+    def _keep_session(self, extr: Extractor) -> None:
+        if extr.session is not None:
+            self.sessions.setdefault(extr.category, extr.session)
+
+    def _run(self, job, url: str, results: list) -> bool:
+        """Run a job with the extractor of _find_extractor, False if gallery-dl gave up.
+
+        Raises:
+            ConnectionError, TimeoutError: nothing was downloaded because of network errors
+        """
+        self.network_error = None
+        try:
+            job.run()
+            is_ok = True
+        except gallery_dl.exception.GalleryDLException:
+            is_ok = False
+        finally:
+            self._keep_session(job.extractor)
+
+        if not results and self.network_error is not None:
+            raise host_failure(url, self.network_error) from self.network_error
+        return is_ok
+
+    def download(self, url: str, dest: Optional[str] = None) -> List[Path]:
+        """Download image file into {dest}, defaults to the folder it was created with.
+
+        Returns:
+            List[Path]: paths of downloaded files, empty if nothing was downloaded
+        """
+        dest = self.folder if dest is None else dest
+        if dest and is_direct_image_url(url):
+            return fetch_direct(url, dest, self.direct_session)
+
+        extr = self._find_extractor(url)
+        if extr is None:
+            return []
 
-    return True
+        # gallery-dl names files after the url and skips the ones that exist,
+        # every job writes into a folder of its own and the files are moved out of it
+        if dest:
+            os.makedirs(dest, exist_ok=True)
+        job_folder = Path(tempfile.mkdtemp(prefix=JOB_PREFIX, dir=dest))
+        # child jobs (galleries) inherit it with the parent-directory option
+        extr._parentdir = str(job_folder) + os.sep
+        try:
+            job = PathRecordingJob(extr)
+            if not self._run(job, url, job.written_paths):
+                return []
+            return [move_out_of_job_folder(path) for path in job.written_paths]
+        finally:
+            shutil.rmtree(job_folder, ignore_errors=True)
+
+    def download_to_buffer(
+        self,
+        url: str,
+        max_memory: int = DEFAULT_MAX_MEMORY,
+        spill_folder: Optional[str] = None,
+    ) -> List[tempfile.SpooledTemporaryFile]:
+        """Same as download_pic_to_buffer"""
+        if is_direct_image_url(url):
+            return fetch_direct_to_buffer(
+                url, max_memory, spill_folder, self.direct_session
+            )
+
+        extr = self._find_extractor(url)
+        if extr is None:
+            return []
+
+        job = BufferJob(extr, max_memory=max_memory, spill_folder=spill_folder)
+        if not self._run(job, url, job.buffers):
+            for buffer in job.buffers:
+                buffer.close()
+            return []
+        return job.buffers
+
+
+def get_downloader(folder: Optional[str] = None) -> GalleryDownloader:
+    """Downloader of the current thread, created with {folder} on first use"""
+    downloader = getattr(_downloaders, "downloader", None)
+    if downloader is None:
+        downloader = GalleryDownloader(folder)
+        _downloaders.downloader = downloader
+    return downloader
+
+
+def download_pic_from_url(
+    url: str, folder=os.getenv("STATIC_FOLDER_PATH")
+) -> List[Path]:
+    """Download image file with the downloader of the current thread.
+    Direct links to pictures are fetched with a pooled session, everything else with gallery-dl.
+
+    Args:
+        url (str): url to image file
+
+    Returns:
+        List[Path]: paths of downloaded files, empty if nothing was downloaded
+
+    Raises:
+        ConnectionError, TimeoutError: the host couldn't be reached
+    """
+    return get_downloader(folder).download(url, folder)
+
+
+def download_pic_to_buffer(
+    url: str,
+    max_memory: int = DEFAULT_MAX_MEMORY,
+    spill_folder: Optional[str] = None,
+) -> List[tempfile.SpooledTemporaryFile]:
+    """Download image file without writing it to disk,
+    unless it is bigger than max_memory bytes.
+
+    Args:
+        url (str): url to image file
+        max_memory (int, optional): in memory size limit per file, in bytes.
+        spill_folder (Optional[str], optional): folder for files above the limit.
+
+    Returns:
+        List[tempfile.SpooledTemporaryFile]: downloaded files, the caller has to close them
+
+    Raises:
+        ConnectionError, TimeoutError: the host couldn't be reached
+    """
+    return get_downloader(spill_folder).download_to_buffer(
+        url, max_memory=max_memory, spill_folder=spill_folder
+    )
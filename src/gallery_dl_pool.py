@@ -0,0 +1,217 @@
+"""
+Long lived worker processes for gallery-dl downloads, with a hard deadline per job.
+Workers configure gallery-dl and import its extractors once when they start,
+every worker keeps one GalleryDownloader with its HTTP sessions.
+A job that runs past its deadline gets its worker killed and replaced with a fresh one,
+so a stuck download can't hold up the scrape, wherever the caller runs (any thread).
+The scraper and the downloader both send their downloads here.
+Jobs given a url are also held to the per host limits of src/host_policy.py.
+
+Example:
+    with GalleryDLPool(workers=4, timeout=60, folder="scrape_download") as pool:
+        paths = pool.run(download_pic_from_url, url, "scrape_download", url=url)
+        futures = [pool.submit(download_pic_from_url, u, folder, url=u) for u in urls]
+"""
+import multiprocessing
+import multiprocessing.connection
+import pickle
+import queue
+import signal
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Set
+
+try:
+    from gallery_dl_helper import get_downloader
+    from host_policy import HostLimiter
+except ModuleNotFoundError:
+    from src.gallery_dl_helper import get_downloader
+    from src.host_policy import HostLimiter
+
+
+# a job waits for a free worker at most this many of its timeouts,
+# only a worker lost to a bug could keep it waiting longer
+MAX_QUEUED_TIMEOUTS = 10
+
+
+class DownloadTimeout(TimeoutError):
+    pass
+
+
+class WorkerDied(RuntimeError):
+    pass
+
+
+def _worker_main(connection, folder: Optional[str]) -> None:
+    # ctrl+c is handled by the parent, which then terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # configures gallery-dl, its sessions are then kept for the life of the worker
+    get_downloader(folder)
+
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+
+        func, args = job
+        try:
+            result = (True, func(*args))
+        except Exception as ex:
+            result = (False, ex)
+
+        try:
+            connection.send(result)
+        except Exception as ex:  # result or exception that doesn't pickle
+            connection.send((False, RuntimeError(repr(ex))))
+
+
+@dataclass(eq=False)  # hashed by identity
+class _Worker:
+    process: multiprocessing.Process
+    connection: multiprocessing.connection.Connection
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join(timeout=5)
+        self.connection.close()
+
+
+class GalleryDLPool:
+    """Pool of {workers} download processes, usable from any amount of threads.
+
+    Args:
+        workers (int): amount of processes
+        timeout (int): seconds a job may run before its worker is killed
+        folder (Optional[str]): gallery-dl download folder of the workers
+        hosts (Optional[HostLimiter]): per host limits, defaults to HostLimiter.from_env()
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        timeout: int = 60,
+        folder: Optional[str] = None,
+        hosts: Optional[HostLimiter] = None,
+    ):
+        self.workers = max(workers, 1)
+        self.timeout = timeout
+        self.folder = folder
+        self.hosts = hosts if hosts is not None else HostLimiter.from_env()
+        self.respawned = 0
+        self._lock = threading.Lock()
+        self._live: Set[_Worker] = set()
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        for _ in range(self.workers):
+            self._idle.put(self._spawn())
+        # threads that wait on workers for submit(), more than workers since some of them
+        # wait on host slots while jobs for other hosts could already run
+        self._executor = ThreadPoolExecutor(max_workers=self.workers * 4)
+
+    def __enter__(self) -> "GalleryDLPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _spawn(self) -> _Worker:
+        parent_connection, child_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_worker_main, args=(child_connection, self.folder), daemon=True
+        )
+        process.start()
+        child_connection.close()
+
+        worker = _Worker(process, parent_connection)
+        with self._lock:
+            self._live.add(worker)
+        return worker
+
+    def _replace(self, worker: _Worker) -> None:
+        with self._lock:
+            self._live.discard(worker)
+            self.respawned += 1
+        worker.kill()
+        self._idle.put(self._spawn())
+
+    def run(
+        self,
+        func: Callable,
+        *args,
+        timeout: Optional[float] = None,
+        url: Optional[str] = None,
+    ) -> Any:
+        """Run func(*args) in a worker and return its result, exceptions are re-raised.
+        func and args must be picklable, so module level functions only.
+        With a url the job first waits for a slot of its host.
+
+        Raises:
+            DownloadTimeout: the job ran longer than {timeout} seconds, its worker was killed
+            WorkerDied: the worker process crashed, or no worker was free in time
+            HostUnavailable: the url's host is dead or failed too often, nothing was run
+        """
+        if url is None:
+            return self._run(func, args, timeout)
+        with self.hosts.slot(url):
+            return self._run(func, args, timeout)
+
+    def _run(self, func: Callable, args: tuple, timeout: Optional[float]) -> Any:
+        timeout = self.timeout if timeout is None else timeout
+        # pickled before a worker is taken, so a job that doesn't pickle can't lose one
+        job = pickle.dumps((func, args))
+        try:
+            worker = self._idle.get(timeout=timeout * MAX_QUEUED_TIMEOUTS)
+        except queue.Empty:
+            raise WorkerDied(f"{func.__name__}: no worker became free") from None
+
+        try:
+            worker.connection.send_bytes(job)
+            is_done = worker.connection.poll(timeout)
+            if is_done:
+                is_ok, value = worker.connection.recv()
+        except (EOFError, OSError) as ex:
+            self._replace(worker)
+            raise WorkerDied(f"{func.__name__}: {ex!r}") from ex
+        except BaseException:
+            # result that doesn't unpickle, ctrl+c... the worker's state is unknown
+            self._replace(worker)
+            raise
+
+        if not is_done:
+            self._replace(worker)
+            raise DownloadTimeout(f"{func.__name__} took over {timeout}s")
+
+        self._idle.put(worker)
+        if not is_ok:
+            raise value
+        return value
+
+    def submit(
+        self,
+        func: Callable,
+        *args,
+        timeout: Optional[float] = None,
+        url: Optional[str] = None,
+    ) -> Future:
+        """Same as run, but returns a future right away"""
+        return self._executor.submit(self.run, func, *args, timeout=timeout, url=url)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            workers, self._live = list(self._live), set()
+
+        for worker in workers:
+            try:
+                worker.connection.send(None)
+            except OSError:
+                pass
+        for worker in workers:
+            worker.process.join(timeout=1)
+            if worker.process.is_alive():
+                worker.kill()
+            else:
+                worker.connection.close()
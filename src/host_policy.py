@@ -0,0 +1,223 @@
+"""
+Per host limits for downloads: how many at once, how often, and a circuit breaker.
+After {failure_threshold} timeouts in a row a host is skipped for {cooldown} seconds,
+so a host that is down costs a few timeouts per run instead of one per url.
+Hosts that are gone for good are marked dead and never contacted.
+Policies are looked up by domain suffix, "i.minus.com" gets the policy of "minus.com".
+Open breakers are kept in a small json file, so the downloader that cron starts
+every minute in a fresh process keeps skipping the host until the cooldown is over.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+
+@dataclass
+class HostPolicy:
+    """
+    Args:
+        max_concurrency (int): downloads from the host at once
+        min_interval (float): seconds between the starts of two downloads
+        failure_threshold (int): timeouts in a row that open the circuit breaker
+        cooldown (float): seconds the host is skipped once the breaker is open
+        dead (bool): never download from the host
+    """
+
+    max_concurrency: int = 4
+    min_interval: float = 0.0
+    failure_threshold: int = 3
+    cooldown: float = 600.0
+    dead: bool = False
+
+
+HOST_POLICIES = {
+    # gone for years, every url would only wait for its timeout
+    "minus.com": HostPolicy(dead=True),
+    "i.redd.it": HostPolicy(max_concurrency=8),
+    "i.imgur.com": HostPolicy(max_concurrency=4),
+    "imgur.com": HostPolicy(max_concurrency=2),
+    "pixiv.net": HostPolicy(max_concurrency=2, min_interval=1.0),
+    "deviantart.com": HostPolicy(max_concurrency=2, min_interval=1.0),
+    "twitter.com": HostPolicy(max_concurrency=2, min_interval=1.0),
+}
+
+# exceptions that count against the host, anything else is the picture's fault.
+# The download functions of gallery_dl_helper raise these for network errors.
+HOST_FAILURES = (TimeoutError, ConnectionError)
+
+
+# {domain: {"open_until": unix time, "failures": n}} of the open breakers
+DEFAULT_BREAKERS_PATH = Path(__file__).resolve().parent.parent / ".host_breakers.json"
+
+
+class HostUnavailable(Exception):
+    pass
+
+
+@dataclass
+class _HostState:
+    slots: threading.Semaphore
+    failures: int = 0
+    open_until: float = 0.0
+    next_start: float = 0.0
+
+
+def get_host(url: str) -> str:
+    return (urllib.parse.urlsplit(url).hostname or "").lower()
+
+
+def read_breakers(path: str) -> Dict[str, dict]:
+    """Breakers saved in {path}, empty if there is no readable file"""
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def find_policy(
+    host: str, policies: Dict[str, HostPolicy]
+) -> Tuple[str, Optional[HostPolicy]]:
+    """Most specific configured domain of {host} and its policy, (host, None) if there is none"""
+    parts = host.split(".")
+    for start in range(len(parts)):
+        domain = ".".join(parts[start:])
+        if domain in policies:
+            return domain, policies[domain]
+    return host, None
+
+
+@dataclass
+class HostLimiter:
+    """Applies HostPolicy per host, shared by all threads of a run.
+
+    Example:
+        limiter = HostLimiter()
+        with limiter.slot(url):  # raises HostUnavailable for dead hosts and open breakers
+            download(url)
+
+    Args:
+        state_path (Optional[str]): json file of open breakers shared with other processes,
+            they are read on creation and written when a breaker opens. None keeps them in memory.
+    """
+
+    policies: Dict[str, HostPolicy] = field(default_factory=lambda: HOST_POLICIES)
+    default: HostPolicy = field(default_factory=HostPolicy)
+    state_path: Optional[str] = None
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._states: Dict[str, _HostState] = {}
+        if self.state_path:
+            self._load()
+
+    @classmethod
+    def from_env(cls) -> "HostLimiter":
+        """Limiter with HOST_POLICIES, breakers are kept in HOST_BREAKERS_PATH
+        or .host_breakers.json in the project
+        """
+        return cls(
+            state_path=os.getenv("HOST_BREAKERS_PATH") or str(DEFAULT_BREAKERS_PATH)
+        )
+
+    def policy_for(self, url: str) -> Tuple[str, HostPolicy]:
+        domain, policy = find_policy(get_host(url), self.policies)
+        return domain, policy or self.default
+
+    def _state(self, domain: str, policy: HostPolicy) -> _HostState:
+        with self._lock:
+            if domain not in self._states:
+                slots = threading.Semaphore(max(policy.max_concurrency, 1))
+                self._states[domain] = _HostState(slots)
+            return self._states[domain]
+
+    def _load(self) -> None:
+        """Open the breakers that earlier runs opened and whose cooldown isn't over"""
+        now, clock = time.time(), time.monotonic()
+        for domain, breaker in read_breakers(self.state_path).items():
+            if breaker["open_until"] > now:
+                state = self._state(domain, self.policies.get(domain, self.default))
+                state.failures = breaker["failures"]
+                state.open_until = clock + breaker["open_until"] - now
+
+    def _save(self, domain: str, state: _HostState) -> None:
+        """Add the breaker of {domain} to the file, dropping the ones that closed since"""
+        now = time.time()
+        breakers = {
+            other: breaker
+            for other, breaker in read_breakers(self.state_path).items()
+            if breaker["open_until"] > now
+        }
+        breakers[domain] = {
+            "open_until": now + state.open_until - time.monotonic(),
+            "failures": state.failures,
+        }
+        folder = Path(self.state_path).parent
+        try:
+            with tempfile.NamedTemporaryFile(
+                "w", dir=folder, suffix=".tmp", delete=False
+            ) as temp_file:
+                json.dump(breakers, temp_file)
+            os.replace(temp_file.name, self.state_path)
+        except OSError as ex:  # the breaker still works for this run
+            print(f"Couldnt save the breaker of {domain}: {ex}")
+
+    def _check(self, domain: str, policy: HostPolicy, state: _HostState) -> None:
+        if policy.dead:
+            raise HostUnavailable(f"{domain} is dead")
+        if state.open_until > time.monotonic():
+            raise HostUnavailable(f"{domain} failed {state.failures} times in a row")
+
+    @contextmanager
+    def slot(self, url: str) -> Iterator[None]:
+        """Wait for a free slot and the minimum interval of the url's host.
+
+        Raises:
+            HostUnavailable: the host is dead or its breaker is open
+        """
+        domain, policy = self.policy_for(url)
+        state = self._state(domain, policy)
+        self._check(domain, policy, state)
+
+        with state.slots:
+            with self._lock:
+                # the breaker may have opened while this thread waited for the slot
+                self._check(domain, policy, state)
+                now = time.monotonic()
+                start = max(now, state.next_start)
+                state.next_start = start + policy.min_interval
+            if start > now:
+                time.sleep(start - now)
+
+            try:
+                yield
+            except HOST_FAILURES:
+                self._record(domain, policy, state, failed=True)
+                raise
+            self._record(domain, policy, state, failed=False)
+
+    def _record(
+        self, domain: str, policy: HostPolicy, state: _HostState, failed: bool
+    ) -> None:
+        with self._lock:
+            if not failed:
+                state.failures = 0
+                return
+
+            state.failures += 1
+            # after the cooldown a single failure opens it again
+            if state.failures >= policy.failure_threshold:
+                state.open_until = time.monotonic() + policy.cooldown
+                print(
+                    f"{domain}: {state.failures} failures in a row, "
+                    f"skipping it for {policy.cooldown:.0f}s"
+                )
+                if self.state_path:
+                    self._save(domain, state)
@@ -0,0 +1,145 @@
+"""
+Everything we want to know about a picture, computed from a single decode when it is scraped
+and stored in the image_features table (sql_commands/image_features.sql),
+so later stages don't have to read and decode the file again.
+Rows carry FEATURES_VERSION, bump it when features are added or their computation changes,
+older rows are then ignored and recomputed from disk by their users.
+"""
+import os
+from dataclasses import dataclass, field
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import psycopg2
+import psycopg2.extras
+from PIL import Image
+
+try:
+    from img_helper import DRAFT_MIN_SIZE, phash_thumbnail, phash_thumbnails
+except ModuleNotFoundError:
+    from src.img_helper import DRAFT_MIN_SIZE, phash_thumbnail, phash_thumbnails
+
+FEATURES_VERSION = 1
+
+# same layout as image_similarity._get_hist_for_file: 8 bins per channel, BGR order
+HIST_BINS = 8
+
+
+@dataclass
+class ImageFeatures:
+    phash: str
+    width: int
+    height: int
+    file_size: int
+    avg_color: Tuple[int, int, int]  # RGB
+    color_hist: np.ndarray = field(repr=False)  # 512 float32
+    version: int = FEATURES_VERSION
+
+
+def color_histogram(rgb: np.ndarray) -> np.ndarray:
+    """8x8x8 color histogram, normalized to unit length.
+    Same values as cv2.calcHist over cv2.imread's BGR channels followed by cv2.normalize.
+    """
+    bins = (rgb >> 5).astype(np.int32)  # 256 / 8 values per bin
+    blue, green, red = bins[..., 2], bins[..., 1], bins[..., 0]
+    index = (blue * HIST_BINS + green) * HIST_BINS + red
+    hist = np.bincount(index.ravel(), minlength=HIST_BINS**3).astype(np.float32)
+    norm = np.linalg.norm(hist)
+    return hist / norm if norm else hist
+
+
+def get_file_size(file: Union[str, os.PathLike, BinaryIO]) -> int:
+    if hasattr(file, "seek"):
+        position = file.tell()
+        size = file.seek(0, os.SEEK_END)
+        file.seek(position)
+        return size
+    return os.path.getsize(file)
+
+
+def compute_features(
+    image: Image.Image, file_size: int, draft: bool = False
+) -> ImageFeatures:
+    """All features of an opened (not yet loaded) picture, it is decoded once.
+    With draft=True jpegs are decoded at reduced resolution (see img_helper),
+    which changes the phash slightly and the histogram a little.
+    """
+    width, height = image.size  # from the header, before a draft decode shrinks it
+    if draft and image.format == "JPEG":
+        image.draft("RGB", (DRAFT_MIN_SIZE, DRAFT_MIN_SIZE))
+    # the only decode, the conversions below work on the loaded pixels
+    rgb = np.asarray(image.convert("RGB"))
+
+    thumbnail = phash_thumbnail(image)
+    return ImageFeatures(
+        phash=phash_thumbnails(thumbnail[np.newaxis])[0],
+        width=width,
+        height=height,
+        file_size=file_size,
+        avg_color=tuple(int(round(c)) for c in rgb.reshape(-1, 3).mean(axis=0)),
+        color_hist=color_histogram(rgb),
+    )
+
+
+def save_features(cursor, rows: List[Tuple[str, str, ImageFeatures]]) -> None:
+    """Upsert features of (sub_name, post_id, features) rows"""
+    if not rows:
+        return
+
+    psycopg2.extras.execute_values(
+        cursor,
+        """INSERT INTO image_features
+        (sub_name, post_id, version, phash, width, height, file_size, avg_color, color_hist)
+        VALUES %s ON CONFLICT (sub_name, post_id) DO UPDATE SET
+        version = EXCLUDED.version, phash = EXCLUDED.phash, width = EXCLUDED.width,
+        height = EXCLUDED.height, file_size = EXCLUDED.file_size,
+        avg_color = EXCLUDED.avg_color, color_hist = EXCLUDED.color_hist""",
+        [
+            (
+                sub_name,
+                post_id,
+                features.version,
+                features.phash,
+                features.width,
+                features.height,
+                features.file_size,
+                list(features.avg_color),
+                psycopg2.Binary(features.color_hist.astype("<f4").tobytes()),
+            )
+            for sub_name, post_id, features in rows
+        ],
+    )
+
+
+def load_histograms(
+    cursor, posts: Iterable[Tuple[str, str]]
+) -> Dict[Tuple[str, str], np.ndarray]:
+    """Color histograms of current version for (sub_name, post_id) pairs that have one"""
+    posts = list(posts)
+    if not posts:
+        return {}
+
+    query = """SELECT sub_name, post_id, color_hist FROM image_features
+            WHERE version = %s AND (sub_name, post_id) IN
+            (SELECT * FROM unnest(%s::text[], %s::text[]))"""
+    cursor.execute(
+        query,
+        (
+            FEATURES_VERSION,
+            [sub_name for sub_name, _ in posts],
+            [post_id for _, post_id in posts],
+        ),
+    )
+    return {
+        (sub_name, post_id): np.frombuffer(bytes(hist), dtype="<f4").astype(np.float32)
+        for sub_name, post_id, hist in cursor.fetchall()
+    }
+
+
+def parse_static_file_name(file_name: str) -> Optional[Tuple[str, str]]:
+    """'awwnime_abc123.jpg' -> ('awwnime', 'abc123'), subreddit names may contain '_'"""
+    stem = os.path.splitext(file_name)[0]
+    sub_name, _, post_id = stem.rpartition("_")
+    if not sub_name or not post_id:
+        return None
+    return sub_name, post_id
@@ -3,14 +3,23 @@ Find similar images using opencv by using correlation between color histograms
 """
 import glob
 import os
-from typing import Optional
+from typing import Dict, List, Optional
 
 import cv2
 import h5py
 import matplotlib
+import numpy as np
+import psycopg2
 from dotenv import find_dotenv, load_dotenv
 from PIL import Image
 
+try:
+    from image_features import load_histograms, parse_static_file_name
+    from postgres import connect_to_db
+except ModuleNotFoundError:
+    from src.image_features import load_histograms, parse_static_file_name
+    from src.postgres import connect_to_db
+
 load_dotenv(find_dotenv(raise_error_if_not_found=True))
 STATIC_PATH = os.getenv("STATIC_FOLDER_PATH")
 
@@ -35,18 +44,56 @@ def _get_hist_for_file(img_path):
 import pathlib
 
 
-def generate_hist_cache() -> None:
+def get_stored_histograms(file_names: List[str], conn=None) -> Dict[str, np.ndarray]:
+    """Histograms the scraper computed when it checked the pictures (image_features table),
+    by static file name. Empty if the database can't be reached.
+    """
+    posts = {}
+    for file_name in file_names:
+        post = parse_static_file_name(file_name)
+        if post is not None:
+            posts[post] = file_name
+
+    if not posts:
+        return {}
+
+    try:
+        connection = conn or connect_to_db()
+        with connection.cursor() as cursor:
+            histograms = load_histograms(cursor, posts.keys())
+        if conn is None:
+            connection.close()
+    except psycopg2.Error as ex:
+        print(f"Couldnt load stored histograms: {ex}")
+        return {}
+
+    return {posts[post]: hist for post, hist in histograms.items()}
+
+
+def generate_hist_cache(conn=None) -> None:
     """Store histograms in an HDF5 storage for future re-use during similar image search.
     This was necessary because i was running into memory errors otherwise.
+    Histograms stored by the scraper are used, only the other pictures are read from disk.
     """
     static_folder = "./static/*.jpg"
     static_images = glob.glob(static_folder)
 
     with h5py.File("cache_dict.h5", "a", libver="latest") as f:
-        for img_path in static_images:
+        new_images = [
+            img_path
+            for img_path in static_images
+            if "dict/" + pathlib.Path(img_path).name not in f
+        ]
+        stored_histograms = get_stored_histograms(
+            [pathlib.Path(img_path).name for img_path in new_images], conn
+        )
+
+        for img_path in new_images:
             p = pathlib.Path(img_path)
             file_name = p.name
-            hist = _get_hist_for_file(str(img_path))
+            hist = stored_histograms.get(file_name)
+            if hist is None:
+                hist = _get_hist_for_file(str(img_path))
             if hist is not None:
                 try:
                     f.create_dataset(
@@ -1,6 +1,134 @@
-from imagehash import phash
+"""
+Perceptual hashing of many pictures at once.
+Pictures are shrunk one by one (PIL), then the DCTs and medians of all thumbnails
+are computed in one numpy pass. Hashes are bit-identical to str(imagehash.phash(im)),
+so they can be compared with the phash values already in my_app_redditpost.
+
+Draft mode decodes JPEGs at 1/2 to 1/8 of their resolution (DCT scaling), which is
+several times faster for big pictures. The thumbnail is then made from fewer pixels,
+so the hash is NOT bit-identical: usually 0-2 bits differ, well within the
+near duplicate radius of the scraper (4 bits). Verify mode computes both hashes,
+returns the exact one and reports the difference, to check draft mode on real pictures:
+    python src/img_helper.py --verify pic1.jpg pic2.jpg ...
+"""
+import sys
+from pathlib import Path
+from typing import BinaryIO, Iterable, List, Tuple, Union
+
+import numpy as np
+import scipy.fftpack
 from PIL import Image
 
-img = Image.open("img.jpg")
-img_hash = str(phash(img))
-print(img_hash)
+HASH_SIZE = 8
+HIGHFREQ_FACTOR = 4
+THUMBNAIL_SIZE = HASH_SIZE * HIGHFREQ_FACTOR
+
+PHASH_MODES = ("exact", "draft", "verify")
+
+# imagehash.phash resizes with LANCZOS, called ANTIALIAS before Pillow 9.1,
+# the constant isn't taken from imagehash, which only has it from 4.3 on
+LANCZOS = getattr(Image, "Resampling", Image).LANCZOS
+
+# draft decodes are at least this big, so LANCZOS still has 8x8 pixels per thumbnail pixel
+DRAFT_MIN_SIZE = 8 * THUMBNAIL_SIZE
+
+
+def phash_thumbnail(image: Image.Image) -> np.ndarray:
+    """Grayscale 32x32 thumbnail, exactly like imagehash.phash makes it"""
+    thumbnail = image.convert("L").resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), LANCZOS)
+    return np.asarray(thumbnail)
+
+
+def draft_thumbnail(image: Image.Image) -> np.ndarray:
+    """Like phash_thumbnail, but JPEGs are decoded at reduced resolution, straight to grayscale.
+    Must be called before the image is loaded, other formats are decoded fully.
+    """
+    if image.format == "JPEG":
+        image.draft("L", (DRAFT_MIN_SIZE, DRAFT_MIN_SIZE))
+    return phash_thumbnail(image)
+
+
+def phash_thumbnails(thumbnails: np.ndarray) -> List[str]:
+    """Hash a stack of thumbnails.
+
+    Args:
+        thumbnails (np.ndarray): uint8 array of shape (N, 32, 32)
+
+    Returns:
+        List[str]: hex phash of every thumbnail
+    """
+    if len(thumbnails) == 0:
+        return []
+
+    # same transforms as imagehash, applied to every thumbnail of the stack
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(thumbnails, axis=1), axis=2)
+    lowfreq = dct[:, :HASH_SIZE, :HASH_SIZE].reshape(len(thumbnails), -1)
+    medians = np.median(lowfreq, axis=1)
+    bits = lowfreq > medians[:, np.newaxis]
+
+    # 64 bits -> 8 bytes, most significant bit first, same as ImageHash.__str__
+    return [row.tobytes().hex() for row in np.packbits(bits, axis=1)]
+
+
+def phash_batch(images: Iterable[Image.Image]) -> List[str]:
+    """Same as [str(imagehash.phash(im)) for im in images], but with one vectorized DCT"""
+    thumbnails = [phash_thumbnail(image) for image in images]
+    if not thumbnails:
+        return []
+    return phash_thumbnails(np.stack(thumbnails))
+
+
+def phash_files(paths: Iterable[Union[str, Path]]) -> List[str]:
+    """Hash picture files, opening them one at a time"""
+    thumbnails = []
+    for path in paths:
+        with Image.open(path) as image:
+            thumbnails.append(phash_thumbnail(image))
+
+    if not thumbnails:
+        return []
+    return phash_thumbnails(np.stack(thumbnails))
+
+
+def phash_image(image: Image.Image, draft: bool = False) -> str:
+    """phash of a single opened (not yet loaded) picture"""
+    thumbnail = draft_thumbnail(image) if draft else phash_thumbnail(image)
+    return phash_thumbnails(thumbnail[np.newaxis])[0]
+
+
+def hamming_distance(phash: str, other: str) -> int:
+    return bin(int(phash, 16) ^ int(other, 16)).count("1")
+
+
+def verify_draft_phash(file: Union[str, Path, BinaryIO]) -> Tuple[str, str, int]:
+    """Hash a picture both ways.
+
+    Returns:
+        Tuple[str, str, int]: exact phash, draft phash, amount of differing bits
+    """
+    with Image.open(file) as image:
+        draft = phash_image(image, draft=True)
+    if hasattr(file, "seek"):
+        file.seek(0)
+    with Image.open(file) as image:
+        exact = phash_image(image)
+    return exact, draft, hamming_distance(exact, draft)
+
+
+if __name__ == "__main__":
+    # python src/img_helper.py [--verify] img.jpg [more.jpg ...]
+    files = [arg for arg in sys.argv[1:] if arg != "--verify"] or ["img.jpg"]
+    if "--verify" not in sys.argv:
+        for file_name, img_hash in zip(files, phash_files(files)):
+            print(file_name, img_hash)
+        sys.exit()
+
+    distances = []
+    for file_name in files:
+        exact, draft, distance = verify_draft_phash(file_name)
+        distances.append(distance)
+        print(f"{file_name} exact {exact} draft {draft} distance {distance}")
+    print(
+        f"{sum(1 for d in distances if d == 0)}/{len(distances)} identical, "
+        f"max distance {max(distances)}"
+    )
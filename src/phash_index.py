@@ -0,0 +1,130 @@
+"""
+Multi-index hashing of 64 bit phashes, to find reposts whose phash differs in a few bits.
+The hashes are split into {radius + 1} chunks. Two hashes within {radius} bits of each other
+have at least one identical chunk (pigeonhole), so candidates are found with a binary search
+per chunk and only those are compared bit by bit.
+Everything lives in a few numpy arrays, with radius >= 3 that is 8 bytes per hash
+plus 6 bytes per hash and chunk.
+"""
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+HASH_BITS = 64
+
+# hashes added after the index was built are compared one by one, until there are this many
+REBUILD_AFTER = 1000
+
+# popcount of every byte value
+_BYTE_BITS = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def phashes_to_array(phashes: Iterable[str]) -> np.ndarray:
+    """16 char hex phashes -> uint64 array"""
+    joined = "".join(phashes)
+    return np.frombuffer(bytes.fromhex(joined), dtype=">u8").astype(np.uint64)
+
+
+def hamming_distances(hashes: np.ndarray, value: int) -> np.ndarray:
+    """Amount of differing bits between every hash and value"""
+    xor = np.bitwise_xor(hashes, np.uint64(value))
+    return _BYTE_BITS[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def chunk_bounds(radius: int) -> List[Tuple[int, int]]:
+    """(shift, bits) of {radius + 1} chunks that cover all 64 bits"""
+    amount = radius + 1
+    bounds = []
+    start = 0
+    for number in range(amount):
+        bits = HASH_BITS // amount + (1 if number < HASH_BITS % amount else 0)
+        bounds.append((start, bits))
+        start += bits
+    return bounds
+
+
+def chunk_dtype(bits: int) -> type:
+    for dtype in (np.uint16, np.uint32):
+        if bits <= np.iinfo(dtype).bits:
+            return dtype
+    return np.uint64
+
+
+class PhashIndex:
+    """Find a known phash within {radius} bits of a new one.
+
+    Example:
+        index = PhashIndex(["a1b2c3d4e5f60718", ...], radius=4)
+        index.find("a1b2c3d4e5f60719")  # ("a1b2c3d4e5f60718", 1)
+    """
+
+    def __init__(self, phashes: Iterable[str] = (), radius: int = 4):
+        if not 0 <= radius < HASH_BITS // 2:
+            raise ValueError(f"radius must be between 0 and {HASH_BITS // 2 - 1}")
+
+        self.radius = radius
+        self.bounds = chunk_bounds(radius)
+        self._lock = threading.Lock()
+        self._pending: List[int] = []
+        self._build(np.unique(phashes_to_array(phashes)))
+
+    @classmethod
+    def from_db(cls, cursor, radius: int = 4) -> "PhashIndex":
+        """Index phashes of all valid pictures in my_app_redditpost"""
+        cursor.execute("""SELECT DISTINCT phash FROM my_app_redditpost
+            WHERE phash IS NOT NULL AND wrong_format = false""")
+        return cls((phash for phash, in cursor.fetchall()), radius=radius)
+
+    def _build(self, hashes: np.ndarray) -> None:
+        self.hashes = hashes
+        self.chunks = []
+        for shift, bits in self.bounds:
+            mask = np.uint64((1 << bits) - 1)
+            values = ((hashes >> np.uint64(shift)) & mask).astype(chunk_dtype(bits))
+            order = np.argsort(values, kind="stable").astype(np.uint32)
+            self.chunks.append((values[order], order))
+
+    def __len__(self) -> int:
+        return len(self.hashes) + len(self._pending)
+
+    def _candidates(self, value: int) -> np.ndarray:
+        found = []
+        for (shift, bits), (values, order) in zip(self.bounds, self.chunks):
+            # same dtype as the array, otherwise numpy converts the whole array
+            chunk = values.dtype.type((value >> shift) & ((1 << bits) - 1))
+            left = np.searchsorted(values, chunk, side="left")
+            right = np.searchsorted(values, chunk, side="right")
+            found.append(order[left:right])
+        return self.hashes[np.unique(np.concatenate(found))]
+
+    def find(self, phash: str) -> Optional[Tuple[str, int]]:
+        """Closest known phash within the radius.
+
+        Returns:
+            Optional[Tuple[str, int]]: (phash, distance) or None
+        """
+        value = int(phash, 16)
+        with self._lock:
+            candidates = self._candidates(value)
+            if self._pending:
+                candidates = np.concatenate(
+                    [candidates, np.array(self._pending, dtype=np.uint64)]
+                )
+
+        if len(candidates) == 0:
+            return None
+
+        distances = hamming_distances(candidates, value)
+        best = int(np.argmin(distances))
+        if distances[best] > self.radius:
+            return None
+        return f"{int(candidates[best]):016x}", int(distances[best])
+
+    def add(self, phash: str) -> None:
+        with self._lock:
+            self._pending.append(int(phash, 16))
+            if len(self._pending) >= REBUILD_AFTER:
+                pending = np.array(self._pending, dtype=np.uint64)
+                self._pending = []
+                self._build(np.unique(np.concatenate([self.hashes, pending])))
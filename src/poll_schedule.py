@@ -0,0 +1,116 @@
+"""
+Adaptive polling of subreddits.
+The post rate of every subreddit is measured from created_utc of its posts in db,
+busy subreddits are polled often with small fetches and quiet ones rarely,
+always early enough that no post falls out of reddit's 1000 post listing.
+"""
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+HOUR = 3600
+
+# reddit listings don't go deeper than this
+LISTING_WINDOW = 1000
+
+
+@dataclass
+class PollPolicy:
+    """
+    Args:
+        posts_per_poll (int): aim for this many new posts per poll
+        safety_factor (float): fetch this many times the expected amount of posts
+        min_interval (int): seconds
+        max_interval (int): seconds
+        min_amount (int): smallest fetch, one listing request gives up to 100 posts anyway
+        history_days (int): post rate is measured over this many days
+    """
+
+    posts_per_poll: int = 100
+    safety_factor: float = 2.0
+    min_interval: int = 1 * HOUR
+    max_interval: int = 7 * 24 * HOUR
+    min_amount: int = 100
+    history_days: int = 14
+
+
+@dataclass
+class PollPlan:
+    sub_name: str
+    posts_per_hour: float
+    interval: int
+    amount: int
+
+
+def plan_poll(
+    sub_name: str, posts_per_hour: float, policy: PollPolicy = PollPolicy()
+) -> PollPlan:
+    """Next poll interval and fetch size for a subreddit with the given post rate"""
+    rate = posts_per_hour / HOUR  # posts per second
+
+    if rate > 0:
+        interval = policy.posts_per_poll / rate
+        # even with the safety factor the listing window must not be exceeded
+        interval = min(interval, LISTING_WINDOW / (rate * policy.safety_factor))
+    else:
+        interval = policy.max_interval
+    interval = int(min(max(interval, policy.min_interval), policy.max_interval))
+
+    amount = math.ceil(rate * interval * policy.safety_factor)
+    amount = min(max(amount, policy.min_amount), LISTING_WINDOW)
+
+    return PollPlan(sub_name, posts_per_hour, interval, amount)
+
+
+def get_post_rates(
+    cursor, sub_names: List[str], history_days: int, now: Optional[float] = None
+) -> Dict[str, float]:
+    """Posts per hour of every subreddit over the last {history_days},
+    subreddits that are younger than that are measured since their first post.
+    """
+    now = time.time() if now is None else now
+    since = int(now - history_days * 24 * HOUR)
+    query = """SELECT sub_name, count(*), min(CAST(created_utc AS BIGINT))
+            FROM my_app_redditpost
+            WHERE sub_name = ANY(%s) AND CAST(created_utc AS BIGINT) >= %s
+            GROUP BY sub_name"""
+
+    cursor.execute(query, (sub_names, since))
+    rates = {sub_name: 0.0 for sub_name in sub_names}
+    for sub_name, amount, first in cursor.fetchall():
+        hours = max(now - max(first, since), HOUR) / HOUR
+        rates[sub_name] = amount / hours
+    return rates
+
+
+def get_due_subreddits(cursor, sub_names: List[str]) -> Dict[str, Optional[int]]:
+    """Subreddits whose next poll time has come, with their planned fetch size.
+    Subreddits without a schedule are due, with an amount of None.
+    """
+    query = """SELECT sub_name, fetch_amount, next_poll <= now() FROM subreddit_schedule
+            WHERE sub_name = ANY(%s)"""
+
+    cursor.execute(query, (sub_names,))
+    scheduled = {sub_name: (amount, due) for sub_name, amount, due in cursor.fetchall()}
+
+    due_subs = {}
+    for sub_name in sub_names:
+        if sub_name not in scheduled:
+            due_subs[sub_name] = None
+        elif scheduled[sub_name][1]:
+            due_subs[sub_name] = scheduled[sub_name][0]
+    return due_subs
+
+
+def save_poll_plan(cursor, plan: PollPlan) -> None:
+    query = """INSERT INTO subreddit_schedule
+            (sub_name, posts_per_hour, fetch_amount, last_poll, next_poll)
+            VALUES (%s, %s, %s, now(), now() + %s * interval '1 second')
+            ON CONFLICT (sub_name) DO UPDATE SET
+            posts_per_hour = EXCLUDED.posts_per_hour, fetch_amount = EXCLUDED.fetch_amount,
+            last_poll = EXCLUDED.last_poll, next_poll = EXCLUDED.next_poll"""
+
+    cursor.execute(
+        query, (plan.sub_name, plan.posts_per_hour, plan.amount, plan.interval)
+    )
@@ -0,0 +1,135 @@
+"""
+Cheap checks of a picture url before it is downloaded.
+One ranged GET gives the content type, the full size and the first few KB of the file,
+which is enough to read the dimensions from the image header.
+Pictures that would be rejected after the download anyway are rejected without fetching the body.
+"""
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import requests
+from PIL import ImageFile
+
+# accepted width + height of a picture, exclusive
+MIN_DIMENSIONS_SUM = 500
+MAX_DIMENSIONS_SUM = 14000
+
+# same as gallery-dl's filesize-min
+MIN_FILESIZE = 20 * 1024
+
+# jpeg/png headers are tiny, but exif/icc blocks before the size can take a few KB
+HEADER_BYTES = 64 * 1024
+
+# same as the image-filter of gallery-dl
+ACCEPTED_CONTENT_TYPES = ("image/jpeg", "image/png", "image/webp")
+
+# media, anything else is a gallery page or unknown
+MEDIA_CONTENT_TYPES = ("video/", "audio/", "image/")
+
+
+@dataclass
+class PreflightResult:
+    ok: bool
+    reason: str = ""
+    content_type: Optional[str] = None
+    content_length: Optional[int] = None
+    size: Optional[Tuple[int, int]] = None
+
+
+def get_total_length(response: requests.Response) -> Optional[int]:
+    """Full size of the file, from Content-Range of a partial response or Content-Length"""
+    if response.status_code == 206:
+        content_range = response.headers.get("Content-Range", "")
+        total = content_range.rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+
+    length = response.headers.get("Content-Length", "")
+    return int(length) if length.isdigit() else None
+
+
+def read_image_size(response: requests.Response) -> Optional[Tuple[int, int]]:
+    """Feed the beginning of the body to PIL until it knows the image size"""
+    parser = ImageFile.Parser()
+    read = 0
+    for chunk in response.iter_content(chunk_size=4096):
+        parser.feed(chunk)
+        if parser.image is not None:
+            return parser.image.size
+
+        read += len(chunk)
+        if read >= HEADER_BYTES:
+            break
+    return None
+
+
+def preflight_check(
+    url: str,
+    session: Optional[requests.Session] = None,
+    timeout: float = 7,
+) -> PreflightResult:
+    """Check a picture url without downloading the whole file.
+
+    Only answers that are certain reject the url: non picture content types,
+    too small/big files and bad dimensions. Gallery pages (html), unknown answers
+    and network errors pass, so gallery-dl still gets a chance with them.
+
+    Args:
+        url (str): url of the picture or gallery
+        session (Optional[requests.Session], optional): session to reuse connections,
+            without one a session is opened and closed for this check. Defaults to None.
+        timeout (float, optional): seconds for connecting and each read. Defaults to 7.
+
+    Returns:
+        PreflightResult: ok=False with a reason if the picture would be rejected anyway
+    """
+    if session is None:
+        with requests.Session() as session:
+            return preflight_check(url, session, timeout)
+
+    try:
+        with session.get(
+            url,
+            headers={"Range": f"bytes=0-{HEADER_BYTES - 1}"},
+            stream=True,
+            timeout=timeout,
+            allow_redirects=True,
+        ) as response:
+            if response.status_code >= 400:
+                return PreflightResult(True, f"status {response.status_code}")
+
+            content_type = (
+                response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+            )
+            result = PreflightResult(
+                True,
+                content_type=content_type,
+                content_length=get_total_length(response),
+            )
+
+            if not content_type.startswith(MEDIA_CONTENT_TYPES):
+                # html gallery page or something else gallery-dl knows better
+                result.reason = "not a direct picture"
+                return result
+
+            if content_type not in ACCEPTED_CONTENT_TYPES:
+                result.ok, result.reason = False, f"content type {content_type}"
+                return result
+
+            length = result.content_length
+            if length is not None and length < MIN_FILESIZE:
+                result.ok, result.reason = False, f"file is too small ({length} bytes)"
+                return result
+
+            result.size = read_image_size(response)
+    except requests.exceptions.RequestException as ex:
+        return PreflightResult(True, f"request failed: {ex!r}")
+    except Exception as ex:
+        # broken header, the full download decides
+        return PreflightResult(True, f"unreadable header: {ex!r}")
+
+    if result.size is not None:
+        width, height = result.size
+        if not MIN_DIMENSIONS_SUM < width + height < MAX_DIMENSIONS_SUM:
+            result.ok, result.reason = False, f"wrong dimensions {width}x{height}"
+
+    return result
@@ -0,0 +1,225 @@
+"""
+Small thread based pipeline: a producer and a chain of stages connected by bounded queues.
+Items flow through the stages as soon as they are ready, so memory is bounded by
+the queue sizes instead of the amount of items, and every stage keeps throughput counters.
+"""
+import queue
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, List, Optional
+
+# marks the end of the stream in a queue
+_DONE = object()
+
+
+@dataclass
+class StageCounter:
+    name: str
+    processed: int = 0
+    failed: int = 0
+    busy_seconds: float = 0.0
+    started: float = field(default_factory=time.monotonic)
+    finished: Optional[float] = None
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, seconds: float, amount: int = 1, failed: bool = False) -> None:
+        with self._lock:
+            self.busy_seconds += seconds
+            if failed:
+                self.failed += amount
+            else:
+                self.processed += amount
+
+    @property
+    def elapsed(self) -> float:
+        end = self.finished if self.finished is not None else time.monotonic()
+        return max(end - self.started, 1e-9)
+
+    @property
+    def throughput(self) -> float:
+        """processed items per second of wall time"""
+        return self.processed / self.elapsed
+
+    def __str__(self):
+        return (
+            f"{self.name}: {self.processed} done, {self.failed} failed, "
+            f"{self.throughput:.2f}/s, busy {self.busy_seconds:.1f}s"
+        )
+
+
+class _Stage:
+    def __init__(
+        self,
+        name: str,
+        func: Callable,
+        workers: int,
+        queue_size: int,
+        batch_size: Optional[int] = None,
+        flush_interval: float = 5.0,
+    ):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.input: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.output: Optional[queue.Queue] = None
+        self.counter = StageCounter(name)
+        self.threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        target = self._run_batches if self.batch_size else self._run_items
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=target, name=f"{self.name}-{number}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def join(self) -> None:
+        for thread in self.threads:
+            thread.join()
+        self.counter.finished = time.monotonic()
+        if self.output is not None:
+            self.output.put(_DONE)
+
+    def _call(self, arg: Any, amount: int = 1) -> Any:
+        start = time.monotonic()
+        try:
+            result = self.func(arg)
+        except Exception:
+            print(f"{self.name} stage failed:")
+            traceback.print_exc()
+            self.counter.add(time.monotonic() - start, amount, failed=True)
+            return None
+        self.counter.add(time.monotonic() - start, amount)
+        return result
+
+    def _run_items(self) -> None:
+        while True:
+            item = self.input.get()
+            if item is _DONE:
+                # let the other workers of this stage see it too
+                self.input.put(_DONE)
+                return
+
+            result = self._call(item)
+            # returning None drops the item
+            if result is not None and self.output is not None:
+                self.output.put(result)
+
+    def _run_batches(self) -> None:
+        batch: list = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self.input.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+
+            if item is _DONE:
+                if batch:
+                    self._call(batch, len(batch))
+                self.input.put(_DONE)
+                return
+
+            if item is not None:
+                batch.append(item)
+
+            if batch and (
+                len(batch) >= self.batch_size or time.monotonic() >= deadline
+            ):
+                self._call(batch, len(batch))
+                batch = []
+
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.flush_interval
+
+
+class Pipeline:
+    """Chain of stages connected by bounded queues.
+
+    Example:
+        pipeline = Pipeline(queue_size=20)
+        pipeline.add_stage("download", download, workers=8)
+        pipeline.add_stage("hash", phash, workers=2)
+        pipeline.add_batch_stage("db", insert_rows, batch_size=50)
+        pipeline.run(submissions)
+    """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self.stages: List[_Stage] = []
+        self.producer_counter = StageCounter("producer")
+
+    def add_stage(self, name: str, func: Callable, workers: int = 1) -> "Pipeline":
+        """func gets one item and returns the item for the next stage, None drops it"""
+        self._append(_Stage(name, func, max(workers, 1), self.queue_size))
+        return self
+
+    def add_batch_stage(
+        self,
+        name: str,
+        func: Callable[[list], Any],
+        batch_size: int = 50,
+        flush_interval: float = 5.0,
+    ) -> "Pipeline":
+        """Final stage that gets lists of up to {batch_size} items,
+        a partial batch is flushed after {flush_interval} seconds.
+        """
+        self._append(
+            _Stage(
+                name,
+                func,
+                1,
+                self.queue_size,
+                batch_size=batch_size,
+                flush_interval=flush_interval,
+            )
+        )
+        return self
+
+    def _append(self, stage: _Stage) -> None:
+        if self.stages:
+            self.stages[-1].output = stage.input
+        self.stages.append(stage)
+
+    @property
+    def counters(self) -> List[StageCounter]:
+        return [self.producer_counter] + [stage.counter for stage in self.stages]
+
+    def run(self, items: Iterable) -> List[StageCounter]:
+        """Feed items through all stages and wait until everything is processed.
+        Exceptions raised by the producer (items iterator) are re-raised after the stages drain.
+        """
+        if not self.stages:
+            raise ValueError("Pipeline has no stages")
+
+        producer_error: List[BaseException] = []
+
+        def produce():
+            try:
+                for item in items:
+                    self.producer_counter.add(0.0)
+                    self.stages[0].input.put(item)
+            except BaseException as ex:
+                producer_error.append(ex)
+            finally:
+                self.producer_counter.finished = time.monotonic()
+                self.stages[0].input.put(_DONE)
+
+        for stage in self.stages:
+            stage.start()
+
+        producer = threading.Thread(target=produce, name="producer", daemon=True)
+        producer.start()
+        producer.join()
+
+        for stage in self.stages:
+            stage.join()
+
+        if producer_error:
+            raise producer_error[0]
+        return self.counters
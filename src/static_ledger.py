@@ -0,0 +1,113 @@
+"""
+Size of the static folder kept in the database, so it is read without walking the folder.
+Whatever adds or deletes files in the static folder records it here,
+the static_file table has the size of every file
+and a trigger keeps its sum in static_folder (sql_commands/static_file_ledger.sql).
+Files changed behind its back (by hand, crashes) are picked up by a full scan
+once the last one is older than RECONCILE_EVERY.
+"""
+import datetime
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+RECONCILE_EVERY = datetime.timedelta(days=1)
+
+
+def get_file_name(folder: str, path: Path) -> str:
+    """Name of the file in the ledger, its path relative to {folder}"""
+    return Path(path).relative_to(folder).as_posix()
+
+
+def record_file(conn, folder: str, path: Path) -> None:
+    """Add the file to the ledger or update its size"""
+    size = Path(path).stat().st_size
+    with conn:
+        with conn.cursor() as cursor:
+            query = """INSERT INTO static_file (file_name, size) VALUES (%s, %s)
+                       ON CONFLICT (file_name) DO UPDATE SET size=EXCLUDED.size
+                       WHERE static_file.size <> EXCLUDED.size"""
+            cursor.execute(query, (get_file_name(folder, path), size))
+
+
+def forget_files(conn, folder: str, paths: Iterable[Path]) -> None:
+    """Remove deleted files from the ledger"""
+    file_names = [get_file_name(folder, path) for path in paths]
+    if not file_names:
+        return
+    with conn:
+        with conn.cursor() as cursor:
+            query = """DELETE FROM static_file WHERE file_name = ANY(%s)"""
+            cursor.execute(query, (file_names,))
+
+
+def scan_folder(folder: str) -> Dict[str, int]:
+    """Size of every file in {folder} and its subfolders, by ledger name"""
+    sizes = {}
+    for root, _, files in os.walk(folder):
+        for name in files:
+            path = Path(root, name)
+            try:
+                sizes[get_file_name(folder, path)] = path.stat().st_size
+            except FileNotFoundError:  # deleted during the scan
+                continue
+    return sizes
+
+
+def plan_reconcile(
+    scanned: Dict[str, int], recorded: Dict[str, int]
+) -> Tuple[Dict[str, int], List[str]]:
+    """Rows to upsert and rows to delete, so that the ledger matches the scan
+
+    Returns:
+        Tuple[Dict[str, int], List[str]]: new or resized files, files that are gone
+    """
+    changed = {
+        name: size for name, size in scanned.items() if recorded.get(name) != size
+    }
+    removed = [name for name in recorded if name not in scanned]
+    return changed, removed
+
+
+def reconcile(conn, folder: str) -> int:
+    """Scan {folder} and correct the ledger, returns the folder size"""
+    scanned = scan_folder(folder)
+    with conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT file_name, size FROM static_file")
+            recorded = dict(cursor.fetchall())
+            changed, removed = plan_reconcile(scanned, recorded)
+            if changed:
+                cursor.executemany(
+                    """INSERT INTO static_file (file_name, size) VALUES (%s, %s)
+                       ON CONFLICT (file_name) DO UPDATE SET size=EXCLUDED.size""",
+                    list(changed.items()),
+                )
+            if removed:
+                cursor.execute(
+                    "DELETE FROM static_file WHERE file_name = ANY(%s)", (removed,)
+                )
+            # also repairs a total that drifted from its rows
+            query = """UPDATE static_folder SET reconciled_at=now(),
+                       total_size=(SELECT COALESCE(SUM(size), 0) FROM static_file)"""
+            cursor.execute(query)
+
+    if changed or removed:
+        print(f"Static ledger: {len(changed)} files updated, {len(removed)} removed")
+    return sum(scanned.values())
+
+
+def get_folder_size(conn, folder: str) -> int:
+    """Size of the static folder in bytes, a full scan only if the last one is too old"""
+    with conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """SELECT total_size, reconciled_at IS NULL OR reconciled_at < now() - %s
+                   FROM static_folder""",
+                (RECONCILE_EVERY,),
+            )
+            total_size, is_stale = cursor.fetchone()
+
+    if is_stale:
+        return reconcile(conn, folder)
+    return total_size
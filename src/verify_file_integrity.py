@@ -12,6 +12,7 @@ from postgres import (
     get_downloaded_posts,
 )
 from models import IdentifiedRedditPost
+from static_ledger import forget_files
 from pathlib import Path
 import os
 
@@ -24,6 +25,7 @@ STATIC_FOLDER_PATH = os.getenv("STATIC_FOLDER_PATH")
 def verify_downloaded_files():
     conn = connect_to_db()
     database_marked_downloaded_files = get_downloaded_posts(conn)
+    missing_files = []
     for post_info in database_marked_downloaded_files:
         reddit_post = IdentifiedRedditPost(
             post_id=post_info[0],
@@ -40,6 +42,7 @@ def verify_downloaded_files():
         current_file = Path(STATIC_FOLDER_PATH, reddit_post.get_image_name())
         if not current_file.is_file():
             print(f"File DOESNT EXIST: {str(current_file)}")
+            missing_files.append(current_file)
             set_downloaded_status_by_post_id_and_phash(
                 conn,
                 status=False,
@@ -47,6 +50,9 @@ def verify_downloaded_files():
                 sub_name=reddit_post.sub_name,
             )
 
+    # in case it was deleted without the static folder ledger noticing
+    forget_files(conn, STATIC_FOLDER_PATH, missing_files)
+
     if conn:
         conn.commit()
         conn.close()
@@ -25,6 +25,7 @@ try:
         insert_vk_record,
         set_downloaded_status_by_phash,
     )
+    from static_ledger import forget_files
     from tags_resolver import convert_tags_to_vk_string
     from vk_helper import (
         get_latest_post_date_and_total_post_count,
@@ -46,6 +47,7 @@ except ModuleNotFoundError:
         insert_vk_record,
         set_downloaded_status_by_phash,
     )
+    from src.static_ledger import forget_files
     from src.tags_resolver import convert_tags_to_vk_string
     from src.vk_helper import (
         get_latest_post_date_and_total_post_count,
@@ -267,12 +269,21 @@ class VkPost:
             for post in self.similar_posts
         ]
 
+        deleted_paths = []
         for path in similar_img_paths:
             try:
                 os.remove(path)
+            except FileNotFoundError:
+                deleted_paths.append(path)
             except OSError:
                 print(f"Couldnt delete file {path}")
                 pass
+            else:
+                deleted_paths.append(path)
+
+        conn = connect_to_db()
+        forget_files(conn, STATIC_PATH, deleted_paths)
+        conn.close()
 
     def _get_main_post_message(self, filtered_reddit_posts: list[IdentifiedRedditPost]):
         if not filtered_reddit_posts:
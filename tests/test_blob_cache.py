@@ -0,0 +1,55 @@
+import os
+
+from PIL import Image
+
+from src.blob_cache import BlobCache
+
+# pytest -x ./tests/test_blob_cache.py
+
+
+def test_put_get_take(tmp_path):
+    cache = BlobCache(str(tmp_path / "cache"))
+    url = "https://i.redd.it/abc.jpg"
+    assert cache.get(url) is None
+
+    cache.put_image(url, Image.new("RGBA", (64, 64), (255, 0, 0, 255)))
+    cached = cache.get(url)
+    assert cached is not None
+    with Image.open(cached) as im:
+        assert im.format == "JPEG"
+        assert im.size == (64, 64)
+
+    destination = tmp_path / "awwnime_abc.jpg"
+    assert cache.take(url, destination)
+    assert destination.exists()
+    assert cache.get(url) is None
+    assert not cache.take(url, destination)
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=3500)
+    for number, url in enumerate(["a", "b", "c"]):
+        path = cache.put(url, b"x" * 1000)
+        os.utime(path, (number, number))
+
+    cache.get("a")  # now the most recently used
+    cache.put("d", b"x" * 1000)
+
+    assert cache.get("b") is None
+    assert all(cache.get(url) is not None for url in ["a", "c", "d"])
+    assert cache.size() <= 3500
+
+
+def test_put_scans_only_when_the_estimate_is_over_the_limit(tmp_path, monkeypatch):
+    cache = BlobCache(str(tmp_path), max_bytes=3500)
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, "evict", lambda: scans.append(1) or evict())
+
+    for url in ["a", "b", "c"]:
+        cache.put(url, b"x" * 1000)
+    assert len(scans) == 1  # the first put
+
+    cache.put("d", b"x" * 1000)
+    assert len(scans) == 2
+    assert cache.size() <= 3500
@@ -0,0 +1,197 @@
+import functools
+import http.server
+import os
+import socket
+import threading
+
+import pytest
+from gallery_dl import config
+from PIL import Image
+
+from src.gallery_dl_helper import (
+    GalleryDownloader,
+    download_pic_from_url,
+    download_pic_to_buffer,
+    fetch_direct,
+    fetch_direct_to_buffer,
+    is_direct_image_url,
+    rename_downloaded_file,
+)
+
+# pytest -x ./tests/test_gallery_dl_helper.py
+
+
+@pytest.fixture
+def refusing_host():
+    """Address where nothing listens, connections to it are refused"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+
+@pytest.fixture
+def image_server(tmp_path):
+    """Serve a folder with a couple of images over a local HTTP server"""
+    served = tmp_path / "served"
+    served.mkdir()
+    # random noise, so the file is bigger than gallery-dl's filesize-min
+    Image.frombytes("RGB", (200, 200), os.urandom(200 * 200 * 3)).save(
+        served / "noise.png"
+    )
+    Image.new("RGB", (20, 20)).save(served / "tiny.png")
+
+    handler = functools.partial(
+        http.server.SimpleHTTPRequestHandler, directory=str(served)
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_pic_from_url_returns_written_path(image_server, tmp_path):
+    folder = tmp_path / "download"
+    folder.mkdir()
+    (folder / "older_file.png").write_bytes(b"not the downloaded file")
+
+    paths = download_pic_from_url(f"{image_server}/noise.png", folder=str(folder))
+
+    assert len(paths) == 1
+    assert paths[0].parent == folder
+    assert paths[0].name != "older_file.png"
+    assert paths[0].read_bytes() == (tmp_path / "served" / "noise.png").read_bytes()
+
+
+@pytest.mark.parametrize("download", [download_pic_from_url, fetch_direct])
+def test_same_url_downloads_dont_collide(image_server, tmp_path, download):
+    # crossposts downloaded at once, the second one used to find the first one's file
+    url = f"{image_server}/noise.png"
+    folder = tmp_path / "download"
+    folder.mkdir()
+
+    first = download(url, str(folder))
+    second = download(url, str(folder))
+
+    assert len(first) == len(second) == 1
+    assert first[0] != second[0]
+    assert first[0].read_bytes() == second[0].read_bytes()
+    assert sorted(folder.iterdir()) == sorted([first[0], second[0]])
+
+
+def test_download_pic_from_url_nothing_downloaded(image_server, tmp_path):
+    # smaller than filesize-min, so gallery-dl skips it
+    paths = download_pic_from_url(f"{image_server}/tiny.png", folder=str(tmp_path))
+    assert paths == []
+
+
+def test_rename_downloaded_file(tmp_path):
+    file_path = tmp_path / "random_name.png"
+    file_path.write_bytes(b"data")
+
+    new_path = rename_downloaded_file(file_path, "1600000000_abc")
+
+    assert new_path == tmp_path / "1600000000_abc.png"
+    assert new_path.read_bytes() == b"data"
+    assert not file_path.exists()
+
+
+def test_download_pic_to_buffer(image_server, tmp_path):
+    buffers = download_pic_to_buffer(
+        f"{image_server}/noise.png", spill_folder=str(tmp_path)
+    )
+
+    assert len(buffers) == 1
+    with buffers[0] as buffer:
+        assert not buffer._rolled  # stayed in memory
+        assert buffer.read() == (tmp_path / "served" / "noise.png").read_bytes()
+    assert list(tmp_path.glob("*.png")) == []
+
+
+def test_download_pic_to_buffer_spills_big_files(image_server, tmp_path):
+    buffers = download_pic_to_buffer(
+        f"{image_server}/noise.png", max_memory=1000, spill_folder=str(tmp_path)
+    )
+
+    with buffers[0] as buffer:
+        assert buffer._rolled
+        assert buffer.read() == (tmp_path / "served" / "noise.png").read_bytes()
+
+
+@pytest.mark.parametrize(
+    "url, expected",
+    [
+        ("https://i.redd.it/abc123.jpg", True),
+        ("https://i.imgur.com/AbC.PNG?1", True),
+        ("https://i.imgur.com/AbC.gifv", False),
+        ("https://imgur.com/a/AbC", False),
+        ("https://www.pixiv.net/en/artworks/123", False),
+    ],
+)
+def test_is_direct_image_url(url, expected):
+    assert is_direct_image_url(url) == expected
+
+
+def test_fetch_direct(image_server, tmp_path):
+    paths = fetch_direct(f"{image_server}/noise.png", str(tmp_path))
+
+    assert len(paths) == 1
+    assert paths[0].parent == tmp_path
+    assert paths[0].name.startswith("download-")
+    assert paths[0].name.endswith("_noise.png")
+    assert paths[0].read_bytes() == (tmp_path / "served" / "noise.png").read_bytes()
+
+
+def test_fetch_direct_nothing_downloaded(image_server, tmp_path):
+    folder = tmp_path / "download"
+    folder.mkdir()
+
+    assert fetch_direct(f"{image_server}/tiny.png", str(folder)) == []
+    assert fetch_direct(f"{image_server}/missing.png", str(folder)) == []
+    assert list(folder.iterdir()) == []  # no partial files left behind
+
+
+def test_fetch_direct_to_buffer(image_server, tmp_path):
+    buffers = fetch_direct_to_buffer(f"{image_server}/noise.png", 10**6, None)
+
+    with buffers[0] as buffer:
+        assert buffer.read() == (tmp_path / "served" / "noise.png").read_bytes()
+    assert fetch_direct_to_buffer(f"{image_server}/tiny.png", 10**6, None) == []
+
+
+def test_gallery_downloader_reuses_session(image_server, tmp_path):
+    downloader = GalleryDownloader(str(tmp_path))
+
+    first = downloader.download(f"{image_server}/noise.png")
+    session = downloader.sessions["directlink"]
+    first[0].unlink()
+    second = downloader.download(f"{image_server}/noise.png", str(tmp_path / "other"))
+
+    assert downloader.sessions == {"directlink": session}
+    assert second[0].parent == tmp_path / "other"
+    assert second[0].read_bytes() == (tmp_path / "served" / "noise.png").read_bytes()
+
+
+def test_unreachable_host_raises(refusing_host, tmp_path):
+    folder = tmp_path / "download"
+    folder.mkdir()
+
+    with pytest.raises(ConnectionError):
+        fetch_direct(f"{refusing_host}/noise.png", str(folder))
+    with pytest.raises(ConnectionError):
+        fetch_direct_to_buffer(f"{refusing_host}/noise.png", 10**6, None)
+    assert list(folder.iterdir()) == []
+
+
+def test_gallery_downloader_unreachable_host_raises(refusing_host, tmp_path):
+    downloader = GalleryDownloader(str(tmp_path))
+    config.set((), "retries", 0)
+    try:
+        with pytest.raises(ConnectionError):
+            downloader.download(f"{refusing_host}/noise.png")
+        with pytest.raises(ConnectionError):
+            downloader.download_to_buffer(f"{refusing_host}/noise.png")
+    finally:
+        config.unset((), "retries")
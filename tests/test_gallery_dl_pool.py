@@ -0,0 +1,87 @@
+import os
+import socket
+import time
+
+import pytest
+
+from src.gallery_dl_helper import fetch_direct
+from src.gallery_dl_pool import DownloadTimeout, GalleryDLPool, WorkerDied
+from src.host_policy import HostLimiter, HostUnavailable
+
+# pytest -x ./tests/test_gallery_dl_pool.py
+
+
+@pytest.fixture
+def pool(tmp_path):
+    with GalleryDLPool(workers=2, timeout=1, folder=str(tmp_path)) as pool:
+        yield pool
+
+
+def test_runs_in_worker_process(pool):
+    assert pool.run(os.getpid) != os.getpid()
+    with pytest.raises(ValueError):
+        pool.run(int, "not a number")
+
+
+def test_hung_job_is_killed_and_worker_replaced(pool):
+    started = time.monotonic()
+    with pytest.raises(DownloadTimeout):
+        pool.run(time.sleep, 30)
+    assert time.monotonic() - started < 5
+    assert pool.respawned == 1
+
+    # both workers are usable again
+    futures = [pool.submit(os.getpid) for _ in range(4)]
+    assert all(future.result() for future in futures)
+
+
+def test_crashed_worker_is_replaced(pool):
+    with pytest.raises(WorkerDied):
+        pool.run(os._exit, 1)
+    assert pool.run(int, "7") == 7
+
+
+def test_job_that_does_not_pickle_keeps_workers(pool):
+    for _ in range(3):
+        with pytest.raises(Exception):
+            pool.run(print, lambda: None)
+    assert pool.run(int, "7") == 7
+    assert pool.respawned == 0
+
+
+class TwoArgumentError(Exception):
+    def __init__(self, first, second):
+        super().__init__(f"{first} {second}")
+
+
+def raise_two_argument_error():
+    raise TwoArgumentError(1, 2)  # pickles, but doesn't unpickle
+
+
+def test_result_that_does_not_unpickle_keeps_workers(tmp_path):
+    with GalleryDLPool(workers=1, timeout=2, folder=str(tmp_path)) as pool:
+        with pytest.raises(TypeError):
+            pool.run(raise_two_argument_error)
+        assert pool.run(int, "7") == 7
+        assert pool.respawned == 1
+
+
+def test_dead_host_is_not_run(pool):
+    with pytest.raises(HostUnavailable):
+        pool.run(time.sleep, 30, url="http://minus.com/abc.jpg")
+    assert pool.run(int, "7", url="https://i.redd.it/abc.jpg") == 7
+
+
+def test_unreachable_host_opens_the_breaker(tmp_path):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        url = f"http://127.0.0.1:{sock.getsockname()[1]}/abc.jpg"
+
+    hosts = HostLimiter()
+    hosts.default.failure_threshold = 2
+    with GalleryDLPool(timeout=5, folder=str(tmp_path), hosts=hosts) as pool:
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                pool.run(fetch_direct, url, str(tmp_path), url=url)
+        with pytest.raises(HostUnavailable):
+            pool.run(fetch_direct, url, str(tmp_path), url=url)
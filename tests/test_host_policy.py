@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+
+import pytest
+
+from src.host_policy import (
+    HostLimiter,
+    HostPolicy,
+    HostUnavailable,
+    find_policy,
+    read_breakers,
+)
+
+# pytest -x ./tests/test_host_policy.py
+
+
+def test_find_policy_by_domain_suffix():
+    policies = {"minus.com": HostPolicy(dead=True), "i.imgur.com": HostPolicy(1)}
+    assert find_policy("i.minus.com", policies)[0] == "minus.com"
+    assert find_policy("i.imgur.com", policies)[0] == "i.imgur.com"
+    assert find_policy("imgur.com", policies) == ("imgur.com", None)
+
+
+def test_dead_host_fails_fast():
+    limiter = HostLimiter()
+    with pytest.raises(HostUnavailable):
+        with limiter.slot("http://i.minus.com/abc.jpg"):
+            pytest.fail("dead host was contacted")
+
+
+def test_breaker_opens_after_failures_in_a_row():
+    limiter = HostLimiter(
+        policies={}, default=HostPolicy(failure_threshold=2, cooldown=60)
+    )
+    url = "https://down.example/pic.jpg"
+
+    for _ in range(2):
+        with pytest.raises(TimeoutError):
+            with limiter.slot(url):
+                raise TimeoutError
+    with pytest.raises(HostUnavailable):
+        with limiter.slot(url):
+            pass
+
+    # other hosts are not affected
+    with limiter.slot("https://up.example/pic.jpg"):
+        pass
+
+
+def test_open_breaker_carries_over_to_the_next_run(tmp_path):
+    state_path = str(tmp_path / "breakers.json")
+    policy = HostPolicy(failure_threshold=1, cooldown=60)
+    url = "https://down.example/pic.jpg"
+
+    first_run = HostLimiter(policies={}, default=policy, state_path=state_path)
+    with pytest.raises(TimeoutError):
+        with first_run.slot(url):
+            raise TimeoutError
+
+    # a fresh process, like the downloader started by cron every minute
+    next_run = HostLimiter(policies={}, default=policy, state_path=state_path)
+    with pytest.raises(HostUnavailable, match="failed 1 times"):
+        with next_run.slot(url):
+            pytest.fail("host with an open breaker was contacted")
+    with next_run.slot("https://up.example/pic.jpg"):
+        pass
+
+
+def test_closed_breakers_are_dropped(tmp_path):
+    state_path = tmp_path / "breakers.json"
+    state_path.write_text(
+        json.dumps({"over.example": {"open_until": time.time() - 1, "failures": 3}})
+    )
+    limiter = HostLimiter(
+        policies={}, default=HostPolicy(failure_threshold=1), state_path=str(state_path)
+    )
+
+    with limiter.slot("https://over.example/pic.jpg"):
+        pass
+    with pytest.raises(TimeoutError):
+        with limiter.slot("https://down.example/pic.jpg"):
+            raise TimeoutError
+    assert list(read_breakers(str(state_path))) == ["down.example"]
+
+
+def test_unreadable_breakers_file(tmp_path):
+    state_path = tmp_path / "breakers.json"
+    state_path.write_text("{not json")
+
+    limiter = HostLimiter(policies={}, state_path=str(state_path))
+    with limiter.slot("https://up.example/pic.jpg"):
+        pass
+
+
+def test_success_resets_failures():
+    limiter = HostLimiter(policies={}, default=HostPolicy(failure_threshold=2))
+    url = "https://flaky.example/pic.jpg"
+    for _ in range(3):
+        with pytest.raises(TimeoutError):
+            with limiter.slot(url):
+                raise TimeoutError
+        with limiter.slot(url):
+            pass
+
+
+def test_max_concurrency_and_min_interval():
+    limiter = HostLimiter(
+        policies={"slow.example": HostPolicy(max_concurrency=1, min_interval=0.1)}
+    )
+    running = []
+    starts = []
+
+    def download():
+        with limiter.slot("https://slow.example/pic.jpg"):
+            running.append(1)
+            starts.append(time.monotonic())
+            assert len(running) == 1
+            time.sleep(0.01)
+            running.pop()
+
+    threads = [threading.Thread(target=download) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    starts.sort()
+    assert all(b - a >= 0.09 for a, b in zip(starts, starts[1:]))
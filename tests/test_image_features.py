@@ -0,0 +1,91 @@
+import io
+import os
+
+import imagehash
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from src.image_features import (
+    color_histogram,
+    compute_features,
+    get_file_size,
+    parse_static_file_name,
+)
+
+# pytest -x ./tests/test_image_features.py
+
+
+@pytest.fixture
+def picture(tmp_path):
+    image = Image.linear_gradient("L").resize((900, 600)).convert("RGB")
+    ImageDraw.Draw(image).ellipse((100, 100, 500, 400), fill=(200, 40, 90))
+    path = tmp_path / "awwnime_abc123.jpg"
+    image.save(path, quality=90)
+    return path
+
+
+def test_compute_features(picture):
+    with Image.open(picture) as im:
+        features = compute_features(im, get_file_size(picture))
+
+    with Image.open(picture) as im:
+        assert features.phash == str(imagehash.phash(im))
+        rgb = np.asarray(im.convert("RGB"))
+
+    assert (features.width, features.height) == (900, 600)
+    assert features.file_size == os.path.getsize(picture)
+    assert features.avg_color == tuple(
+        int(round(c)) for c in rgb.reshape(-1, 3).mean(axis=0)
+    )
+    assert features.color_hist.shape == (512,)
+    assert features.color_hist.dtype == np.float32
+    assert np.linalg.norm(features.color_hist) == pytest.approx(1)
+
+
+def test_draft_features_keep_the_real_size(picture):
+    with Image.open(picture) as im:
+        features = compute_features(im, 0, draft=True)
+    assert (features.width, features.height) == (900, 600)
+
+
+def test_color_histogram_matches_opencv(picture):
+    cv2 = pytest.importorskip("cv2")
+    image = cv2.imread(str(picture))
+    expected = cv2.calcHist(
+        [image], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256]
+    )
+    expected = cv2.normalize(expected, expected).flatten()
+
+    rgb = image[..., ::-1]  # opencv decodes to BGR
+    np.testing.assert_allclose(color_histogram(rgb), expected, rtol=1e-5)
+
+
+def test_get_file_size_of_buffers():
+    buffer = io.BytesIO(b"12345")
+    buffer.read(2)
+    assert get_file_size(buffer) == 5
+    assert buffer.tell() == 2
+
+
+@pytest.mark.parametrize(
+    "file_name, post",
+    [
+        ("awwnime_abc123.jpg", ("awwnime", "abc123")),
+        ("artistic_ecchi_x1y2.jpg", ("artistic_ecchi", "x1y2")),
+        ("broken.jpg", None),
+    ],
+)
+def test_parse_static_file_name(file_name, post):
+    assert parse_static_file_name(file_name) == post
+
+
+def test_compute_features_without_imagehash_antialias(picture, monkeypatch):
+    # ImageHash 4.2.1 of poetry.lock has no module level ANTIALIAS
+    with Image.open(picture) as im:
+        expected = str(imagehash.phash(im))
+    monkeypatch.delattr(imagehash, "ANTIALIAS", raising=False)
+
+    with Image.open(picture) as im:
+        features = compute_features(im, get_file_size(picture))
+    assert features.phash == expected
@@ -0,0 +1,89 @@
+import io
+import os
+import random
+
+import imagehash
+from PIL import Image, ImageDraw
+
+from src.img_helper import (
+    phash_batch,
+    phash_files,
+    phash_image,
+    verify_draft_phash,
+)
+
+# pytest -x ./tests/test_img_helper.py
+
+
+def random_images(amount):
+    rng = random.Random(42)
+    images = []
+    for _ in range(amount):
+        width, height = rng.randint(1, 900), rng.randint(1, 900)
+        image = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+        # gradients and flat areas, not only noise
+        image.paste(rng.randint(0, 255), (0, 0, width // 2, height))
+        images.append(image.convert(rng.choice(["RGB", "RGBA", "L", "P", "CMYK"])))
+    images.append(Image.new("RGB", (500, 500), "white"))
+    images.append(Image.linear_gradient("L").resize((640, 480)))
+    return images
+
+
+def test_phash_batch_is_identical_to_imagehash():
+    images = random_images(200)
+    assert phash_batch(images) == [str(imagehash.phash(im)) for im in images]
+
+
+def test_phash_batch_empty():
+    assert phash_batch([]) == []
+
+
+def test_phash_files(tmp_path):
+    paths = []
+    for number, image in enumerate(random_images(5)):
+        path = tmp_path / f"{number}.png"
+        image.convert("RGB").save(path)
+        paths.append(path)
+
+    expected = []
+    for path in paths:
+        with Image.open(path) as im:
+            expected.append(str(imagehash.phash(im)))
+    assert phash_files(paths) == expected
+
+
+def drawn_picture(width, height, seed):
+    """Smooth shapes, closer to the pictures we scrape than noise"""
+    rng = random.Random(seed)
+    image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(20):
+        x, y = rng.randrange(width), rng.randrange(height)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x, y, x + width // 4, y + height // 4), fill=color)
+    return image
+
+
+def encoded(image, format):
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, quality=90)
+    buffer.seek(0)
+    return buffer
+
+
+def test_draft_phash_is_close_for_jpegs():
+    for seed in range(10):
+        buffer = encoded(drawn_picture(2400, 1600, seed), "JPEG")
+        exact, draft, distance = verify_draft_phash(buffer)
+
+        buffer.seek(0)
+        assert exact == str(imagehash.phash(Image.open(buffer)))
+        assert distance <= 4
+
+
+def test_draft_phash_is_exact_for_other_formats():
+    buffer = encoded(drawn_picture(1200, 800, 0), "PNG")
+    with Image.open(buffer) as image:
+        draft = phash_image(image, draft=True)
+    buffer.seek(0)
+    assert draft == str(imagehash.phash(Image.open(buffer)))
@@ -0,0 +1,87 @@
+import random
+
+import imagehash
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter
+
+from src.phash_index import PhashIndex, chunk_bounds, hamming_distances
+
+# pytest -x ./tests/test_phash_index.py
+
+
+def random_phashes(amount, seed=0):
+    rng = random.Random(seed)
+    return [f"{rng.getrandbits(64):016x}" for _ in range(amount)]
+
+
+def flip_bits(phash, bits):
+    value = int(phash, 16)
+    for bit in bits:
+        value ^= 1 << bit
+    return f"{value:016x}"
+
+
+def test_chunks_cover_all_bits():
+    for radius in range(32):
+        bounds = chunk_bounds(radius)
+        assert len(bounds) == radius + 1
+        assert sum(bits for _, bits in bounds) == 64
+        assert bounds[-1][0] + bounds[-1][1] == 64
+
+
+def test_hamming_distances():
+    hashes = np.array([0, 1, 2**64 - 1], dtype=np.uint64)
+    assert hamming_distances(hashes, 0).tolist() == [0, 1, 64]
+
+
+@pytest.mark.parametrize("radius", [0, 1, 4, 8])
+def test_find_within_radius(radius):
+    phashes = random_phashes(20000)
+    index = PhashIndex(phashes, radius=radius)
+    rng = random.Random(1)
+
+    for phash in phashes[:200]:
+        near = flip_bits(phash, rng.sample(range(64), radius))
+        assert index.find(near) == (phash, radius)
+
+        far = flip_bits(phash, rng.sample(range(64), radius + 6))
+        match = index.find(far)
+        # a random hash that close to another one is practically impossible
+        assert match is None or match[0] != phash
+
+
+def test_find_returns_the_closest():
+    phash = random_phashes(1)[0]
+    index = PhashIndex([flip_bits(phash, [1, 2, 3]), flip_bits(phash, [7])], radius=4)
+    assert index.find(phash) == (flip_bits(phash, [7]), 1)
+
+
+def test_added_phashes_are_found(monkeypatch):
+    monkeypatch.setattr("src.phash_index.REBUILD_AFTER", 10)
+    index = PhashIndex(radius=3)
+    assert index.find("0" * 16) is None
+
+    phashes = random_phashes(25)
+    for phash in phashes:
+        index.add(phash)
+
+    assert len(index) == 25
+    for phash in phashes:
+        assert index.find(flip_bits(phash, [0, 63])) == (phash, 2)
+
+
+def test_reencoded_picture_is_a_near_duplicate(tmp_path):
+    image = Image.linear_gradient("L").resize((600, 400)).convert("RGB")
+    image.paste((200, 30, 30), (100, 100, 300, 250))
+    image.save(tmp_path / "original.png")
+    image.filter(ImageFilter.GaussianBlur(1)).save(tmp_path / "repost.jpg", quality=70)
+
+    with Image.open(tmp_path / "original.png") as im:
+        original = str(imagehash.phash(im))
+    with Image.open(tmp_path / "repost.jpg") as im:
+        repost = str(imagehash.phash(im))
+
+    index = PhashIndex(random_phashes(1000) + [original], radius=4)
+    match = index.find(repost)
+    assert match is not None and match[0] == original
@@ -0,0 +1,29 @@
+from src.poll_schedule import HOUR, LISTING_WINDOW, PollPolicy, plan_poll
+
+# pytest -x ./tests/test_poll_schedule.py
+
+
+def test_busy_subreddits_are_polled_often_with_small_fetches():
+    busy = plan_poll("busy", posts_per_hour=300 / 24)
+    quiet = plan_poll("quiet", posts_per_hour=5 / 24)
+
+    assert busy.interval < quiet.interval
+    assert busy.amount < LISTING_WINDOW
+    assert quiet.interval == PollPolicy().max_interval
+    assert quiet.amount == PollPolicy().min_amount
+
+
+def test_no_posts_fall_out_of_the_listing():
+    policy = PollPolicy(posts_per_poll=5000, max_interval=30 * 24 * HOUR)
+    for posts_per_hour in [0.01, 0.5, 3, 20, 200]:
+        plan = plan_poll("sub", posts_per_hour, policy)
+        expected_posts = posts_per_hour * plan.interval / HOUR
+        assert expected_posts * policy.safety_factor <= LISTING_WINDOW
+        assert plan.amount >= expected_posts
+
+
+def test_intervals_are_clamped():
+    policy = PollPolicy()
+    assert plan_poll("dead", 0).interval == policy.max_interval
+    assert plan_poll("flood", 10000).interval == policy.min_interval
+    assert plan_poll("flood", 10000).amount == LISTING_WINDOW
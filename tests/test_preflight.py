@@ -0,0 +1,121 @@
+import http.server
+import io
+import os
+import threading
+
+import pytest
+from PIL import Image
+
+from src.preflight import HEADER_BYTES, preflight_check
+
+# pytest -x ./tests/test_preflight.py
+
+
+def noise_image(width, height, format="JPEG"):
+    buffer = io.BytesIO()
+    Image.frombytes("RGB", (width, height), os.urandom(width * height * 3)).save(
+        buffer, format=format
+    )
+    return buffer.getvalue()
+
+
+FILES = {
+    "/good.jpg": ("image/jpeg", noise_image(800, 600)),
+    "/good.png": ("image/png", noise_image(400, 300, "PNG")),
+    "/thin.png": ("image/png", noise_image(300, 100, "PNG")),
+    "/small.jpg": ("image/jpeg", noise_image(20, 20)),
+    "/anim.gif": ("image/gif", noise_image(400, 300, "GIF")),
+    "/clip.mp4": ("video/mp4", os.urandom(100000)),
+    "/gallery": ("text/html", b"<html></html>"),
+}
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves FILES, honours "Range: bytes=start-end" and records how much was sent"""
+
+    sent = {}
+    support_range = True
+
+    def do_GET(self):
+        if self.path not in FILES:
+            self.send_error(404)
+            return
+
+        content_type, body = FILES[self.path]
+        range_header = self.headers.get("Range")
+        if range_header and self.support_range:
+            start, end = range_header.split("=")[1].split("-")
+            part = body[int(start) : int(end) + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+        else:
+            part = body
+            self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(part)))
+        self.end_headers()
+        try:
+            self.wfile.write(part)
+            self.sent[self.path] = len(part)
+        except ConnectionError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(params=[True, False], ids=["range", "no-range"])
+def server(request):
+    handler = type(
+        "Handler", (RangeHandler,), {"sent": {}, "support_range": request.param}
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", handler
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("path", ["/good.jpg", "/good.png"])
+def test_preflight_accepts_good_pictures(server, path):
+    base_url, _ = server
+    result = preflight_check(base_url + path)
+
+    assert result.ok
+    assert result.size == Image.open(io.BytesIO(FILES[path][1])).size
+    assert result.content_length == len(FILES[path][1])
+
+
+@pytest.mark.parametrize(
+    "path, reason",
+    [
+        ("/thin.png", "wrong dimensions"),
+        ("/small.jpg", "too small"),
+        ("/anim.gif", "content type"),
+        ("/clip.mp4", "content type"),
+    ],
+)
+def test_preflight_rejects(server, path, reason):
+    base_url, _ = server
+    result = preflight_check(base_url + path)
+
+    assert not result.ok
+    assert reason in result.reason
+
+
+def test_preflight_doesnt_fetch_the_body(server):
+    base_url, handler = server
+    preflight_check(base_url + "/good.jpg")
+    if handler.support_range:
+        assert handler.sent["/good.jpg"] <= HEADER_BYTES
+
+
+@pytest.mark.parametrize("path", ["/gallery", "/missing"])
+def test_preflight_leaves_other_urls_to_gallery_dl(server, path):
+    base_url, _ = server
+    assert preflight_check(base_url + path).ok
+
+
+def test_preflight_passes_on_network_errors():
+    assert preflight_check("http://127.0.0.1:1/good.jpg", timeout=1).ok
@@ -0,0 +1,98 @@
+import threading
+import time
+
+import pytest
+
+from src.scrape_pipeline import Pipeline
+
+# pytest -x ./tests/test_scrape_pipeline.py
+
+
+def test_pipeline_processes_every_item():
+    written = []
+    pipeline = (
+        Pipeline(queue_size=2)
+        .add_stage("double", lambda x: x * 2, workers=4)
+        .add_stage("drop_odd_tens", lambda x: None if x % 20 == 10 else x, workers=2)
+        .add_batch_stage("write", written.append, batch_size=7)
+    )
+
+    counters = pipeline.run(range(100))
+
+    items = sorted(item for batch in written for item in batch)
+    assert items == [x * 2 for x in range(100) if (x * 2) % 20 != 10]
+    assert all(len(batch) <= 7 for batch in written)
+    assert [c.name for c in counters] == [
+        "producer",
+        "double",
+        "drop_odd_tens",
+        "write",
+    ]
+    assert counters[0].processed == 100
+    assert counters[1].processed == 100
+    assert counters[3].processed == len(items)
+
+
+def test_pipeline_writes_while_producing():
+    """The writer must not wait for the end of the stream"""
+    first_write = threading.Event()
+
+    def items():
+        for item in range(3):
+            yield item
+        assert first_write.wait(timeout=5)
+        yield 3
+
+    written = []
+
+    def write(batch):
+        written.append(batch)
+        first_write.set()
+
+    Pipeline().add_batch_stage("write", write, batch_size=3).run(items())
+
+    assert written == [[0, 1, 2], [3]]
+
+
+def test_pipeline_flushes_partial_batches():
+    written = []
+
+    def items():
+        yield 1
+        time.sleep(0.5)
+        yield 2
+
+    Pipeline().add_batch_stage(
+        "write", written.append, batch_size=100, flush_interval=0.1
+    ).run(items())
+
+    assert written == [[1], [2]]
+
+
+def test_pipeline_counts_failures():
+    def explode(x):
+        if x == 3:
+            raise ValueError
+        return x
+
+    written = []
+    counters = (
+        Pipeline()
+        .add_stage("explode", explode)
+        .add_batch_stage("write", written.extend)
+        .run(range(5))
+    )
+
+    assert sorted(written) == [0, 1, 2, 4]
+    assert counters[1].failed == 1
+
+
+def test_pipeline_reraises_producer_errors():
+    def items():
+        yield 1
+        raise RuntimeError("listing failed")
+
+    written = []
+    with pytest.raises(RuntimeError):
+        Pipeline().add_batch_stage("write", written.extend).run(items())
+    assert written == [1]
@@ -0,0 +1,611 @@
+import asyncio
+import contextlib
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import scrape_reddit
+from scrape_reddit import (
+    DownloadOptions,
+    PostSearchType,
+    SubredditSpec,
+    UrlChecks,
+    attach_known_url_results,
+    _download_submissions_in_pool,
+    buffer_to_payload,
+    filter_new_submissions,
+    flag_near_duplicates,
+    get_scrape_cursor,
+    has_table,
+    make_download_options,
+    parse_subreddit_specs,
+    passes_preflight,
+    prepare_pic_records,
+    save_scrape_cursor,
+    stop_at_watermark,
+)
+from src.phash_index import PhashIndex
+
+# pytest -x ./tests/test_scrape_reddit.py
+
+
+def submission(post_id, **kwargs):
+    return SimpleNamespace(id=post_id, **kwargs)
+
+
+def full_submission(post_id, title="title", url="https://i.redd.it/abc.jpg"):
+    return submission(
+        post_id, author="someone", title=title, url=url, created_utc=1600000000.5
+    )
+
+
+def test_flag_near_duplicates_keeps_own_phash():
+    index = PhashIndex(["a1b2c3d4e5f60718"], radius=4)
+    filtered = [
+        (submission("near"), False, "a1b2c3d4e5f60719"),
+        (submission("new"), False, "0f0f0f0f0f0f0f0f"),
+        (submission("broken"), True, None),
+        (submission("same"), False, "a1b2c3d4e5f60718"),
+    ]
+
+    near_duplicates = flag_near_duplicates(filtered, index)
+
+    assert [(subm.id, *rest) for subm, *rest in near_duplicates] == [
+        ("near", "a1b2c3d4e5f60719", "a1b2c3d4e5f60718", 1)
+    ]
+    assert index.find("0f0f0f0f0f0f0f0e") == ("0f0f0f0f0f0f0f0f", 1)
+
+
+def test_only_direct_urls_are_preflighted(monkeypatch, tmp_path):
+    checked = []
+    monkeypatch.setattr(
+        scrape_reddit,
+        "preflight_check",
+        lambda url, session: checked.append((url, session)) or SimpleNamespace(ok=True),
+    )
+    options = DownloadOptions(folder=str(tmp_path), blob_cache=None)
+
+    assert passes_preflight("https://imgur.com/a/abc", options)
+    assert passes_preflight("https://www.pixiv.net/artworks/123", options)
+    assert passes_preflight("https://i.redd.it/abc.jpg", options)
+    # the session the download goes through afterwards
+    session = scrape_reddit.get_downloader(options.folder).direct_session
+    assert checked == [("https://i.redd.it/abc.jpg", session)]
+
+
+class TableCursor:
+    def __init__(self, tables):
+        self.tables = tables
+        self.queries = 0
+
+    def execute(self, query, params):
+        self.queries += 1
+        self.result = params[0] in self.tables
+
+    def fetchone(self):
+        return (self.result,)
+
+
+def test_has_table_looks_up_once(monkeypatch):
+    monkeypatch.setattr(scrape_reddit, "_existing_tables", {})
+    cursor = TableCursor({"near_duplicate"})
+
+    assert has_table(cursor, "near_duplicate")
+    assert not has_table(cursor, "image_features")
+    assert not has_table(cursor, "image_features")
+    assert cursor.queries == 2
+
+
+def test_prepare_pic_records_truncates_titles():
+    filtered = [(full_submission("abc", title="x" * 300), False, "a1b2c3d4e5f60718")]
+
+    rows, rejected = prepare_pic_records(filtered, "awwnime", {"title": 200})
+
+    assert rejected == []
+    assert rows == [
+        (
+            "awwnime",
+            "abc",
+            "someone",
+            "x" * 200,
+            "https://i.redd.it/abc.jpg",
+            "1600000000",
+            "a1b2c3d4e5f60718",
+            False,
+        )
+    ]
+
+
+def test_prepare_pic_records_rejects_other_long_values():
+    long_url = full_submission("long", url="https://i.redd.it/" + "a" * 300 + ".jpg")
+    long_title = full_submission("title", title="x" * 300)
+    filtered = [(long_url, True, None), (long_title, False, "a1b2c3d4e5f60718")]
+    max_lengths = {"title": 200, "url": 200}
+
+    rows, rejected = prepare_pic_records(filtered, "awwnime", max_lengths)
+    assert [row[1] for row in rows] == ["title"]
+    assert rejected == [(long_url, "too long: url")]
+
+    rows, rejected = prepare_pic_records(
+        filtered, "awwnime", max_lengths, truncate_titles=False
+    )
+    assert rows == []
+    assert [reason for _, reason in rejected] == ["too long: url", "too long: title"]
+
+
+class RecordingCursor:
+    """Answers every query with rows(params) and keeps the params"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.params = []
+
+    def execute(self, query, params):
+        self.params.append(params)
+
+    def fetchall(self):
+        return self.rows(self.params[-1])
+
+
+def test_filter_new_submissions_queries_once_per_page():
+    known = {"2", "5", "6"}
+    cursor = RecordingCursor(
+        lambda params: [(post_id,) for post_id in params[1] if post_id in known]
+    )
+    submissions = (submission(str(number)) for number in range(7))
+
+    new = filter_new_submissions(cursor, "awwnime", submissions, page_size=3)
+
+    assert [subm.id for subm in new] == ["0", "1", "3", "4"]
+    assert cursor.params == [
+        ("awwnime", ["0", "1", "2"]),
+        ("awwnime", ["3", "4", "5"]),
+        ("awwnime", ["6"]),
+    ]
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("awwnime", SubredditSpec("awwnime")),
+        (" awwnime ", SubredditSpec("awwnime")),
+        ("awwnime:top", SubredditSpec("awwnime", PostSearchType.TOP)),
+        ("awwnime:HOT:50", SubredditSpec("awwnime", PostSearchType.HOT, 50)),
+        ("awwnime::50", SubredditSpec("awwnime", PostSearchType.NEW, 50)),
+        ("awwnime:PostSearchType.TOP", SubredditSpec("awwnime", PostSearchType.TOP)),
+    ],
+)
+def test_subreddit_spec_from_str(value, expected):
+    assert SubredditSpec.from_str(value) == expected
+
+
+def test_subreddit_spec_rejects_unknown_modes():
+    with pytest.raises(KeyError):
+        SubredditSpec.from_str("awwnime:rising")
+
+
+def test_parse_subreddit_specs():
+    expected = [SubredditSpec("a", PostSearchType.NEW, 10), SubredditSpec("b")]
+    assert parse_subreddit_specs("a:new:10,b,") == expected
+    assert parse_subreddit_specs(("a:new:10", "b")) == expected
+
+
+def posts_created_at(*times):
+    return [submission(str(number), created_utc=t) for number, t in enumerate(times)]
+
+
+def test_stop_at_watermark_after_a_run_of_old_posts():
+    # a single old post (reapproved) doesn't stop the listing
+    posts = posts_created_at(110, 105, 90, 104, 101, 100, 95, 99, 80)
+
+    taken = list(stop_at_watermark(iter(posts), watermark=100, run=3))
+
+    assert [subm.created_utc for subm in taken] == [110, 105, 90, 104, 101, 100, 95, 99]
+
+
+def test_stop_at_watermark_resets_the_run_on_newer_posts():
+    posts = posts_created_at(100, 90, 101, 80, 70, 102, 60, 50, 40, 30)
+
+    taken = list(stop_at_watermark(iter(posts), watermark=100, run=3))
+
+    assert [subm.created_utc for subm in taken] == [
+        100,
+        90,
+        101,
+        80,
+        70,
+        102,
+        60,
+        50,
+        40,
+    ]
+
+
+def test_stop_at_watermark_doesnt_read_past_the_stop():
+    read = []
+
+    def listing():
+        for subm in posts_created_at(50, 40, 30, 20):
+            read.append(subm.created_utc)
+            yield subm
+
+    assert len(list(stop_at_watermark(listing(), watermark=100, run=2))) == 2
+    assert read == [50, 40]
+
+
+def test_attach_known_url_results_per_page():
+    known = {"https://i.redd.it/a.jpg": (False, "a1b2c3d4e5f60718")}
+    cursor = RecordingCursor(
+        lambda params: [(url, *known[url]) for url in params[0] if url in known]
+    )
+    submissions = [
+        submission("1", url="https://i.redd.it/a.jpg"),
+        submission("2", url="https://i.redd.it/b.jpg"),
+        submission("3", url="https://i.redd.it/a.jpg"),  # crosspost
+    ]
+
+    paired = list(attach_known_url_results(cursor, submissions, page_size=2))
+
+    assert [(subm.id, result) for subm, result in paired] == [
+        ("1", (False, "a1b2c3d4e5f60718")),
+        ("2", None),
+        ("3", (False, "a1b2c3d4e5f60718")),
+    ]
+    assert [sorted(params[0]) for params in cursor.params] == [
+        ["https://i.redd.it/a.jpg", "https://i.redd.it/b.jpg"],
+        ["https://i.redd.it/a.jpg"],
+    ]
+
+
+def test_make_download_options(tmp_path):
+    options = make_download_options(
+        str(tmp_path), 4, download_timeout=30, max_memory_mb=8, phash_mode="draft"
+    )
+
+    assert (options.workers, options.timeout) == (4, 30)
+    assert options.max_memory == 8 * 1000000
+    assert options.preflight and not options.in_memory
+    assert options.phash_mode == "draft"
+    with pytest.raises(TypeError):
+        make_download_options(str(tmp_path), 4, download_timout=30)
+
+
+def test_buffer_to_payload(tmp_path):
+    options = DownloadOptions(str(tmp_path), max_memory=4, blob_cache=None)
+
+    with tempfile.SpooledTemporaryFile(max_size=4) as buffer:
+        buffer.write(b"abcd")
+        assert buffer_to_payload(buffer, "1600000000_small", options) == b"abcd"
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_buffer_to_payload_spilled(tmp_path):
+    options = DownloadOptions(str(tmp_path), max_memory=4, blob_cache=None)
+
+    with tempfile.SpooledTemporaryFile(max_size=4) as buffer:
+        buffer.write(b"abcdef")
+        payload = buffer_to_payload(buffer, "1600000000_big", options)
+
+    assert payload == tmp_path / "1600000000_big"
+    assert payload.read_bytes() == b"abcdef"
+
+
+class CountingPool:
+    """GalleryDLPool stand-in that records the urls of its downloads"""
+
+    def __init__(self):
+        self.urls = []
+
+    def submit(self, func, *args, url=None):
+        self.urls.append(url)
+        future = Future()
+        future.set_result((False, f"phash of {url}", None))
+        return future
+
+
+def test_url_checks_download_crossposts_once():
+    pool = CountingPool()
+    url_checks = UrlChecks()
+    options = DownloadOptions("folder", blob_cache=None)
+    crosspost = "https://i.redd.it/same.jpg"
+
+    first = _download_submissions_in_pool(
+        [full_submission("a1", url=crosspost)], options, pool, url_checks
+    )
+    second = _download_submissions_in_pool(
+        [
+            full_submission("b1", url=crosspost),
+            full_submission("b2", url="https://i.redd.it/other.jpg"),
+        ],
+        options,
+        pool,
+        url_checks,
+    )
+
+    assert pool.urls == [crosspost, "https://i.redd.it/other.jpg"]
+    assert first[0][1:3] == second[0][1:3] == (False, f"phash of {crosspost}")
+    assert [subm.id for subm, *_ in second] == ["b1", "b2"]
+
+
+def test_url_checks_claim():
+    url_checks = UrlChecks()
+
+    check, is_first = url_checks.claim("https://i.redd.it/a.jpg")
+    again, is_again_first = url_checks.claim("https://i.redd.it/a.jpg")
+
+    assert is_first and not is_again_first
+    assert again is check
+    assert url_checks.claim("https://i.redd.it/b.jpg")[1]
+
+
+class InlinePool:
+    """GalleryDLPool and multiprocessing.Pool stand-in that runs everything in the caller"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def apply(self, func, args):
+        return func(*args)
+
+
+def test_pipeline_downloads_crossposts_once(monkeypatch):
+    downloads, rows = [], []
+    monkeypatch.setattr(scrape_reddit, "GalleryDLPool", InlinePool)
+    monkeypatch.setattr(scrape_reddit.multiprocessing, "Pool", InlinePool)
+    monkeypatch.setattr(
+        scrape_reddit, "filter_new_submissions", lambda cur, name, subms: subms
+    )
+    monkeypatch.setattr(
+        scrape_reddit,
+        "attach_known_url_results",
+        lambda cur, subms: ((subm, None) for subm in subms),
+    )
+
+    def download_payload(subm, options, pool):
+        downloads.append(subm.url)
+        return subm, subm.url.encode()
+
+    def add_filtered_submissions_to_db(conn, filtered, name, **kwargs):
+        rows.extend(filtered)
+        return len(filtered)
+
+    monkeypatch.setattr(scrape_reddit, "download_payload", download_payload)
+    monkeypatch.setattr(
+        scrape_reddit,
+        "check_payload",
+        lambda payload, *args: (False, f"phash of {payload.decode()}", None),
+    )
+    monkeypatch.setattr(
+        scrape_reddit, "add_filtered_submissions_to_db", add_filtered_submissions_to_db
+    )
+    connection = SimpleNamespace(cursor=contextlib.nullcontext)
+    crosspost = "https://i.redd.it/same.jpg"
+    listing = [
+        full_submission("a", url=crosspost),
+        full_submission("b", url="https://i.redd.it/other.jpg"),
+        full_submission("c", url=crosspost),
+    ]
+
+    summary = scrape_reddit.scrape_submissions_pipeline(
+        connection,
+        "awwnime",
+        listing,
+        DownloadOptions("folder", workers=4, blob_cache=None),
+    )
+
+    assert sorted(downloads) == sorted([crosspost, "https://i.redd.it/other.jpg"])
+    assert sorted((subm.id, phash) for subm, _, phash in rows) == [
+        ("a", f"phash of {crosspost}"),
+        ("b", "phash of https://i.redd.it/other.jpg"),
+        ("c", f"phash of {crosspost}"),
+    ]
+    assert (summary.inserted, summary.reused) == (3, 1)
+
+
+class ScrapeCursorTable:
+    """Recording cursor that keeps scrape_cursor rows the way its upsert does"""
+
+    def __init__(self, rows=None):
+        self.rows = dict(rows or {})
+        self.saved = []
+
+    def execute(self, query, params):
+        if query.startswith("INSERT"):
+            sub_name, created_utc = params
+            self.saved.append(params)
+            self.rows[sub_name] = max(self.rows.get(sub_name, created_utc), created_utc)
+        else:
+            self.result = self.rows.get(params[0])
+
+    def fetchone(self):
+        return None if self.result is None else (self.result,)
+
+
+def test_scrape_cursor_only_moves_forward():
+    cursor = ScrapeCursorTable()
+    assert get_scrape_cursor(cursor, "awwnime") is None
+
+    save_scrape_cursor(cursor, "awwnime", 1600000100)
+    save_scrape_cursor(cursor, "awwnime", 1600000050)
+
+    assert get_scrape_cursor(cursor, "awwnime") == 1600000100
+
+
+@pytest.fixture
+def psaw_run(monkeypatch):
+    """psaw_scrape against a fake pushshift stream of 5 posts from 1000 on,
+    returns the scrape cursor, the batches and the after dates of the stream queries
+    """
+    cursor = ScrapeCursorTable({"awwnime": 1000})
+    run = SimpleNamespace(cursor=cursor, batches=[], after=[], pulled=0, clock=0)
+
+    def get_submissions(sub_name, since_date):
+        run.after.append(since_date)
+        for number in range(5):
+            run.pulled += 1
+            yield submission(str(number), created_utc=1000.5 + number)
+
+    def scrape_submissions(conn, sub_name, batch, *args):
+        run.batches.append([subm.id for subm in batch])
+        run.clock += 10
+        return "summary"
+
+    monkeypatch.setattr(scrape_reddit, "connect_to_postgres", lambda: (None, cursor))
+    monkeypatch.setattr(scrape_reddit, "close_postgres_connection", lambda *args: None)
+    monkeypatch.setattr(scrape_reddit, "clear_folder", lambda folder: None)
+    monkeypatch.setattr(scrape_reddit, "GalleryDLPool", InlinePool)
+    monkeypatch.setattr(scrape_reddit, "get_submissions", get_submissions)
+    monkeypatch.setattr(scrape_reddit, "scrape_submissions", scrape_submissions)
+    monkeypatch.setattr(scrape_reddit.time, "monotonic", lambda: run.clock)
+    return run
+
+
+def test_psaw_scrape_checkpoints_every_batch(psaw_run):
+    scrape_reddit.Scraper().psaw_scrape("awwnime", amount=2)
+
+    # resumes one second before the cursor, posts of that second may be split
+    assert psaw_run.after == [999]
+    assert psaw_run.batches == [["0", "1"], ["2", "3"], ["4"]]
+    assert psaw_run.cursor.saved == [
+        ("awwnime", 1001),
+        ("awwnime", 1003),
+        ("awwnime", 1004),
+    ]
+
+
+def test_psaw_scrape_row_budget(psaw_run):
+    scrape_reddit.Scraper().psaw_scrape("awwnime", amount=2, max_rows=3)
+
+    assert psaw_run.batches == [["0", "1"], ["2", "3"]]
+    assert psaw_run.pulled == 4  # the stream isn't read past the budget
+    assert get_scrape_cursor(psaw_run.cursor, "awwnime") == 1003
+
+
+def test_psaw_scrape_time_budget(psaw_run):
+    # every batch takes 10 seconds
+    scrape_reddit.Scraper().psaw_scrape("awwnime", amount=2, max_seconds=15)
+
+    assert psaw_run.batches == [["0", "1"], ["2", "3"]]
+    assert psaw_run.cursor.saved == [("awwnime", 1001), ("awwnime", 1003)]
+
+
+@pytest.fixture
+def async_scrape(monkeypatch):
+    """Runs scrape_subreddit_async for {spec name: listing} on one context,
+    listings are new posts whose url is known if it ends in "known.jpg".
+    Returns the summaries, the downloaded urls and the written batches.
+    """
+    run = SimpleNamespace(downloads=[], writes=[])
+
+    def lookup_page(connection, sub_name, page):
+        known = {
+            str(subm.url): (False, f"phash of {subm.url}")
+            for subm in page
+            if str(subm.url).endswith("known.jpg")
+        }
+        return page, known
+
+    def download_payload(subm, options, pool):
+        run.downloads.append(str(subm.url))
+        return subm, str(subm.url)
+
+    def add_filtered_submissions_to_db(conn, filtered, sub_name, **kwargs):
+        run.writes.append((sub_name, [(subm.id, phash) for subm, _, phash in filtered]))
+        return len(filtered)
+
+    monkeypatch.setattr(scrape_reddit, "read_watermark", lambda conn, name: None)
+    monkeypatch.setattr(scrape_reddit, "lookup_page", lookup_page)
+    monkeypatch.setattr(scrape_reddit, "download_payload", download_payload)
+    monkeypatch.setattr(
+        scrape_reddit,
+        "check_payload",
+        lambda payload, *args: (False, f"phash of {payload}", None),
+    )
+    monkeypatch.setattr(
+        scrape_reddit, "add_filtered_submissions_to_db", add_filtered_submissions_to_db
+    )
+
+    def scrape(listings, batch_size):
+        monkeypatch.setattr(
+            scrape_reddit,
+            "get_listing",
+            lambda reddit, name, *args, **kwargs: listings[name],
+        )
+
+        async def scrape_all():
+            with ThreadPoolExecutor(max_workers=2) as executor, ThreadPoolExecutor(
+                max_workers=1
+            ) as reddit_executor, ThreadPoolExecutor(max_workers=1) as db_executor:
+                ctx = scrape_reddit.AsyncScrapeContext(
+                    reddit=None,
+                    connection=None,
+                    options=DownloadOptions("folder", workers=2, blob_cache=None),
+                    download_pool=None,
+                    download_executor=executor,
+                    hash_executor=executor,
+                    reddit_executor=reddit_executor,
+                    db_executor=db_executor,
+                    download_slots=asyncio.Semaphore(2),
+                    batch_size=batch_size,
+                )
+                return await asyncio.gather(
+                    *(
+                        scrape_reddit.scrape_subreddit_async(ctx, SubredditSpec(name))
+                        for name in listings
+                    )
+                )
+
+        run.summaries = asyncio.run(scrape_all())
+        return run
+
+    return scrape
+
+
+def test_scrape_subreddit_async_writes_full_batches(async_scrape):
+    listing = [
+        full_submission("k1", url="https://i.redd.it/1known.jpg"),
+        full_submission("k2", url="https://i.redd.it/2known.jpg"),
+        full_submission("k3", url="https://i.redd.it/3known.jpg"),
+        full_submission("d1", url="https://i.redd.it/d1.jpg"),
+        full_submission("d2", url="https://i.redd.it/d2.jpg"),
+    ]
+
+    run = async_scrape({"awwnime": listing}, batch_size=2)
+
+    # rows of known urls count towards the batch size too
+    assert [len(rows) for _, rows in run.writes] == [2, 2, 1]
+    assert sorted(row for _, rows in run.writes for row in rows) == sorted(
+        (subm.id, f"phash of {subm.url}") for subm in listing
+    )
+    summary = run.summaries[0]
+    assert (summary.new, summary.reused, summary.inserted) == (5, 3, 5)
+
+
+def test_scrape_subreddit_async_shares_url_checks(async_scrape):
+    crosspost = "https://i.redd.it/same.jpg"
+    listings = {
+        "awwnime": [full_submission("a1", url=crosspost)],
+        "patchuu": [
+            full_submission("p1", url=crosspost),
+            full_submission("p2", url="https://i.redd.it/other.jpg"),
+        ],
+    }
+
+    run = async_scrape(listings, batch_size=50)
+
+    assert sorted(run.downloads) == sorted([crosspost, "https://i.redd.it/other.jpg"])
+    assert {name: sorted(rows) for name, rows in run.writes} == {
+        "awwnime": [("a1", f"phash of {crosspost}")],
+        "patchuu": [
+            ("p1", f"phash of {crosspost}"),
+            ("p2", "phash of https://i.redd.it/other.jpg"),
+        ],
+    }
@@ -0,0 +1,25 @@
+from src.static_ledger import get_file_name, plan_reconcile, scan_folder
+
+# pytest -x ./tests/test_static_ledger.py
+
+
+def test_scan_folder(tmp_path):
+    (tmp_path / "anime_abc.jpg").write_bytes(b"x" * 10)
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "anime_def.jpg").write_bytes(b"x" * 3)
+
+    assert scan_folder(str(tmp_path)) == {"anime_abc.jpg": 10, "sub/anime_def.jpg": 3}
+    assert get_file_name(str(tmp_path), tmp_path / "sub" / "a.jpg") == "sub/a.jpg"
+
+
+def test_plan_reconcile():
+    scanned = {"same.jpg": 5, "resized.jpg": 7, "new.jpg": 1}
+    recorded = {"same.jpg": 5, "resized.jpg": 6, "gone.jpg": 9}
+
+    changed, removed = plan_reconcile(scanned, recorded)
+    assert changed == {"resized.jpg": 7, "new.jpg": 1}
+    assert removed == ["gone.jpg"]
+
+
+def test_plan_reconcile_in_sync():
+    assert plan_reconcile({"a.jpg": 1}, {"a.jpg": 1}) == ({}, [])
@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# pytest -x ./tests/test_token_cache.py
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# a fresh process that logs in the way gallery-dl's pixiv and deviantart extractors do,
+# "login" is printed only when the token wasn't cached
+LOGIN_SCRIPT = """
+from gallery_dl import extractor
+from src.gallery_dl_helper import GalleryDownloader
+
+def login(username):
+    print("login")
+    return "token of " + username
+
+GalleryDownloader(None)
+extr = extractor.find("https://www.pixiv.net/en/artworks/1")
+if hasattr(extr, "cache"):
+    print(extr.cache(login, "user", _exp={expires}, _mem=False))
+else:  # gallery-dl before 1.26
+    from gallery_dl.cache import cache
+    print(cache(maxage={expires}, keyarg=0)(login)("user"))
+"""
+
+
+def run_login(cache_path: Path, expires: int) -> list:
+    env = dict(os.environ, GALLERY_DL_CACHE_PATH=str(cache_path))
+    result = subprocess.run(
+        [sys.executable, "-c", LOGIN_SCRIPT.format(expires=expires)],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.split("\n")[:-1]
+
+
+def test_token_is_shared_between_processes(tmp_path):
+    cache_path = tmp_path / "cache.sqlite3"
+
+    assert run_login(cache_path, expires=3600) == ["login", "token of user"]
+    assert run_login(cache_path, expires=3600) == ["token of user"]
+    assert cache_path.is_file()
+
+
+def test_expired_token_is_refreshed(tmp_path):
+    cache_path = tmp_path / "cache.sqlite3"
+
+    assert run_login(cache_path, expires=1) == ["login", "token of user"]
+    time.sleep(1.5)
+    assert run_login(cache_path, expires=1) == ["login", "token of user"]